@@ -1,11 +1,14 @@
 from pyramid.authentication import BasicAuthAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated, Everyone
 from sqlalchemy import engine_from_config
 
 from reliquary.models import DBSession, Base
+from reliquary.offload import offload_backend
+from reliquary.rebuild import start_rebuild_worker_on_request
 
 
 # helper for auto-appending slashes to not found urls
@@ -112,6 +115,12 @@ def main(global_config, **settings):
     config.add_route('debian_archpackages', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages', request_method='GET')
     config.add_route('debian_archpackagesgz', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages.gz', request_method='GET')
     config.add_route('debian_archpackagesbz2', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages.bz2', request_method='GET')
+    config.add_route('debian_archpackagesxz', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages.xz', request_method='GET')
+    config.add_route('debian_archpackagesdiffbyhash', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages.diff/by-hash/SHA256/{sha256}', request_method='GET')
+    config.add_route('debian_archpackagesdiff', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/Packages.diff/{name}', request_method='GET')
+    config.add_route('debian_archbyhash', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/by-hash/SHA256/{sha256}', request_method='GET')
+    config.add_route('debian_translationbyhash', '/api/v1/debian/{channel}/dist/{index}/main/i18n/by-hash/SHA256/{sha256}', request_method='GET')
+    config.add_route('debian_translation', '/api/v1/debian/{channel}/dist/{index}/main/i18n/{name}', request_method='GET')
     config.add_route('debian_poolpackage', '/api/v1/debian/{channel}/pool/{index}/{relic_name}', request_method='GET')
     # additional paths that could be just a directory listing of some sort (like autoindex)
     config.add_route('debian_archindex', '/api/v1/debian/{channel}/dist/{index}/main/binary-{arch}/', request_method='GET')
@@ -126,4 +135,13 @@ def main(global_config, **settings):
 
     config.scan('.views')
 
-    return config.make_wsgi_app()
+    # debian indices queued for regeneration by uploads are rebuilt in the
+    # background of the served app
+    config.add_subscriber(start_rebuild_worker_on_request, NewRequest)
+
+    app = config.make_wsgi_app()
+
+    # a misconfigured offload frontend is an error on startup, not per request
+    offload_backend(app.registry)
+
+    return app
@@ -0,0 +1,109 @@
+import filecmp
+import logging
+import os
+import tempfile
+
+from pyramid.threadlocal import get_current_registry
+
+
+logger = logging.getLogger(__name__)
+
+# stored blobs (and so every relic linked to one) are read-only
+BLOB_MODE = 0o444
+
+
+def _settings():
+    return get_current_registry().settings or {}
+
+
+# whether relics are deduplicated through the blob store (reliquary.blob_store)
+def blob_store_enabled(settings=None):
+    if settings is None:
+        settings = _settings()
+    return settings.get('reliquary.blob_store', 'false') == 'true'
+
+
+# blobs are stored under reliquary.blob_location (defaults to a hidden folder
+# in reliquary.location -- relics are hardlinks to their blob, so it has to be
+# on the same filesystem)
+def blob_location(settings=None):
+    if settings is None:
+        settings = _settings()
+    location = settings.get('reliquary.blob_location', None)
+    if not location:
+        location = os.path.join(settings.get('reliquary.location', ''), '.blobs')
+    return os.path.normpath(location)
+
+
+def blob_path(sha256, settings=None):
+    return os.path.join(blob_location(settings), 'sha256', sha256[:2], sha256[2:4], sha256)
+
+
+# replaces 'path' with a hardlink to 'target', without it ever missing
+def _link_over(target, path):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.link')
+    os.close(fd)
+    os.remove(temp_path)
+    os.link(target, temp_path)
+    os.replace(temp_path, path)
+
+
+# stores the relic at 'path' (whose contents have 'sha256') in the blob store.
+# if a relic with the same contents is already stored, 'path' is replaced with
+# a hardlink to it, otherwise 'path' becomes the stored blob. returns whether
+# 'path' was deduplicated. the contents are compared first, since a relic is
+# only ever replaced with a blob of the same contents. every relic linked to a
+# blob shares its inode, so blobs are made read-only -- a relic written to in
+# place (instead of being replaced) would change all of them, and no longer
+# match its sha256.
+def store_blob(path, sha256, settings=None):
+    target = blob_path(sha256, settings)
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(path, target)
+            os.chmod(target, BLOB_MODE)
+            return False
+        except FileExistsError:
+            pass
+        if os.path.samefile(target, path):
+            return False
+        # 'sha256' may be stale (it comes from the database), and replacing
+        # the relic with a blob of other contents would lose it
+        if not filecmp.cmp(target, path, shallow=False):
+            logger.error('"{}" does not have the contents of blob {}, not '
+                         'deduplicating it'.format(path, sha256))
+            return False
+        _link_over(target, path)
+        return True
+    except OSError as ex:
+        logger.error('unable to store "{}" as a blob: {}'.format(path, ex))
+        return False
+
+
+# removes the blobs no relic links to anymore (their only link is the blob
+# store's own), and the shard folders that leaves empty. returns how many
+# blobs, and how many bytes, were removed.
+def collect_blobs(settings=None):
+    removed, freed = 0, 0
+    root = os.path.join(blob_location(settings), 'sha256')
+    if not os.path.isdir(root):
+        return removed, freed
+    for folder, subfolders, files in os.walk(root, topdown=False):
+        for name in files:
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_nlink > 1:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += stat.st_size
+        if folder != root and not os.listdir(folder):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+    return removed, freed
@@ -0,0 +1,248 @@
+import collections
+import datetime
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import transaction
+
+from pyramid.threadlocal import get_current_registry
+from sqlalchemy.exc import IntegrityError
+
+from reliquary.models import DBSession, FileCache, FileCacheDependency
+
+
+logger = logging.getLogger(__name__)
+
+# default for the reliquary.cache_memory setting -- how many bytes of the most
+# recently read cached files are kept in memory
+CACHE_MEMORY = 64 * 1024 * 1024
+
+
+# cached file contents by sha256, least recently read first. the contents of
+# a sha256 never change, so entries never need to be invalidated, only evicted.
+class MemoryCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, sha256):
+        with self.lock:
+            value = self.entries.get(sha256, None)
+            if value is not None:
+                self.entries.move_to_end(sha256)
+            return value
+
+    def put(self, sha256, value, limit):
+        if len(value) > limit:
+            return
+        with self.lock:
+            if sha256 in self.entries:
+                self.entries.move_to_end(sha256)
+                return
+            self.entries[sha256] = value
+            self.size += len(value)
+            while self.size > limit:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+memory_cache = MemoryCache()
+
+
+def _settings():
+    return get_current_registry().settings or {}
+
+
+# cached files are stored by their sha256 under reliquary.cache_location
+# (defaults to a hidden folder in reliquary.location)
+def cache_location(settings=None):
+    if settings is None:
+        settings = _settings()
+    location = settings.get('reliquary.cache_location', None)
+    if not location:
+        location = os.path.join(settings.get('reliquary.location', ''), '.cache')
+    return os.path.normpath(location)
+
+
+def cache_path(sha256):
+    return os.path.join(cache_location(), sha256[:2], sha256)
+
+
+def _write_file(sha256, value):
+    path = cache_path(sha256)
+    if os.path.exists(path):
+        return
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=folder, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(value)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+
+# removes the files of 'sha256s' no cached file refers to anymore
+def _remove_files(sha256s):
+    if not sha256s:
+        return
+    referenced = set(sha256 for (sha256,) in
+                     DBSession.query(FileCache.sha256)
+                              .filter(FileCache.sha256.in_(sha256s)))
+    for sha256 in set(sha256s) - referenced:
+        try:
+            os.unlink(cache_path(sha256))
+        except FileNotFoundError:
+            pass
+
+
+# the cached file for 'key', or None if it isn't cached
+def cache_get(key):
+    entry = DBSession.query(FileCache).filter_by(key=key).one_or_none()
+    if entry and not os.path.exists(cache_path(entry.sha256)):
+        logger.error('file for cache key "{}" is missing'.format(key))
+        cache_invalidate([key])
+        return None
+    return entry
+
+
+# the contents of a cached file
+def cache_value(entry):
+    value = memory_cache.get(entry.sha256)
+    if value is None:
+        with open(cache_path(entry.sha256), 'rb') as fin:
+            value = fin.read()
+        memory_cache.put(entry.sha256, value, int(_settings().get('reliquary.cache_memory', CACHE_MEMORY)))
+    return value
+
+
+# key a superseded version of a cached file is kept under
+def cache_history_key(key, sha256):
+    return '{}@{}'.format(key, sha256)
+
+
+def _startswith(prefix):
+    pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+    return FileCache.key.like(pattern, escape='\\')
+
+
+# keys of the cached files starting with 'prefix'
+def cache_keys(prefix):
+    return set(key for (key,) in
+               DBSession.query(FileCache.key).filter(_startswith(prefix)))
+
+
+# superseded versions of 'key', newest first
+def cache_history(key):
+    return DBSession.query(FileCache) \
+                    .filter(_startswith(key + '@')) \
+                    .order_by(FileCache.mtime.desc(), FileCache.uid.desc())
+
+
+# drops the cached files for 'keys', keeping the ones that have a history as
+# superseded versions. has to be called within a transaction. returns the
+# sha256 of the dropped files, for _remove_files once it's committed.
+def _supersede(keys):
+    removed = set()
+    entries = DBSession.query(FileCache.uid,
+                              FileCache.key,
+                              FileCache.sha256,
+                              FileCache.history) \
+                       .filter(FileCache.key.in_(keys)) \
+                       .all()
+    dropped = [uid for (uid, key, sha256, history) in entries if not history]
+    removed.update(sha256 for (uid, key, sha256, history) in entries if not history)
+    if dropped:
+        DBSession.query(FileCache) \
+                 .filter(FileCache.uid.in_(dropped)) \
+                 .delete(synchronize_session=False)
+
+    for (uid, key, sha256, history) in entries:
+        if not history:
+            continue
+        historykey = cache_history_key(key, sha256)
+        DBSession.query(FileCache) \
+                 .filter_by(key=historykey) \
+                 .delete(synchronize_session=False)
+        DBSession.query(FileCache) \
+                 .filter_by(uid=uid) \
+                 .update({'key': historykey}, synchronize_session=False)
+        expired = cache_history(key).with_entities(FileCache.uid, FileCache.sha256) \
+                                    .offset(history) \
+                                    .all()
+        if expired:
+            removed.update(expiredsha256 for (expireduid, expiredsha256) in expired)
+            DBSession.query(FileCache) \
+                     .filter(FileCache.uid.in_([expireduid for (expireduid, expiredsha256) in expired])) \
+                     .delete(synchronize_session=False)
+
+    DBSession.query(FileCacheDependency) \
+             .filter(FileCacheDependency.key.in_(keys)) \
+             .delete(synchronize_session=False)
+    return removed
+
+
+# caches 'value' (bytes) under 'key', replacing whatever was cached there.
+# 'depends' are the keys of the cached files 'value' was generated from;
+# invalidating any of them also invalidates 'key'. the last 'history'
+# superseded versions of 'key' are kept (see cache_history).
+def cache_put(key, value, depends=(), history=0):
+    sha256 = hashlib.sha256(value).hexdigest()
+    _write_file(sha256, value)
+    memory_cache.put(sha256, value, int(_settings().get('reliquary.cache_memory', CACHE_MEMORY)))
+
+    entry = FileCache(
+        key=key,
+        mtime=datetime.datetime.utcnow(),
+        size=len(value),
+        md5sum=hashlib.md5(value).hexdigest(),
+        sha1=hashlib.sha1(value).hexdigest(),
+        sha256=sha256,
+        history=history)
+    try:
+        with transaction.manager:
+            removed = _supersede([key])
+            DBSession.add(entry)
+            for dependency in set(depends):
+                DBSession.add(FileCacheDependency(key=key, depends_on=dependency))
+    except IntegrityError:
+        # someone else cached 'key' at the same time -- theirs is as good
+        logger.warning('cache key "{}" was cached concurrently'.format(key))
+        return entry
+    _remove_files(removed - set([sha256]))
+    return entry
+
+
+# the keys 'key' was generated from when it was cached
+def cache_dependencies(key):
+    return set(depends_on for (depends_on,) in
+               DBSession.query(FileCacheDependency.depends_on)
+                        .filter_by(key=key))
+
+
+# drops the cached files for 'keys' and everything that (transitively) depends
+# on them (keeping superseded versions, as cache_put does). returns all of the
+# keys that were invalidated.
+def cache_invalidate(keys):
+    invalidated = set(keys)
+    pending = set(keys)
+    while pending:
+        dependents = set(key for (key,) in
+                         DBSession.query(FileCacheDependency.key)
+                                  .filter(FileCacheDependency.depends_on.in_(pending))
+                                  .distinct())
+        pending = dependents - invalidated
+        invalidated |= pending
+
+    if invalidated:
+        with transaction.manager:
+            removed = _supersede(invalidated)
+        _remove_files(removed)
+    return invalidated
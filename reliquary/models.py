@@ -5,9 +5,10 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index as SqlIndex,
     Integer,
-    LargeBinary,
     Text,
+    UniqueConstraint,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker
@@ -19,18 +20,32 @@ DBSession = scoped_session(sessionmaker(
 Base = declarative_base()
 
 
-# simple cache for certain files that need to be pregenerated
+# simple cache for certain files that need to be pregenerated. the files
+# themselves are stored on disk by their sha256 (see reliquary.cache)
 class FileCache(Base):
     __tablename__ = "rcache"
     uid = Column(Integer, primary_key=True)
 
-    key = Column(Text)
-    value = Column(LargeBinary)
+    key = Column(Text, unique=True)
     mtime = Column(DateTime, default=datetime.datetime.utcnow())
     size = Column(Integer)
     md5sum = Column(Text)
     sha1 = Column(Text)
-    sha256 = Column(Text)
+    sha256 = Column(Text, index=True)
+
+    # how many superseded versions of this key are kept around (under
+    # '<key>@<sha256>') when it's replaced or invalidated
+    history = Column(Integer, default=0)
+
+
+# what each cached file was generated from, so invalidating a cached file also
+# invalidates everything generated from it (see reliquary.cache)
+class FileCacheDependency(Base):
+    __tablename__ = "rcache_deps"
+    uid = Column(Integer, primary_key=True)
+
+    key = Column(Text, index=True)
+    depends_on = Column(Text, index=True)
 
 
 class Channel(Base):
@@ -54,6 +69,9 @@ class Index(Base):
 
 class Relic(Base):
     __tablename__ = "relics"
+    __table_args__ = (
+        SqlIndex('ix_relics_index_normalized_name', 'index_id', 'normalized_name'),
+    )
     uid = Column(Integer, primary_key=True)
     dirty = Column(Boolean, default=True)
     index_id = Column(Integer, ForeignKey('indices.uid'))
@@ -61,6 +79,15 @@ class Relic(Base):
     name = Column(Text)
     mtime = Column(Text)
     size = Column(Integer)
+    sha256 = Column(Text, nullable=True)            # only known if the relic was hashed when indexed
+
+    # parsed out of the relic name when it's indexed (see
+    # reliquary.utils.relic_name_columns) so package lookups don't have to
+    # regex every relic in an index
+    package_name = Column(Text, nullable=True)
+    normalized_name = Column(Text, nullable=True)
+    version = Column(Text, nullable=True)
+    extension = Column(Text, nullable=True)
 
     # additional debinfo if relic is a debian file
     debinfo = relationship("DebInfo", uselist=False, backref="relic", cascade="all, delete-orphan")
@@ -68,8 +95,13 @@ class Relic(Base):
 
 class DebInfo(Base):
     __tablename__ = "debinfo"
+    __table_args__ = (
+        SqlIndex('ix_debinfo_index_arch', 'index_id', 'arch'),
+    )
     uid = Column(Integer, primary_key=True)
     relic_id = Column(Integer, ForeignKey('relics.uid'))
+    index_id = Column(Integer, ForeignKey('indices.uid'))  # same as relic.index_id, so Packages can be built from this table alone
+    arch = Column(Text)                             # normalized 'architecture' (lowercase, single value)
 
     filename = Column(Text)                         # Packages index: mandatory
     #size = Column(Integer)                          # Packages index: mandatory -- see Relic.size
@@ -98,3 +130,37 @@ class DebInfo(Base):
     description = Column(Text)                      # mandatory
     homepage = Column(Text, nullable=True)          # optional
     built_using = Column(Text, nullable=True)       # optional
+
+    stanza = Column(Text, nullable=True)            # this package's entry in the Packages index, rendered when indexed
+    stanza_short = Column(Text, nullable=True)      # same, with only the short description (see reliquary.debian.split_descriptions)
+
+
+# debian indices waiting to be regenerated in the background, one row per
+# index/architecture however often it's asked for (see
+# reliquary.utils.enqueue_debian_rebuild)
+class RebuildQueue(Base):
+    __tablename__ = "rebuild_queue"
+    __table_args__ = (
+        UniqueConstraint('index_id', 'arch'),
+    )
+    uid = Column(Integer, primary_key=True)
+    index_id = Column(Integer, ForeignKey('indices.uid'))
+    arch = Column(Text)                             # 'all' regenerates every architecture
+
+    first_requested = Column(DateTime)
+    requested = Column(DateTime)                    # the last time it was asked for
+
+
+# upstream metadata documents (pypi simple pages, npm packuments) the proxy
+# views have fetched, with what's needed to revalidate them with upstream. the
+# documents themselves are cached files (see reliquary.upstream.upstream_document)
+class UpstreamDocument(Base):
+    __tablename__ = "upstream_documents"
+    uid = Column(Integer, primary_key=True)
+
+    key = Column(Text, unique=True)                 # '<ecosystem>:<path>'
+    status = Column(Integer)                        # 200, or 404 when it's cached as missing
+    etag = Column(Text)
+    last_modified = Column(Text)
+    encoding = Column(Text)
+    checked = Column(DateTime)                      # the last time upstream was asked
@@ -0,0 +1,87 @@
+import os
+
+from urllib.parse import quote
+
+from reliquary.cache import cache_location
+
+
+class NginxOffload(object):
+    """Sends files with an X-Accel-Redirect to an internal location of nginx.
+
+    Files under reliquary.location and the cache location are redirected to
+    the reliquary.xsendfile_nginx_location and
+    reliquary.xsendfile_nginx_cache_location prefixes. Both are required,
+    except for the cache location prefix when the cache is kept inside of
+    reliquary.location."""
+
+    def __init__(self, settings):
+        self.locations = []
+        relics = os.path.abspath(settings.get('reliquary.location', ''))
+        cache = os.path.abspath(cache_location(settings))
+        for root, setting in ((relics, 'reliquary.xsendfile_nginx_location'),
+                              (cache, 'reliquary.xsendfile_nginx_cache_location')):
+            prefix = settings.get(setting, None)
+            if prefix:
+                self.locations.append((root, '/' + prefix.strip('/') + '/'))
+            elif root == relics or not root.startswith(relics + os.sep):
+                raise ValueError('{} is required to offload to nginx'.format(setting))
+        # the cache location defaults to a folder in reliquary.location, so
+        # the most specific location has to be matched first
+        self.locations.sort(key=lambda location: len(location[0]), reverse=True)
+        self.buffering = settings.get('reliquary.xsendfile_nginx_buffering', None)
+        self.limit_rate = settings.get('reliquary.xsendfile_nginx_limit_rate', None)
+
+    def uri(self, path):
+        path = os.path.abspath(path)
+        for root, prefix in self.locations:
+            if path.startswith(root + os.sep):
+                return prefix + quote(os.path.relpath(path, root).replace(os.sep, '/'))
+        raise ValueError('"{}" is outside of the nginx locations'.format(path))
+
+    def headers(self, path):
+        headers = dict()
+        headers['X-Accel-Redirect'] = self.uri(path)
+        if self.buffering:
+            headers['X-Accel-Buffering'] = self.buffering
+        if self.limit_rate:
+            headers['X-Accel-Limit-Rate'] = self.limit_rate
+        return headers
+
+
+class SendfileOffload(object):
+    """Sends files with an X-Sendfile of their absolute path (Apache with
+    mod_xsendfile, lighttpd)."""
+
+    def __init__(self, settings):
+        pass
+
+    def headers(self, path):
+        return {'X-Sendfile': os.path.abspath(path)}
+
+
+# offload backends by reliquary.xsendfile_frontend
+OFFLOAD_BACKENDS = {
+    'nginx': NginxOffload,
+    'apache': SendfileOffload,
+    'lighttpd': SendfileOffload,
+}
+
+
+# the backend files are offloaded to the web server in front of the app with,
+# or None if reliquary.xsendfile_enabled is off and the app sends them itself
+def offload_backend(registry):
+    backend = getattr(registry, 'reliquary_offload', False)
+    if backend is not False:
+        return backend
+
+    settings = registry.settings or {}
+    backend = None
+    if settings.get('reliquary.xsendfile_enabled', None) == 'true':
+        frontend = settings.get('reliquary.xsendfile_frontend', 'nginx') \
+                           .strip().lower()
+        if frontend not in OFFLOAD_BACKENDS:
+            raise ValueError('unknown reliquary.xsendfile_frontend "{}" (one of '
+                             '{})'.format(frontend, ', '.join(sorted(OFFLOAD_BACKENDS))))
+        backend = OFFLOAD_BACKENDS[frontend](settings)
+    registry.reliquary_offload = backend
+    return backend
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+import transaction
+
+from pyramid.threadlocal import manager
+
+from reliquary.models import DBSession
+from reliquary.utils import enqueue_debian_settings_rebuild, process_debian_rebuild_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+# regenerates the queued debian indices (see
+# reliquary.utils.enqueue_debian_rebuild) in the background of the web app
+class RebuildWorker(threading.Thread):
+    def __init__(self, registry, interval=1.0, debounce=5.0, max_delay=60.0):
+        super().__init__(name='reliquary-rebuild', daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+    def run(self):
+        # so the settings are available to what's regenerated
+        manager.push({'registry': self.registry, 'request': None})
+        try:
+            if enqueue_debian_settings_rebuild():
+                logger.info('debian settings changed, regenerating every debian index')
+        except Exception:
+            logger.exception('failed to check the debian settings')
+        finally:
+            transaction.abort()
+            DBSession.remove()
+        while True:
+            time.sleep(self.interval)
+            try:
+                rebuilt = process_debian_rebuild_queue(self.debounce, self.max_delay)
+                if rebuilt:
+                    logger.info('regenerated {} debian indices'.format(rebuilt))
+            except Exception:
+                logger.exception('failed to process the rebuild queue')
+            finally:
+                transaction.abort()
+                DBSession.remove()
+
+
+# starts the rebuild worker for the app, unless reliquary.rebuild_worker is
+# false (when another process takes care of the queue)
+def start_rebuild_worker(registry):
+    settings = registry.settings
+    if settings.get('reliquary.rebuild_worker', 'true') == 'false':
+        return None
+    worker = RebuildWorker(
+        registry,
+        interval=float(settings.get('reliquary.rebuild_interval', 1.0)),
+        debounce=float(settings.get('reliquary.rebuild_debounce', 5.0)),
+        max_delay=float(settings.get('reliquary.rebuild_max_delay', 60.0)))
+    worker.start()
+    return worker
+
+
+_start_lock = threading.Lock()
+
+
+# NewRequest subscriber starting the rebuild worker with the first request the
+# app serves. scripts bootstrapping the app (reindex, reliquary-watch, ...)
+# never serve one, so they don't get a worker racing their own processing of
+# the queue (or forked along with their process pools).
+def start_rebuild_worker_on_request(event):
+    registry = event.request.registry
+    if getattr(registry, 'reliquary_rebuild_worker', False) is not False:
+        return
+    with _start_lock:
+        if getattr(registry, 'reliquary_rebuild_worker', False) is False:
+            registry.reliquary_rebuild_worker = start_rebuild_worker(registry)
@@ -1,2 +1,5 @@
 from .reindex import reindex
 from .init_reliquary import init_reliquary
+from .watch import watch
+from .benchmark import benchmark
+from .blobs import blobs
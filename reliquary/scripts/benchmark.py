@@ -0,0 +1,133 @@
+import http.client
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+from pyramid.response import Response
+from waitress.server import create_server
+from webob import Request
+
+from reliquary.utils import DOWNLOAD_BLOCKSIZE, file_range_response
+
+
+# how a file can be sent by the app: as download_response used to (a plain
+# file object as the body), through the app's own iterator, and through the
+# server's wsgi.file_wrapper
+MODES = ('body_file', 'iter', 'file_wrapper')
+
+
+def make_app(path, mode, blocksize):
+    size = os.path.getsize(path)
+
+    def app(environ, start_response):
+        if mode != 'file_wrapper':
+            environ.pop('wsgi.file_wrapper', None)
+        req = Request(environ)
+        fin = open(path, 'rb')
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Content-Length': str(size)}
+        if mode == 'body_file':
+            resp = Response(body_file=fin, headers=headers)
+        else:
+            resp = file_range_response(req, fin, size, headers, blocksize=blocksize)
+        return resp(environ, start_response)
+
+    return app
+
+
+# downloads the file 'requests' times, in its own process so only the server
+# is measured in this one
+def download(port, requests):
+    for _ in range(requests):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        while resp.read(1024 * 1024):
+            pass
+        conn.close()
+
+
+# serves 'path' with waitress for 'requests' downloads, returns the seconds
+# it took and the cpu seconds the server used
+def run(path, mode, blocksize, requests):
+    server = create_server(make_app(path, mode, blocksize),
+                           host='127.0.0.1', port=0, threads=4)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        client = multiprocessing.Process(target=download,
+                                         args=(server.effective_port, requests))
+        started, cpu_started = time.monotonic(), time.process_time()
+        client.start()
+        client.join()
+        return time.monotonic() - started, time.process_time() - cpu_started
+    finally:
+        server.task_dispatcher.shutdown()
+        server.close()
+
+
+def benchmark():
+    description = """\
+    Measure the throughput, and the cpu used per GB served, of the ways relics
+    can be sent by the app (when they aren't offloaded to the web server).
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+        )
+    parser.add_option(
+        '--file',
+        dest='file',
+        default=None,
+        help='file to serve (default: a temporary file of --size MB)')
+    parser.add_option(
+        '--size',
+        dest='size',
+        type='int',
+        default=256,
+        help='MB of the temporary file to serve (default: 256)')
+    parser.add_option(
+        '--requests',
+        dest='requests',
+        type='int',
+        default=4,
+        help='how many times the file is downloaded per mode (default: 4)')
+    parser.add_option(
+        '--blocksize',
+        dest='blocksize',
+        type='int',
+        default=DOWNLOAD_BLOCKSIZE,
+        help='bytes read at a time (default: {})'.format(DOWNLOAD_BLOCKSIZE))
+    parser.add_option(
+        '--mode',
+        dest='modes',
+        action='append',
+        choices=MODES,
+        help='only measure this mode (can be given several times; one of '
+             '{})'.format(', '.join(MODES)))
+
+    options, args = parser.parse_args(sys.argv[1:])
+
+    path = options.file
+    if not path:
+        fd, path = tempfile.mkstemp(prefix='reliquary-benchmark-')
+        with os.fdopen(fd, 'wb') as fout:
+            block = os.urandom(1024 * 1024)
+            for _ in range(options.size):
+                fout.write(block)
+    try:
+        gigabytes = os.path.getsize(path) * options.requests / float(1024 ** 3)
+        print('{:<14}{:>12}{:>14}'.format('mode', 'MB/s', 'cpu s/GB'))
+        for mode in options.modes or MODES:
+            elapsed, cpu = run(path, mode, options.blocksize, options.requests)
+            print('{:<14}{:>12.1f}{:>14.3f}'.format(
+                mode, gigabytes * 1024 / elapsed, cpu / gigabytes))
+    finally:
+        if not options.file:
+            os.remove(path)
@@ -0,0 +1,99 @@
+import logging
+import optparse
+import os
+import sys
+import textwrap
+import transaction
+
+from pyramid.paster import bootstrap, setup_logging
+from zope.sqlalchemy import mark_changed
+
+from reliquary.blobs import blob_location, collect_blobs, store_blob
+from reliquary.models import Channel, DBSession, Index, Relic
+from reliquary.scripts.reindex import chunked
+from reliquary.utils import file_digests
+
+
+logger = logging.getLogger(__name__)
+
+
+# stores the relics already in the reliquary in the blob store, hashing the
+# ones no sha256 is indexed for. relics that changed since they were indexed
+# are skipped (they need to be reindexed first).
+def dedupe_relics(reliquary, settings):
+    stats = dict(relics=0, deduplicated=0, hashed=0, skipped=0)
+    relics = DBSession.query(Relic.uid,
+                             Relic.name,
+                             Relic.mtime,
+                             Relic.size,
+                             Relic.sha256,
+                             Channel.name,
+                             Index.name) \
+                      .join(Index, Index.uid == Relic.index_id) \
+                      .join(Channel, Channel.uid == Index.channel_id) \
+                      .all()
+    updates = []
+    for (uid, name, mtime, size, sha256, channel, index) in relics:
+        path = os.path.join(reliquary, channel, index, name)
+        try:
+            relic_stat = os.stat(path)
+        except FileNotFoundError:
+            stats['skipped'] += 1
+            continue
+        if mtime != str(relic_stat.st_mtime) or size != relic_stat.st_size:
+            stats['skipped'] += 1
+            continue
+        stats['relics'] += 1
+
+        if not sha256:
+            sha256 = file_digests(path)['sha256']
+            stats['hashed'] += 1
+        if store_blob(path, sha256, settings):
+            stats['deduplicated'] += 1
+            # a hardlink has the mtime of the blob
+            relic_stat = os.stat(path)
+        updates.append(dict(uid=uid, sha256=sha256, mtime=str(relic_stat.st_mtime)))
+
+    for chunk in chunked(updates):
+        with transaction.manager:
+            DBSession.bulk_update_mappings(Relic, chunk)
+            mark_changed(DBSession())
+    return stats
+
+
+def blobs():
+    description = """\
+    Garbage collect the blob store, removing the blobs no relic links to
+    anymore. With --dedupe, the relics already in the reliquary are stored in
+    the blob store first, replacing copies of the same relic with hardlinks.
+    """
+    usage = "usage: %prog config_uri"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+        )
+    parser.add_option(
+        '--dedupe',
+        dest='dedupe',
+        action='store_true',
+        default=False,
+        help='store (and deduplicate) the relics already in the reliquary')
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if not len(args) > 0:
+        logger.error('at least the config uri is needed')
+        return 2
+    config_uri = args[0]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    settings, closer = env['registry'].settings, env['closer']
+    try:
+        logger.info('blob store is {}'.format(blob_location(settings)))
+        if options.dedupe:
+            stats = dedupe_relics(settings.get('reliquary.location', None), settings)
+            logger.info('stored {relics} relics: {deduplicated} deduplicated, '
+                        '{hashed} hashed, {skipped} skipped'.format(**stats))
+        removed, freed = collect_blobs(settings)
+        logger.info('removed {} unused blobs ({} bytes)'.format(removed, freed))
+    finally:
+        closer()
@@ -1,4 +1,5 @@
-import hashlib
+import concurrent.futures
+import json
 import optparse
 import os
 import sys
@@ -6,9 +7,9 @@ import textwrap
 import transaction
 import logging
 
-from debian import arfile, debfile
-from pyramid.paster import bootstrap
-from sqlalchemy.orm.exc import MultipleResultsFound
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy import and_
+from zope.sqlalchemy import mark_changed
 
 from reliquary.models import (
     Channel,
@@ -18,159 +19,373 @@ from reliquary.models import (
     Relic,
 )
 from reliquary.utils import (
-    generate_debian_package_index,
-    get_debian_release_data,
-    get_unique_architectures_set,
+    enqueue_debian_rebuild,
+    enqueue_debian_settings_rebuild,
+    process_debian_rebuild_queue,
+    read_deb_info,
+    relic_name_columns,
 )
 
 
 logger = logging.getLogger(__name__)
 
 
-def pregenerate_deb_indices():
-    # channel + index containing relics with cached deb info
-    indices = DBSession.query(Channel.name, Channel.uid, Index.name, Index.uid) \
+# regenerates the cached debian indices of every channel/index containing
+# relics with deb info, or only of the given index uids, along with anything
+# else already queued for regeneration (including every index, when the
+# debian settings changed)
+def pregenerate_deb_indices(index_ids=None):
+    # every index, if the settings they were generated with changed
+    enqueue_debian_settings_rebuild()
+
+    indices = DBSession.query(Channel.name, Index.name, Index.uid) \
                        .filter(Index.channel_id == Channel.uid) \
                        .filter(Relic.index_id == Index.uid) \
                        .filter(DebInfo.relic_id == Relic.uid) \
                        .distinct()
+    if index_ids is None or index_ids:
+        if index_ids is not None:
+            indices = indices.filter(Index.uid.in_(list(index_ids)))
+        for (channel, index, indexid) in indices:
+            enqueue_debian_rebuild(indexid, 'all')
+    process_debian_rebuild_queue()
 
-    for (channel, chanid, index, indexid) in indices:
-        arches = get_unique_architectures_set(indexid)
-        for arch in arches:
-            if not generate_debian_package_index(channel, index, arch, force=True):
-                logger.error("Failed to generate package for debian/{}/dist/{}/main/binary-{}".format(channel, index, arch))
-            if not generate_debian_package_index(channel, index, arch, compression='gz', force=True):
-                logger.error("Failed to generate package.gz for debian/{}/dist/{}/main/binary-{}".format(channel, index, arch))
-            if not generate_debian_package_index(channel, index, arch, compression='bz2', force=True):
-                logger.error("Failed to generate package.bz2 for debian/{}/dist/{}/main/binary-{}".format(channel, index, arch))
-
-        get_debian_release_data(indexid, force=True)
-
-
-def index_deb_info(name, path, obj, indexname):
-    # relative to the repository root, which would be something
-    # like /api/v1/{channel}/
-    filename = "pool/{}/{}".format(indexname, name)
-
-    # md5, sha1, and sha256 of file
-    blocksize = 65536
-    md5sum_hasher = hashlib.md5()
-    sha1_hasher = hashlib.sha1()
-    sha256_hasher = hashlib.sha256()
-    sha512_hasher = hashlib.sha512()
-    with open(path, 'rb') as fin:
-        buf = fin.read(blocksize)
-        while len(buf) > 0:
-            md5sum_hasher.update(buf)
-            sha1_hasher.update(buf)
-            sha256_hasher.update(buf)
-            sha512_hasher.update(buf)
-            buf = fin.read(blocksize)
-    md5sum = md5sum_hasher.hexdigest()
-    sha1 = sha1_hasher.hexdigest()
-    sha256 = sha256_hasher.hexdigest()
-    sha512 = sha512_hasher.hexdigest()
-
-    # the rest is ripped out of the .deb file or generated based
-    # on the information there.
-    deb = debfile.DebFile(path)
-    control = deb.control.debcontrol()
-
-    # deb control is dict-like object where key lookups are case-insensitive
-    multi_arch = control.get("multi-arch", None)
-    package = control.get("package", None)
-    source = control.get("source", None)
-    version = control.get("version", None)
-    section = control.get("section", None)
-    priority = control.get("priority", None)
-    architecture = control.get("architecture", None)
-    essential = control.get("essential", None)
-    depends = control.get("depends", None)
-    recommends = control.get("recommends", None)
-    suggests = control.get("suggests", None)
-    enhances = control.get("enhances", None)
-    pre_depends = control.get("pre-depends", None)
-    installed_size = control.get("installed-size", None)
-    maintainer = control.get("maintainer", None)
-    description = control.get("description", None)
-    description_md5 = control.get("description-md5", None)
-    homepage = control.get("homepage", None)
-    built_using = control.get("built_using", None)
-
-    # if the description-md5 wasn't specified, comput it!
-    # the computed value starts at the second character after the colon in the
-    # control file (basically, allowing the 'Header: ' format of the text file)
-    # and includes a trailing newline character. The value must be lowercase
-    # hex md5.
-    if not description_md5:
-        if description[-1] == "\n":
-            description_md5 = hashlib.md5(description.encode()).hexdigest()
-        else:
-            description_md5 = hashlib.md5((description+"\n").encode()).hexdigest()
 
-    # missing required fields are a deal breaker for including this package
-    # in the index
-    msg = name+" skipped for deb info: '{}' not found in control"
-    if not package:
-        logger.error(msg.format('Package'))
-        return
-    if not version:
-        logger.error(msg.format('Version'))
-        return
-    if not architecture:
-        logger.error(msg.format('Architecture'))
+# runs in a worker process when reindexing with more than one worker, so it
+# only returns plain values -- all the database work happens in the parent
+def extract_deb_info(job):
+    relic_id, name, path, indexname = job
+    try:
+        return relic_id, read_deb_info(name, path, indexname)
+    except Exception as ex:
+        logger.error("failed to extract deb info from {}: {}".format(path, ex))
+        return relic_id, None
+
+
+# keeps 'IN' clauses under sqlite's limit on bound parameters
+def chunked(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+# extracts deb info for each (relic_id, name, path, indexname) job of an
+# index, either in the given process pool or inline if there isn't one, and
+# saves the results in bulk
+def index_deb_infos(jobs, index_id, pool=None):
+    if not jobs:
         return
-    if not maintainer:
-        logger.error(msg.format('Maintainer'))
+    if pool:
+        results = pool.map(extract_deb_info, jobs, chunksize=4)
+    else:
+        results = map(extract_deb_info, jobs)
+    infos = dict((relic_id, info) for relic_id, info in results if info)
+    if not infos:
         return
-    if not description:
-        logger.error(msg.format('Description'))
+
+    existing = dict()
+    for chunk in chunked(infos.keys()):
+        rows = DBSession.query(DebInfo.relic_id, DebInfo.uid) \
+                        .filter(DebInfo.relic_id.in_(chunk))
+        existing.update(rows)
+
+    inserts = []
+    updates = []
+    for relic_id, info in infos.items():
+        mapping = dict(info, index_id=index_id)
+        if relic_id in existing:
+            mapping['uid'] = existing[relic_id]
+            updates.append(mapping)
+        else:
+            mapping['relic_id'] = relic_id
+            inserts.append(mapping)
+
+    with transaction.manager:
+        if inserts:
+            DBSession.bulk_insert_mappings(DebInfo, inserts)
+        if updates:
+            DBSession.bulk_update_mappings(DebInfo, updates)
+        # bulk operations aren't tracked by the session, so the transaction
+        # needs to be told there's something to commit
+        mark_changed(DBSession())
+    logger.info("Indexed deb info for {} relics".format(len(infos)))
+
+
+# the stored mtime/size (and whether deb info was extracted) of each relic in
+# an index, keyed by relic name. the uids of any extra rows for the same relic
+# name are returned separately, so they can be cleaned up.
+def fetch_relic_manifest(index_id):
+    manifest = dict()
+    duplicates = []
+    relics = DBSession.query(Relic.uid,
+                             Relic.name,
+                             Relic.mtime,
+                             Relic.size,
+                             Relic.normalized_name,
+                             DebInfo.arch,
+                             and_(DebInfo.stanza.isnot(None),
+                                  DebInfo.stanza_short.isnot(None))) \
+                      .outerjoin(DebInfo, DebInfo.relic_id == Relic.uid) \
+                      .filter(Relic.index_id == index_id)
+    for (uid, name, mtime, size, normalized_name, debinfo_arch, has_stanza) in relics:
+        if name in manifest:
+            logger.error('relic "{}" is indexed more than once'.format(name))
+            duplicates.append(uid)
+            continue
+        manifest[name] = dict(uid=uid,
+                              mtime=mtime,
+                              size=size,
+                              has_name_columns=normalized_name is not None,
+                              # deb info from before the arch was normalized,
+                              # or the stanzas were rendered, counts as missing
+                              has_debinfo=debinfo_arch is not None
+                              and bool(has_stanza))
+    return manifest, duplicates
+
+
+def relic_unchanged(known, mtime, size, is_deb):
+    if known['mtime'] != mtime or known['size'] != size:
+        return False
+    # indexed before the parsed name columns existed
+    if not known['has_name_columns']:
+        return False
+    # a .deb without deb info needs another attempt at extracting it
+    if is_deb and not known['has_debinfo']:
+        return False
+    return True
+
+
+# name -> (mtime, size, path) of every relic in an index folder
+def scan_index(index_path):
+    listing = dict()
+    for entry in os.scandir(index_path):
+        # uploads in progress are written to hidden temp files
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        relic_stat = entry.stat()
+        listing[entry.name] = (str(relic_stat.st_mtime),
+                               relic_stat.st_size,
+                               entry.path)
+    return listing
+
+
+# expected to be called inside of a transaction
+def delete_relics(uids):
+    for chunk in chunked(uids):
+        DBSession.query(DebInfo) \
+                 .filter(DebInfo.relic_id.in_(chunk)) \
+                 .delete(synchronize_session=False)
+        DBSession.query(Relic) \
+                 .filter(Relic.uid.in_(chunk)) \
+                 .delete(synchronize_session=False)
+
+
+# expected to be called inside of a transaction -- returns how many relics
+# were deleted along with the indices
+def delete_indices(uids):
+    relic_uids = []
+    for chunk in chunked(uids):
+        relic_uids.extend(uid for (uid,) in DBSession.query(Relic.uid)
+                                                     .filter(Relic.index_id.in_(chunk)))
+    delete_relics(relic_uids)
+    for chunk in chunked(uids):
+        DBSession.query(Index) \
+                 .filter(Index.uid.in_(chunk)) \
+                 .delete(synchronize_session=False)
+    return len(relic_uids)
+
+
+# brings the relics of an index in line with a listing of its folder (see
+# scan_index) using a handful of bulk statements. returns the deb info
+# extraction jobs for new or changed .deb relics, and whether anything in the
+# index changed.
+def reconcile_index(index_dbobj, indexname, listing, stats, incremental=False):
+    manifest, duplicates = fetch_relic_manifest(index_dbobj.uid)
+
+    inserts = []
+    updates = []
+    deb_relics = dict()
+    for name, (mtime, size, path) in listing.items():
+        is_deb = name[-4:] == ".deb"
+        known = manifest.get(name, None)
+        if known and incremental and relic_unchanged(known, mtime, size, is_deb):
+            stats['skipped'] += 1
+            continue
+
+        columns = relic_name_columns(name)
+        columns.update(dirty=False, mtime=mtime, size=size)
+        if known:
+            columns['uid'] = known['uid']
+            # the stored sha256 is of what was there before
+            if known['mtime'] != mtime or known['size'] != size:
+                columns['sha256'] = None
+            updates.append(columns)
+            stats['updated'] += 1
+        else:
+            columns.update(index_id=index_dbobj.uid, name=name)
+            inserts.append(columns)
+            stats['added'] += 1
+
+        # if the relic is a debian archive, there's additional info that
+        # should be pulled out to make generating a deb repo more efficient
+        if is_deb:
+            deb_relics[name] = known['uid'] if known else None
+
+    deletes = [known['uid'] for name, known in manifest.items()
+               if name not in listing]
+
+    with transaction.manager:
+        if inserts:
+            DBSession.bulk_insert_mappings(Relic, inserts)
+        if updates:
+            DBSession.bulk_update_mappings(Relic, updates)
+        delete_relics(deletes + duplicates)
+        mark_changed(DBSession())
+    stats['deleted'] += len(deletes)
+
+    # new relics only have a uid now that they've been inserted
+    new_debs = [name for name, uid in deb_relics.items() if uid is None]
+    for chunk in chunked(new_debs):
+        rows = DBSession.query(Relic.name, Relic.uid) \
+                        .filter(Relic.index_id == index_dbobj.uid) \
+                        .filter(Relic.name.in_(chunk))
+        deb_relics.update(rows)
+
+    deb_jobs = [(uid, name, listing[name][2], indexname)
+                for name, uid in deb_relics.items()]
+    changed = bool(inserts or updates or deletes or duplicates)
+    return deb_jobs, changed
+
+
+# (name, path) of the directories in 'path', or just of 'only' if given
+def list_dirs(path, only=None):
+    if only:
+        only_path = os.path.join(path, only)
+        return [(only, only_path)] if os.path.isdir(only_path) else []
+    # hidden folders aren't channels/indices (the cache defaults to one)
+    return [(entry.name, entry.path) for entry in os.scandir(path)
+            if entry.is_dir() and not entry.name.startswith('.')]
+
+
+# the indices a previous, interrupted, reindex already finished -- returns a
+# dict of (channel, index) -> whether that index changed
+def load_checkpoint(checkpoint):
+    done = dict()
+    if not checkpoint or not os.path.exists(checkpoint):
+        return done
+    with open(checkpoint) as fin:
+        for line in fin:
+            try:
+                item = json.loads(line)
+                done[(item['channel'], item['index'])] = item['changed']
+            except (ValueError, KeyError):
+                # most likely a line that was cut off by the interruption
+                continue
+    if done:
+        logger.info('resuming reindex, {} indices already done'.format(len(done)))
+    return done
+
+
+def save_checkpoint(checkpoint, channel, index, changed):
+    if not checkpoint:
         return
+    with open(checkpoint, 'a') as fout:
+        fout.write(json.dumps(dict(channel=channel, index=index, changed=changed)) + "\n")
+        fout.flush()
+        os.fsync(fout.fileno())
 
-    kwargs = dict(
-        filename=filename,
-        md5sum=md5sum,
-        sha1=sha1,
-        sha256=sha256,
-        sha512=sha512,
-        multi_arch=multi_arch,
-        package=package,
-        source=source,
-        version=version,
-        section=section,
-        priority=priority,
-        architecture=architecture,
-        essential=essential,
-        depends=depends,
-        recommends=recommends,
-        suggests=suggests,
-        enhances=enhances,
-        pre_depends=pre_depends,
-        installed_size=installed_size,
-        maintainer=maintainer,
-        description=description,
-        description_md5=description_md5,
-        homepage=homepage,
-        built_using=built_using)
 
-    try:
-        debinfo_dbobj = DBSession.query(DebInfo) \
-                                 .filter_by(relic_id=obj.uid) \
-                                 .one_or_none()
-        with transaction.manager:
-            if debinfo_dbobj:
-                logger.info("Adding deb info for " + name)
-                DBSession.query(DebInfo) \
-                         .filter_by(uid=debinfo_dbobj.uid) \
-                         .update(kwargs)
-            else:
-                logger.info("Updating deb info for " + name)
-                kwargs['relic_id'] = obj.uid
-                DBSession.add(DebInfo(**kwargs))
-    except MultipleResultsFound:
-        logger.error("Apparently there's more than one debinfo object"
-                     "associated with '"+obj.name+"'")
+# walks the reliquary (or just one channel, or one channel/index), bringing
+# the database in line with what's on disk. returns a dict of
+# added/updated/skipped/deleted counts, and the uids of the indices where
+# something changed. if a checkpoint file is given, each finished index is
+# recorded in it, and indices already recorded there are skipped.
+def reindex_reliquary(reliquary, incremental=False, pool=None,
+                      channel=None, index=None, checkpoint=None):
+    # tallies for the summary at the end of the reindex
+    stats = dict(skipped=0, added=0, updated=0, deleted=0)
+    touched = set()
+    done = load_checkpoint(checkpoint)
+
+    # everything that's already indexed (within the scope of the reindex),
+    # so anything not found on disk can be removed at the end
+    channelq = DBSession.query(Channel)
+    if channel:
+        channelq = channelq.filter_by(name=channel)
+    channels = dict((c.name, c) for c in channelq)
+    indexq = DBSession.query(Index)
+    if channel:
+        indexq = indexq.join(Channel, Channel.uid == Index.channel_id) \
+                       .filter(Channel.name == channel)
+    if index:
+        indexq = indexq.filter(Index.name == index)
+    indices = dict(((i.channel_id, i.name), i) for i in indexq)
+    seen_channels = set()
+    seen_indices = set()
+
+    # now, walk through the reliquary and index relics
+    # ### CHANNEL
+    for channel_name, channel_path in list_dirs(reliquary, channel):
+        # make sure the db object exists
+        channel_dbobj = channels.get(channel_name, None)
+        if not channel_dbobj:
+            channel_dbobj = Channel(dirty=False, name=channel_name)
+            with transaction.manager:
+                DBSession.add(channel_dbobj)
+                DBSession.flush()
+        seen_channels.add(channel_dbobj.uid)
+
+        # ### INDEX
+        for index_name, index_path in list_dirs(channel_path, index):
+            # make sure the db object exists
+            index_dbobj = indices.get((channel_dbobj.uid, index_name), None)
+            if not index_dbobj:
+                index_dbobj = Index(dirty=False,
+                                    name=index_name,
+                                    channel_id=channel_dbobj.uid)
+                with transaction.manager:
+                    DBSession.add(index_dbobj)
+                    DBSession.flush()
+            seen_indices.add(index_dbobj.uid)
+
+            # finished before the last reindex was interrupted
+            if (channel_name, index_name) in done:
+                if done[(channel_name, index_name)]:
+                    touched.add(index_dbobj.uid)
+                continue
+
+            # ### RELIC
+            listing = scan_index(index_path)
+            deb_jobs, changed = reconcile_index(index_dbobj,
+                                                index_name,
+                                                listing,
+                                                stats,
+                                                incremental=incremental)
+            index_deb_infos(deb_jobs, index_dbobj.uid, pool=pool)
+            if changed:
+                touched.add(index_dbobj.uid)
+            save_checkpoint(checkpoint, channel_name, index_name, changed)
+
+    # delete everything that no longer exists on disk
+    stale_indices = [i.uid for i in indices.values()
+                     if i.uid not in seen_indices]
+    stale_channels = [c.uid for c in channels.values()
+                      if c.uid not in seen_channels]
+    # a channel that's gone takes all of its indices with it, including the
+    # ones outside of an --index scope
+    for chunk in chunked(stale_channels):
+        stale_indices.extend(uid for (uid,) in DBSession.query(Index.uid)
+                                                        .filter(Index.channel_id.in_(chunk))
+                             if uid not in stale_indices)
+    with transaction.manager:
+        stats['deleted'] += delete_indices(stale_indices)
+        for chunk in chunked(stale_channels):
+            DBSession.query(Channel) \
+                     .filter(Channel.uid.in_(chunk)) \
+                     .delete(synchronize_session=False)
+
+    touched.update(stale_indices)
+    return stats, touched
 
 
 def reindex():
@@ -182,117 +397,75 @@ def reindex():
         usage=usage,
         description=textwrap.dedent(description)
         )
+    parser.add_option(
+        '-i', '--incremental',
+        dest='incremental',
+        action='store_true',
+        default=False,
+        help='only rehash and reparse relics whose mtime or size differ from '
+             'what is already indexed')
+    parser.add_option(
+        '-w', '--workers',
+        dest='workers',
+        type='int',
+        default=1,
+        help='number of processes used to extract deb info (default: 1, '
+             'which extracts it inline)')
+    parser.add_option(
+        '--channel',
+        dest='channel',
+        default=None,
+        help='only reindex this channel')
+    parser.add_option(
+        '--index',
+        dest='index',
+        default=None,
+        help='only reindex this index of the channel given with --channel')
+    parser.add_option(
+        '--checkpoint',
+        dest='checkpoint',
+        default=None,
+        help='file to record finished indices in, so an interrupted reindex '
+             'can be resumed by running it again with the same file')
 
     options, args = parser.parse_args(sys.argv[1:])
     if not len(args) > 0:
         logger.error('at least the config uri is needed')
         return 2
+    if options.index and not options.channel:
+        logger.error('--index needs the --channel it belongs to')
+        return 2
     config_uri = args[0]
+    setup_logging(config_uri)
     env = bootstrap(config_uri)
     settings, closer = env['registry'].settings, env['closer']
+    pool = None
+    if options.workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=options.workers)
     try:
-        # mark everything as dirty so we can delete anything that
-        # is not clean by the end of the reindex
-        with transaction.manager:
-            DBSession.query(Channel).update({'dirty': True})
-            DBSession.query(Index).update({'dirty': True})
-            DBSession.query(Relic).update({'dirty': True})
-
-        # now, walk through the reliquary and index relics
         reliquary = settings.get('reliquary.location', None)
-        # ### CHANNEL
-        for channel in os.listdir(reliquary):
-            # make sure the directory exists
-            channel_path = os.path.join(reliquary, channel)
-            if not os.path.isdir(channel_path):
-                continue
-            # make sure the db object exists
-            channel_dbobj = DBSession.query(Channel) \
-                                     .filter_by(name=channel) \
-                                     .first()
-            if not channel_dbobj:
-                channel_dbobj = Channel(dirty=False, name=channel)
-                with transaction.manager:
-                    DBSession.add(channel_dbobj)
-            else:
-                # channel is has real path and db entry, so should not be dirty
-                with transaction.manager:
-                    DBSession.query(Channel) \
-                             .filter_by(uid=channel_dbobj.uid) \
-                             .update({'dirty': False})
-
-            # ### INDEX
-            for index in os.listdir(channel_path):
-                # make sure the directory exists
-                index_path = os.path.join(channel_path, index)
-                if not os.path.isdir(index_path):
-                    continue
-                # make sure the db object exists
-                index_dbobj = DBSession.query(Index) \
-                                       .filter_by(channel_id=channel_dbobj.uid, name=index) \
-                                       .first()
-                if not index_dbobj:
-                    index_dbobj = Index(dirty=False,
-                                        name=index,
-                                        channel_id=channel_dbobj.uid)
-                    with transaction.manager:
-                        DBSession.add(index_dbobj)
-                else:
-                    # index has real path and db entry, so should not be dirty
-                    with transaction.manager:
-                        DBSession.query(Index).filter_by(uid=index_dbobj.uid) \
-                                 .update({'dirty': False})
-
-                # ### RELIC
-                for relic in os.listdir(index_path):
-                    relic_path = os.path.join(index_path, relic)
-                    try:
-                        relic_dbobj = DBSession.query(Relic) \
-                                               .filter_by(index_id=index_dbobj.uid, name=relic) \
-                                               .one_or_none()
-                        relic_mtime = str(os.path.getmtime(relic_path))
-                        relic_size = os.path.getsize(relic_path)
-                        if relic_dbobj:
-                            with transaction.manager:
-                                DBSession.query(Relic) \
-                                         .filter_by(uid=relic_dbobj.uid) \
-                                         .update({'dirty': False,
-                                                  'mtime': relic_mtime,
-                                                  'size': relic_size})
-                        else:
-                            relic_dbobj = Relic(dirty=False,
-                                                index_id=index_dbobj.uid,
-                                                name=relic,
-                                                mtime=relic_mtime,
-                                                size=relic_size)
-                            with transaction.manager:
-                                DBSession.add(relic_dbobj)
-
-                        # if the relic is a debian archive, there's additional
-                        # info that should be pulled out to make generating
-                        # a deb repo more efficient
-                        if relic[-4:] == ".deb":
-                            index_deb_info(relic, relic_path, relic_dbobj, index)
-                    except MultipleResultsFound:
-                        logger.error('index [{}/{}/{}] contains non-unique '
-                                     '/channel/index/relic_name'
-                                     .format(channel, index, relic))
-
-        # delete all relics, still dirty, from the index
-        with transaction.manager:
-            DBSession.query(Channel) \
-                     .filter_by(dirty=True) \
-                     .delete()
-            DBSession.query(Index) \
-                     .filter_by(dirty=True) \
-                     .delete()
-            DBSession.query(Relic) \
-                     .filter_by(dirty=True) \
-                     .delete(synchronize_session=False)
+        stats, touched = reindex_reliquary(reliquary,
+                                           incremental=options.incremental,
+                                           pool=pool,
+                                           channel=options.channel,
+                                           index=options.index,
+                                           checkpoint=options.checkpoint)
+
+        logger.info('reindex: {added} added, {updated} updated, '
+                    '{skipped} skipped (unchanged), {deleted} deleted'
+                    .format(**stats))
+
+        # only the indices that changed need their caches regenerated, which
+        # for a full reindex is every index with relics in it
+        pregenerate_deb_indices(touched)
 
-        pregenerate_deb_indices()
+        # finished, so there's nothing to resume
+        if options.checkpoint and os.path.exists(options.checkpoint):
+            os.remove(options.checkpoint)
     except Exception as ex:
         logger.critical("something went wrong")
         logger.critical(ex)
     finally:
+        if pool:
+            pool.shutdown()
         closer()
@@ -0,0 +1,330 @@
+import logging
+import optparse
+import os
+import sys
+import textwrap
+import time
+import transaction
+
+from pyramid.paster import bootstrap, setup_logging
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from reliquary.models import Channel, DBSession, Index
+from reliquary.scripts.reindex import (
+    delete_indices,
+    pregenerate_deb_indices,
+    reindex_reliquary,
+    scan_index,
+)
+from reliquary.utils import (
+    enqueue_debian_rebuild,
+    index_relic,
+    process_debian_rebuild_queue,
+    relic_debian_architecture,
+    relic_stat_matches,
+    unindex_relic,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# the reliquary is laid out as <reliquary>/<channel>/<index>/<relic>, so
+# directories are watched down to the index level, and anything found at the
+# relic level is a relic
+RELIC_DEPTH = 2
+
+
+class InotifyWatcher(object):
+    """Reports paths that changed under the reliquary, using inotify."""
+
+    def __init__(self, reliquary):
+        flags = inotify_simple.flags
+        self.mask = flags.CREATE | flags.DELETE | flags.CLOSE_WRITE \
+            | flags.MOVED_TO | flags.MOVED_FROM
+        self.inotify = inotify_simple.INotify()
+        # watch descriptor -> (directory path, depth below the reliquary)
+        self.watches = dict()
+        self.add_tree(reliquary, 0)
+
+    # watches a directory and every channel/index directory below it, and
+    # returns the relics already in them (a directory that was moved into
+    # place doesn't generate events for what's inside of it)
+    def add_tree(self, path, depth):
+        found = []
+        try:
+            wd = self.inotify.add_watch(path, self.mask)
+            entries = list(os.scandir(path))
+        except OSError as ex:
+            logger.error('unable to watch "{}": {}'.format(path, ex))
+            return found
+        self.watches[wd] = (path, depth)
+        for entry in entries:
+            # hidden folders aren't channels/indices (the cache defaults to one)
+            if entry.name.startswith('.'):
+                continue
+            if depth < RELIC_DEPTH and entry.is_dir():
+                found.append(entry.path)
+                found.extend(self.add_tree(entry.path, depth + 1))
+            elif depth == RELIC_DEPTH and entry.is_file():
+                found.append(entry.path)
+        return found
+
+    def remove_tree(self, path):
+        for wd, (watched, _) in list(self.watches.items()):
+            if watched == path or watched.startswith(path + os.sep):
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    # returns the set of changed paths, and whether events were lost and a
+    # full rescan is needed
+    def read(self, timeout):
+        flags = inotify_simple.flags
+        changed = set()
+        rescan = False
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                rescan = True
+                continue
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            watched = self.watches.get(event.wd, None)
+            if not watched or not event.name:
+                continue
+            path, depth = watched
+            child = os.path.join(path, event.name)
+            if event.mask & flags.ISDIR:
+                if depth >= RELIC_DEPTH or event.name.startswith('.'):
+                    continue
+                if event.mask & flags.MOVED_TO or event.mask & flags.CREATE:
+                    changed.update(self.add_tree(child, depth + 1))
+                elif event.mask & flags.MOVED_FROM:
+                    self.remove_tree(child)
+                changed.add(child)
+            elif depth == RELIC_DEPTH:
+                changed.add(child)
+        return changed, rescan
+
+
+class PollingWatcher(object):
+    """Reports paths that changed under the reliquary by periodically
+    comparing stat results of the whole tree."""
+
+    def __init__(self, reliquary, interval):
+        self.reliquary = reliquary
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    # path -> (mtime, size) for relics, and path -> None for channel/index
+    # directories
+    def scan(self):
+        snapshot = dict()
+        for channel_entry in os.scandir(self.reliquary):
+            if not channel_entry.is_dir() or channel_entry.name.startswith('.'):
+                continue
+            snapshot[channel_entry.path] = None
+            for index_entry in os.scandir(channel_entry.path):
+                if not index_entry.is_dir() or index_entry.name.startswith('.'):
+                    continue
+                snapshot[index_entry.path] = None
+                listing = scan_index(index_entry.path)
+                for (mtime, size, path) in listing.values():
+                    snapshot[path] = (mtime, size)
+        return snapshot
+
+    def read(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set(), False
+        if wait > 0:
+            time.sleep(wait)
+        self.next_scan = time.monotonic() + self.interval
+
+        snapshot = self.scan()
+        changed = set(path for path, stat in snapshot.items()
+                      if path not in self.snapshot
+                      or self.snapshot[path] != stat)
+        changed.update(path for path in self.snapshot
+                       if path not in snapshot)
+        self.snapshot = snapshot
+        return changed, False
+
+
+# removes the indices of a channel (or a single index) whose folder is gone
+def remove_missing(channel, index=None):
+    channelobj = DBSession.query(Channel).filter_by(name=channel).first()
+    if not channelobj:
+        return
+    with transaction.manager:
+        indices = DBSession.query(Index.uid).filter_by(channel_id=channelobj.uid)
+        if index is not None:
+            indices = indices.filter_by(name=index)
+        delete_indices([uid for (uid,) in indices])
+        if index is None:
+            DBSession.query(Channel) \
+                     .filter_by(uid=channelobj.uid) \
+                     .delete(synchronize_session=False)
+
+
+# brings the database in line with the given changed paths, then regenerates
+# the Debian indices for just the architectures that were affected (which
+# indexing/unindexing relics queued)
+def apply_changes(reliquary, paths):
+    for path in sorted(paths):
+        parts = os.path.relpath(path, reliquary).split(os.sep)
+        # hidden files are in-progress uploads and rsync temp files
+        if any(part.startswith('.') for part in parts):
+            continue
+        try:
+            if len(parts) == RELIC_DEPTH + 1:
+                channel, index, relic_name = parts
+                # the whole index folder is gone, which is handled on its own
+                if not os.path.isdir(os.path.dirname(path)):
+                    continue
+                if os.path.isfile(path):
+                    # uploads (and blob store links) are indexed as they're
+                    # made, and only show up here afterwards
+                    if relic_stat_matches(channel, index, relic_name, os.stat(path)):
+                        continue
+                    logger.info('indexing {}'.format(path))
+                    # a changed .deb may have changed architecture
+                    architecture = relic_debian_architecture(channel, index, relic_name)
+                    relicobj = index_relic(channel, index, relic_name, path)
+                    if architecture:
+                        enqueue_debian_rebuild(relicobj.index_id, architecture)
+                else:
+                    logger.info('unindexing {}'.format(path))
+                    unindex_relic(channel, index, relic_name)
+            elif len(parts) == 2 and not os.path.isdir(path):
+                logger.info('removing index {}'.format(path))
+                remove_missing(parts[0], parts[1])
+            elif len(parts) == 1 and not os.path.isdir(path):
+                logger.info('removing channel {}'.format(path))
+                remove_missing(parts[0])
+        except Exception as ex:
+            logger.error('failed to apply change to "{}": {}'.format(path, ex))
+
+    # the changes were already debounced
+    try:
+        process_debian_rebuild_queue()
+    finally:
+        # don't hold on to the implicit transaction any reads were made in
+        transaction.abort()
+
+
+# an incremental reindex, and regenerating the debian indices it touched
+def catch_up(reliquary):
+    try:
+        stats, touched = reindex_reliquary(reliquary, incremental=True)
+        pregenerate_deb_indices(touched)
+    finally:
+        transaction.abort()
+    logger.info('caught up: {added} added, {updated} updated, '
+                '{deleted} deleted'.format(**stats))
+
+
+def watch():
+    description = """\
+    Watch reliquary storage, and keep the index up to date as relics are
+    added, changed and removed outside of reliquary.
+    """
+    usage = "usage: %prog config_uri"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+        )
+    parser.add_option(
+        '--poll',
+        dest='poll',
+        action='store_true',
+        default=False,
+        help='poll the reliquary for changes instead of using inotify '
+             '(the default if inotify_simple is not installed)')
+    parser.add_option(
+        '--poll-interval',
+        dest='poll_interval',
+        type='float',
+        default=5.0,
+        help='seconds between scans when polling (default: 5)')
+    parser.add_option(
+        '--debounce',
+        dest='debounce',
+        type='float',
+        default=2.0,
+        help='seconds to wait for changes to settle before applying them '
+             '(default: 2)')
+    parser.add_option(
+        '--max-delay',
+        dest='max_delay',
+        type='float',
+        default=30.0,
+        help='most seconds changes are held back during a steady stream of '
+             'changes (default: 30)')
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if not len(args) > 0:
+        logger.error('at least the config uri is needed')
+        return 2
+    config_uri = args[0]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    settings, closer = env['registry'].settings, env['closer']
+    try:
+        reliquary = os.path.normpath(settings.get('reliquary.location', None))
+
+        # start watching before catching up, so nothing that changes while
+        # catching up is missed
+        if options.poll or not inotify_simple:
+            logger.info('polling {} for changes'.format(reliquary))
+            watcher = PollingWatcher(reliquary, options.poll_interval)
+        else:
+            logger.info('watching {} for changes'.format(reliquary))
+            watcher = InotifyWatcher(reliquary)
+
+        # catches up with everything that changed while nothing was watching
+        # (on startup, and after events were missed)
+        rescan = True
+        pending = set()
+        first_change = last_change = None
+        while True:
+            # a failure (the database going away, ...) is retried on the next
+            # iteration instead of stopping the daemon
+            try:
+                if rescan:
+                    catch_up(reliquary)
+                    rescan = False
+                    pending = set()
+                    first_change = last_change = None
+                changed, rescan = watcher.read(options.debounce)
+                if rescan:
+                    logger.warning('missed filesystem events, rescanning')
+                    continue
+                now = time.monotonic()
+                if changed:
+                    pending.update(changed)
+                    last_change = now
+                    if first_change is None:
+                        first_change = now
+                if pending and (now - last_change >= options.debounce
+                                or now - first_change >= options.max_delay):
+                    apply_changes(reliquary, pending)
+                    pending = set()
+                    first_change = last_change = None
+            except Exception:
+                logger.exception('failed to apply changes, retrying')
+                transaction.abort()
+                time.sleep(options.debounce)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        closer()
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 from pyramid import testing
@@ -27,3 +28,1326 @@ class FunctionalTests(unittest.TestCase):
     def test_root(self):
         res = self.testapp.get('/', status=200)
         self.assertTrue(b'Pyramid' in res.body)
+
+
+# a temporary sqlite database and reliquary.location for tests that need them
+class ReliquaryTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from sqlalchemy import engine_from_config
+        from reliquary.models import Base, DBSession
+
+        self.location = tempfile.mkdtemp()
+        self.settings = {
+            'reliquary.location': self.location,
+            'sqlalchemy.url': 'sqlite:///{}'.format(os.path.join(self.location, '.test.db')),
+        }
+        self.config = testing.setUp(settings=self.settings)
+        self.engine = engine_from_config(self.settings, 'sqlalchemy.')
+        DBSession.remove()
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        from reliquary.models import DBSession
+
+        transaction.abort()
+        DBSession.remove()
+        self.engine.dispose()
+        testing.tearDown()
+        shutil.rmtree(self.location)
+
+    def write_file(self, path, data):
+        path = os.path.join(self.location, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fout:
+            fout.write(data)
+        return path
+
+
+class ByteRangeTests(unittest.TestCase):
+    def test_parse_byte_ranges(self):
+        from reliquary.utils import parse_byte_ranges
+        self.assertEqual(parse_byte_ranges('bytes=0-9', 100), [(0, 10)])
+        self.assertEqual(parse_byte_ranges('bytes=90-', 100), [(90, 100)])
+        self.assertEqual(parse_byte_ranges('bytes=-10', 100), [(90, 100)])
+        self.assertEqual(parse_byte_ranges('bytes=-200', 100), [(0, 100)])
+        self.assertEqual(parse_byte_ranges('bytes=50-500', 100), [(50, 100)])
+        self.assertEqual(parse_byte_ranges('bytes=0-0, 10-19', 100), [(0, 1), (10, 20)])
+
+    def test_parse_byte_ranges_ignored(self):
+        from reliquary.utils import MAX_BYTE_RANGES, parse_byte_ranges
+        self.assertIsNone(parse_byte_ranges('items=0-9', 100))
+        self.assertIsNone(parse_byte_ranges('bytes=', 100))
+        self.assertIsNone(parse_byte_ranges('bytes=-', 100))
+        self.assertIsNone(parse_byte_ranges('bytes=9-0', 100))
+        self.assertIsNone(parse_byte_ranges('bytes=a-b', 100))
+        many = ','.join('{0}-{0}'.format(i) for i in range(MAX_BYTE_RANGES + 1))
+        self.assertIsNone(parse_byte_ranges('bytes=' + many, 100))
+
+    def test_parse_byte_ranges_unsatisfiable(self):
+        from reliquary.utils import parse_byte_ranges
+        self.assertEqual(parse_byte_ranges('bytes=100-', 100), [])
+        self.assertEqual(parse_byte_ranges('bytes=-0', 100), [])
+        self.assertEqual(parse_byte_ranges('bytes=0-', 0), [])
+
+    def test_file_range_iter(self):
+        import io
+        from reliquary.utils import FileRangeIter
+        fin = io.BytesIO(bytes(range(100)))
+        chunks = list(FileRangeIter(fin, [(10, 15), b'--', (95, 100)], blocksize=2))
+        self.assertEqual(chunks, [b'\x0a\x0b', b'\x0c\x0d', b'\x0e', b'--',
+                                  b'\x5f\x60', b'\x61\x62', b'\x63'])
+        self.assertTrue(fin.closed)
+
+    def test_file_range_iter_close(self):
+        import io
+        from reliquary.utils import FileRangeIter
+        fin = io.BytesIO(b'0123456789')
+        iterator = FileRangeIter(fin, [(0, 10)], blocksize=4)
+        self.assertEqual(next(iter(iterator)), b'0123')
+        iterator.close()
+        self.assertTrue(fin.closed)
+
+    def range_response(self, data, **headers):
+        import io
+        from pyramid.request import Request
+        from reliquary.utils import file_range_response
+        req = Request.blank('/', headers=headers)
+        return file_range_response(req, io.BytesIO(data), len(data),
+                                   {'Content-Type': 'text/plain'},
+                                   etag='"abc"',
+                                   last_modified='Thu, 01 Jan 2015 00:00:00 GMT')
+
+    def test_file_range_response(self):
+        data = b'abcdefghijklmnopqrstuvwxyz'
+        resp = self.range_response(data)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b''.join(resp.app_iter), data)
+
+        resp = self.range_response(data, Range='bytes=2-4')
+        self.assertEqual(resp.status_int, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 2-4/26')
+        self.assertEqual(resp.headers['Content-Length'], '3')
+        self.assertEqual(b''.join(resp.app_iter), b'cde')
+
+        resp = self.range_response(data, Range='bytes=30-')
+        self.assertEqual(resp.status_int, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */26')
+
+    def test_file_range_response_if_range(self):
+        data = b'abcdefghijklmnopqrstuvwxyz'
+        resp = self.range_response(data, Range='bytes=2-4', **{'If-Range': '"abc"'})
+        self.assertEqual(resp.status_int, 206)
+        resp = self.range_response(data, Range='bytes=2-4', **{'If-Range': '"xyz"'})
+        self.assertEqual(resp.status_int, 200)
+        resp = self.range_response(data, Range='bytes=2-4',
+                                   **{'If-Range': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+        self.assertEqual(resp.status_int, 206)
+
+    def test_file_range_response_multipart(self):
+        import email
+        data = b'abcdefghijklmnopqrstuvwxyz'
+        resp = self.range_response(data, Range='bytes=0-1,-3')
+        self.assertEqual(resp.status_int, 206)
+        content_type = resp.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        body = b''.join(resp.app_iter)
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+
+        message = email.message_from_bytes(
+            b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' + body)
+        parts = [(part['Content-Range'], part['Content-Type'], part.get_payload())
+                 for part in message.get_payload()]
+        self.assertEqual(parts, [('bytes 0-1/26', 'text/plain', 'ab'),
+                                 ('bytes 23-25/26', 'text/plain', 'xyz')])
+
+
+class SaveRelicStreamTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def test_save_relic_stream(self):
+        import hashlib
+        import io
+        from reliquary.utils import save_relic_stream
+        data = os.urandom(200000)
+        path = os.path.join(self.folder, 'relic.tar.gz')
+        digests = save_relic_stream(io.BytesIO(data), self.folder, path, blocksize=4096)
+
+        self.assertEqual(digests, dict(md5sum=hashlib.md5(data).hexdigest(),
+                                       sha1=hashlib.sha1(data).hexdigest(),
+                                       sha256=hashlib.sha256(data).hexdigest(),
+                                       sha512=hashlib.sha512(data).hexdigest()))
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(os.listdir(self.folder), ['relic.tar.gz'])
+
+    def test_save_relic_stream_failure(self):
+        import io
+        from reliquary.utils import save_relic_stream
+
+        class BrokenStream(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() > 0:
+                    raise IOError('connection reset')
+                return super(BrokenStream, self).read(size)
+
+        path = os.path.join(self.folder, 'relic.tar.gz')
+        with self.assertRaises(IOError):
+            save_relic_stream(BrokenStream(b'x' * 10000), self.folder, path, blocksize=4096)
+        # neither the relic nor the temporary file it was written to are left
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+class ReconcileIndexTests(ReliquaryTestCase):
+    def reconcile(self, indexobj):
+        from reliquary.scripts.reindex import reconcile_index, scan_index
+        stats = dict(skipped=0, added=0, updated=0, deleted=0)
+        listing = scan_index(os.path.join(self.location, 'chan', 'idx'))
+        deb_jobs, changed = reconcile_index(indexobj, 'idx', listing, stats, incremental=True)
+        return stats, changed
+
+    def relics(self, indexobj):
+        from reliquary.models import DBSession, Relic
+        return dict((name, size) for (name, size) in
+                    DBSession.query(Relic.name, Relic.size)
+                             .filter_by(index_id=indexobj.uid))
+
+    def test_reconcile_index(self):
+        from reliquary.utils import fetch_or_create_index
+        indexobj = fetch_or_create_index('chan', 'idx')
+        self.write_file('chan/idx/one-1.0.tar.gz', b'1')
+        self.write_file('chan/idx/two-1.0.tar.gz', b'2')
+        self.write_file('chan/idx/.upload.part', b'in progress')
+
+        stats, changed = self.reconcile(indexobj)
+        self.assertTrue(changed)
+        self.assertEqual(stats, dict(skipped=0, added=2, updated=0, deleted=0))
+        self.assertEqual(self.relics(indexobj), {'one-1.0.tar.gz': 1, 'two-1.0.tar.gz': 1})
+
+        stats, changed = self.reconcile(indexobj)
+        self.assertFalse(changed)
+        self.assertEqual(stats, dict(skipped=2, added=0, updated=0, deleted=0))
+
+        self.write_file('chan/idx/one-1.0.tar.gz', b'one')
+        os.remove(os.path.join(self.location, 'chan/idx/two-1.0.tar.gz'))
+        self.write_file('chan/idx/three-1.0.tar.gz', b'3')
+        stats, changed = self.reconcile(indexobj)
+        self.assertTrue(changed)
+        self.assertEqual(stats, dict(skipped=0, added=1, updated=1, deleted=1))
+        self.assertEqual(self.relics(indexobj), {'one-1.0.tar.gz': 3, 'three-1.0.tar.gz': 1})
+
+
+class CacheDependencyTests(ReliquaryTestCase):
+    def test_cache_invalidate(self):
+        from reliquary.cache import cache_get, cache_history, cache_invalidate, cache_put
+        cache_put('packages', b'packages', history=1)
+        cache_put('packages.gz', b'gz', depends=['packages'])
+        cache_put('release', b'release', depends=['packages.gz'])
+        cache_put('other', b'other')
+
+        invalidated = cache_invalidate(['packages'])
+        self.assertEqual(invalidated, set(['packages', 'packages.gz', 'release']))
+        for key in invalidated:
+            self.assertIsNone(cache_get(key))
+        self.assertIsNotNone(cache_get('other'))
+        # superseded, not dropped
+        self.assertEqual(cache_history('packages').count(), 1)
+
+
+class DebianEdDiffTests(unittest.TestCase):
+    # applies an ed script as made by debian_ed_diff (as apt does)
+    def apply(self, lines, script):
+        import re
+        lines = list(lines)
+        commands = script.split("\n")[:-1]
+        i = 0
+        while i < len(commands):
+            match = re.match(r'^(\d+)(?:,(\d+))?([acd])$', commands[i])
+            self.assertIsNotNone(match, commands[i])
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            command = match.group(3)
+            i += 1
+            added = []
+            if command != 'd':
+                while commands[i] != '.':
+                    added.append(commands[i])
+                    i += 1
+                i += 1
+            if command == 'a':
+                lines[first:first] = added
+            else:
+                lines[first - 1:last] = added
+        return lines
+
+    def test_round_trip(self):
+        from reliquary.utils import debian_ed_diff
+        cases = [
+            ([], []),
+            ([], ['a', 'b']),
+            (['a', 'b'], []),
+            (['a', 'b', 'c'], ['a', 'b', 'c']),
+            (['a', 'b', 'c'], ['x', 'a', 'c', 'd']),
+            (['a', 'b', 'c', 'd', 'e'], ['a', 'B', 'C', 'd', 'e', 'f']),
+            (['Package: a', 'Version: 1', '', 'Package: b', 'Version: 1'],
+             ['Package: a', 'Version: 2', '', 'Package: c', 'Version: 1',
+              '', 'Package: b', 'Version: 1']),
+        ]
+        for old, new in cases:
+            self.assertEqual(self.apply(old, debian_ed_diff(old, new)), new)
+
+    def test_no_changes(self):
+        from reliquary.utils import debian_ed_diff
+        self.assertEqual(debian_ed_diff(['a'], ['a']), '')
+
+
+class CacheTests(ReliquaryTestCase):
+    def test_cache_put(self):
+        from reliquary.cache import cache_get, cache_history, cache_path, cache_put, cache_value
+        entry = cache_put('key', b'one')
+        self.assertEqual(cache_value(cache_get('key')), b'one')
+        self.assertTrue(os.path.exists(cache_path(entry.sha256)))
+
+        # without history, the superseded file is removed
+        cache_put('key', b'two')
+        self.assertEqual(cache_value(cache_get('key')), b'two')
+        self.assertEqual(cache_history('key').count(), 0)
+        self.assertFalse(os.path.exists(cache_path(entry.sha256)))
+
+    def test_cache_history(self):
+        from reliquary.cache import cache_get, cache_history, cache_history_key, cache_path, cache_put
+        entries = [cache_put('key', value, history=2) for value in (b'1', b'2', b'3', b'4')]
+        self.assertEqual(cache_get('key').sha256, entries[-1].sha256)
+        self.assertEqual([entry.key for entry in cache_history('key')],
+                         [cache_history_key('key', entries[2].sha256),
+                          cache_history_key('key', entries[1].sha256)])
+        # the oldest version expired, the ones kept are still on disk
+        self.assertFalse(os.path.exists(cache_path(entries[0].sha256)))
+        for entry in entries[1:]:
+            self.assertTrue(os.path.exists(cache_path(entry.sha256)))
+
+    def test_cache_put_same_value(self):
+        from reliquary.cache import cache_get, cache_history, cache_path, cache_put
+        entry = cache_put('key', b'same', history=2)
+        cache_put('key', b'same', history=2)
+        self.assertEqual(cache_get('key').sha256, entry.sha256)
+        self.assertEqual(cache_history('key').count(), 1)
+        self.assertTrue(os.path.exists(cache_path(entry.sha256)))
+
+
+class ConditionalTests(ReliquaryTestCase):
+    def test_relic_etag(self):
+        import transaction
+        from reliquary.models import DBSession, Relic
+        from reliquary.utils import fetch_or_create_index, relic_etag
+
+        path = self.write_file('chan/idx/relic.txt', b'relic')
+        relic_stat = os.stat(path)
+        fallback = '"{:x}-{:x}"'.format(int(relic_stat.st_mtime), relic_stat.st_size)
+        self.assertEqual(relic_etag('chan', 'idx', 'relic.txt', relic_stat), fallback)
+
+        indexobj = fetch_or_create_index('chan', 'idx')
+        with transaction.manager:
+            DBSession.add(Relic(index_id=indexobj.uid,
+                                name='relic.txt',
+                                mtime=str(relic_stat.st_mtime),
+                                size=relic_stat.st_size,
+                                sha256='0' * 64))
+        self.assertEqual(relic_etag('chan', 'idx', 'relic.txt', relic_stat),
+                         '"{}"'.format('0' * 64))
+
+        # the stored sha256 is no longer of what's on disk
+        changed = os.stat_result((relic_stat.st_mode, relic_stat.st_ino,
+                                  relic_stat.st_dev, relic_stat.st_nlink,
+                                  relic_stat.st_uid, relic_stat.st_gid,
+                                  relic_stat.st_size + 1, relic_stat.st_atime,
+                                  relic_stat.st_mtime, relic_stat.st_ctime))
+        self.assertNotEqual(relic_etag('chan', 'idx', 'relic.txt', changed),
+                            '"{}"'.format('0' * 64))
+
+    def test_relic_etag_after_reindex(self):
+        import transaction
+        from reliquary.models import DBSession, Relic
+        from reliquary.scripts.reindex import reconcile_index, scan_index
+        from reliquary.utils import fetch_or_create_index, relic_etag
+
+        path = self.write_file('chan/idx/a-1.0.zip', b'abc')
+        indexobj = fetch_or_create_index('chan', 'idx')
+        listing = scan_index(os.path.dirname(path))
+        stats = dict(skipped=0, added=0, updated=0, deleted=0)
+        reconcile_index(indexobj, 'idx', listing, stats, incremental=True)
+        with transaction.manager:
+            DBSession.query(Relic).update({'sha256': '0' * 64})
+
+        # replaced out of band
+        self.write_file('chan/idx/a-1.0.zip', b'abcdef')
+        listing = scan_index(os.path.dirname(path))
+        reconcile_index(indexobj, 'idx', listing, stats, incremental=True)
+        self.assertIsNone(DBSession.query(Relic.sha256).scalar())
+        self.assertNotEqual(relic_etag('chan', 'idx', 'a-1.0.zip', os.stat(path)),
+                            '"{}"'.format('0' * 64))
+
+    def test_is_not_modified(self):
+        from reliquary.utils import is_not_modified
+        mtime = 1420070400  # Thu, 01 Jan 2015 00:00:00 GMT
+
+        def request(method='GET', **headers):
+            return testing.DummyRequest(method=method, headers=headers)
+
+        self.assertFalse(is_not_modified(request(), '"a"', mtime))
+        self.assertTrue(is_not_modified(request(**{'If-None-Match': '"a"'}), '"a"', mtime))
+        self.assertTrue(is_not_modified(request(**{'If-None-Match': '"b", W/"a"'}), '"a"', mtime))
+        self.assertTrue(is_not_modified(request(**{'If-None-Match': '*'}), '"a"', mtime))
+        self.assertFalse(is_not_modified(request(**{'If-None-Match': '"b"'}), '"a"', mtime))
+        self.assertTrue(is_not_modified(request('HEAD', **{'If-None-Match': '"a"'}), '"a"', mtime))
+        self.assertFalse(is_not_modified(request('POST', **{'If-None-Match': '"a"'}), '"a"', mtime))
+
+        since = {'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'}
+        self.assertTrue(is_not_modified(request(**since), '"a"', mtime))
+        self.assertFalse(is_not_modified(request(**since), '"a"', mtime + 1))
+        self.assertFalse(is_not_modified(request(**{'If-Modified-Since': 'garbage'}), '"a"', mtime))
+        # If-None-Match takes precedence over If-Modified-Since
+        self.assertFalse(is_not_modified(request(**dict(since, **{'If-None-Match': '"b"'})),
+                                         '"a"', mtime))
+
+
+class BlobTests(ReliquaryTestCase):
+    def test_store_blob(self):
+        import hashlib
+        from reliquary.blobs import blob_path, store_blob
+        one = self.write_file('chan/a/relic.tar.gz', b'relic')
+        two = self.write_file('chan/b/relic.tar.gz', b'relic')
+        sha256 = hashlib.sha256(b'relic').hexdigest()
+
+        self.assertFalse(store_blob(one, sha256, self.settings))
+        self.assertTrue(os.path.samefile(one, blob_path(sha256, self.settings)))
+        self.assertEqual(os.stat(one).st_nlink, 2)
+        self.assertEqual(os.stat(one).st_mode & 0o777, 0o444)
+        # already stored
+        self.assertFalse(store_blob(one, sha256, self.settings))
+
+        self.assertTrue(store_blob(two, sha256, self.settings))
+        self.assertTrue(os.path.samefile(one, two))
+        self.assertEqual(os.stat(one).st_nlink, 3)
+        with open(two, 'rb') as fin:
+            self.assertEqual(fin.read(), b'relic')
+
+    def test_store_blob_stale_sha256(self):
+        import hashlib
+        from reliquary.blobs import store_blob
+        one = self.write_file('chan/a/relic.tar.gz', b'abc')
+        sha256 = hashlib.sha256(b'abc').hexdigest()
+        store_blob(one, sha256, self.settings)
+
+        # the relic was replaced since its sha256 was stored
+        two = self.write_file('chan/b/relic.tar.gz', b'abcdef')
+        self.assertFalse(store_blob(two, sha256, self.settings))
+        self.assertFalse(os.path.samefile(one, two))
+        with open(two, 'rb') as fin:
+            self.assertEqual(fin.read(), b'abcdef')
+
+    def test_dedupe_relics_stale_sha256(self):
+        import hashlib
+        import transaction
+        from reliquary.models import DBSession, Relic
+        from reliquary.scripts.blobs import dedupe_relics
+        from reliquary.blobs import store_blob
+        from reliquary.utils import fetch_or_create_index
+
+        indexobj = fetch_or_create_index('chan', 'idx')
+        old = self.write_file('chan/old/a-1.0.zip', b'abc')
+        path = self.write_file('chan/idx/a-1.0.zip', b'xyz')
+        relic_stat = os.stat(path)
+        with transaction.manager:
+            DBSession.add(Relic(index_id=indexobj.uid,
+                                name='a-1.0.zip',
+                                mtime=str(relic_stat.st_mtime),
+                                size=relic_stat.st_size,
+                                sha256=hashlib.sha256(b'abc').hexdigest()))
+        store_blob(old, hashlib.sha256(b'abc').hexdigest(), self.settings)
+
+        stats = dedupe_relics(self.location, self.settings)
+        self.assertEqual(stats['deduplicated'], 0)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), b'xyz')
+
+    def test_collect_blobs(self):
+        import hashlib
+        from reliquary.blobs import blob_location, blob_path, collect_blobs, store_blob
+        one = self.write_file('chan/a/relic.tar.gz', b'relic')
+        two = self.write_file('chan/b/other.tar.gz', b'other')
+        for path, data in ((one, b'relic'), (two, b'other')):
+            store_blob(path, hashlib.sha256(data).hexdigest(), self.settings)
+
+        self.assertEqual(collect_blobs(self.settings), (0, 0))
+        os.remove(one)
+        self.assertEqual(collect_blobs(self.settings), (1, len(b'relic')))
+        self.assertFalse(os.path.exists(blob_path(hashlib.sha256(b'relic').hexdigest(), self.settings)))
+        self.assertTrue(os.path.exists(blob_path(hashlib.sha256(b'other').hexdigest(), self.settings)))
+
+        os.remove(two)
+        self.assertEqual(collect_blobs(self.settings), (1, len(b'other')))
+        # the emptied shard folders are removed too
+        self.assertEqual(os.listdir(os.path.join(blob_location(self.settings), 'sha256')), [])
+
+
+class WatchTests(ReliquaryTestCase):
+    def relic(self, name):
+        from reliquary.models import DBSession, Relic
+        return DBSession.query(Relic.size, Relic.sha256).filter_by(name=name).first()
+
+    def test_apply_changes(self):
+        import hashlib
+        from reliquary.scripts.watch import apply_changes
+        from reliquary.utils import index_relic
+
+        # an upload is indexed with its sha256 before its event shows up
+        uploaded = self.write_file('chan/idx/up-1.0.tar.gz', b'up')
+        index_relic('chan', 'idx', 'up-1.0.tar.gz', uploaded,
+                    digests=dict(sha256=hashlib.sha256(b'up').hexdigest()))
+        added = self.write_file('chan/idx/new-1.0.tar.gz', b'new')
+        hidden = self.write_file('chan/idx/.new-1.0.tar.gz.part', b'partial')
+        apply_changes(self.location, [uploaded, added, hidden])
+
+        self.assertEqual(self.relic('up-1.0.tar.gz'), (2, hashlib.sha256(b'up').hexdigest()))
+        self.assertEqual(self.relic('new-1.0.tar.gz'), (3, None))
+        self.assertIsNone(self.relic('.new-1.0.tar.gz.part'))
+
+        # changed and removed out of band
+        self.write_file('chan/idx/up-1.0.tar.gz', b'changed')
+        os.remove(added)
+        apply_changes(self.location, [uploaded, added])
+        self.assertEqual(self.relic('up-1.0.tar.gz'), (7, None))
+        self.assertIsNone(self.relic('new-1.0.tar.gz'))
+
+    def test_apply_changes_removed_index(self):
+        import shutil
+        from reliquary.scripts.watch import apply_changes
+        from reliquary.utils import index_relic
+
+        path = self.write_file('chan/idx/relic-1.0.tar.gz', b'relic')
+        index_relic('chan', 'idx', 'relic-1.0.tar.gz', path)
+        shutil.rmtree(os.path.join(self.location, 'chan', 'idx'))
+        apply_changes(self.location, [path, os.path.dirname(path)])
+        self.assertIsNone(self.relic('relic-1.0.tar.gz'))
+
+
+class RebuildTests(ReliquaryTestCase):
+    def test_rebuild_queue_debounce(self):
+        import datetime
+        import transaction
+        from reliquary.models import DBSession, RebuildQueue
+        from reliquary.utils import enqueue_debian_rebuild, process_debian_rebuild_queue
+
+        enqueue_debian_rebuild(1, 'amd64 i386')
+        enqueue_debian_rebuild(1, 'amd64')
+        self.assertEqual(DBSession.query(RebuildQueue).count(), 2)
+        # asked for again too recently
+        self.assertEqual(process_debian_rebuild_queue(debounce=60), 0)
+
+        # waiting for longer than max_delay, even though it was asked for again
+        with transaction.manager:
+            DBSession.query(RebuildQueue).update(
+                {'first_requested': datetime.datetime.utcnow() - datetime.timedelta(seconds=120)})
+        self.assertEqual(process_debian_rebuild_queue(debounce=60, max_delay=60), 1)
+        self.assertEqual(DBSession.query(RebuildQueue).count(), 0)
+
+    def test_worker_started_on_first_request(self):
+        from unittest import mock
+        from pyramid.events import NewRequest
+        from reliquary import rebuild
+
+        request = testing.DummyRequest()
+        request.registry = self.config.registry
+        with mock.patch.object(rebuild, 'start_rebuild_worker', return_value='worker') as start:
+            rebuild.start_rebuild_worker_on_request(NewRequest(request))
+            rebuild.start_rebuild_worker_on_request(NewRequest(request))
+        start.assert_called_once_with(self.config.registry)
+        self.assertEqual(self.config.registry.reliquary_rebuild_worker, 'worker')
+
+    def test_no_worker_without_requests(self):
+        from unittest import mock
+        from reliquary import main, rebuild
+        settings = dict(self.settings, **{'pyramid.debug': 'false',
+                                          'reliquary.realm': 'Reliquary'})
+        # what scripts bootstrapping the app do
+        with mock.patch.object(rebuild, 'start_rebuild_worker') as start:
+            main({}, **settings)
+        self.assertFalse(start.called)
+
+    def test_worker_disabled(self):
+        from reliquary.rebuild import start_rebuild_worker
+        self.config.registry.settings['reliquary.rebuild_worker'] = 'false'
+        self.assertIsNone(start_rebuild_worker(self.config.registry))
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        self.relic_path = os.path.join(self.folder, 'relic-1.0.tar.gz')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def test_single_flight(self):
+        import threading
+        import time
+        from reliquary.utils import single_flight
+
+        inside = []
+        overlapped = []
+
+        def fetch():
+            with single_flight(self.relic_path):
+                if inside:
+                    overlapped.append(True)
+                inside.append(True)
+                time.sleep(0.05)
+                inside.pop()
+
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlapped, [])
+        # the lock file is removed once nobody holds it
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_single_flight_timeout(self):
+        import threading
+        from reliquary.utils import single_flight
+
+        holding = threading.Event()
+        release = threading.Event()
+
+        def fetch():
+            with single_flight(self.relic_path):
+                holding.set()
+                release.wait()
+
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        holding.wait()
+        try:
+            with self.assertRaises(TimeoutError):
+                with single_flight(self.relic_path, timeout=0.1):
+                    pass
+        finally:
+            release.set()
+            thread.join()
+        with single_flight(self.relic_path, timeout=0.1):
+            pass
+
+    def test_single_flight_lock_file(self):
+        import fcntl
+        from reliquary.utils import single_flight
+
+        # another process holding the lock file
+        with open(os.path.join(self.folder, '.relic-1.0.tar.gz.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self.assertRaises(TimeoutError):
+                with single_flight(self.relic_path, timeout=0.2):
+                    pass
+            # released after removing it, as single_flight does
+            os.remove(lock_file.name)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with single_flight(self.relic_path, timeout=0.2):
+            self.assertTrue(os.path.exists(os.path.join(self.folder, '.relic-1.0.tar.gz.lock')))
+
+
+# stands in for a streamed requests response from upstream
+class FakeUpstreamResponse(object):
+    def __init__(self, chunks, headers=None):
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, blocksize):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class UpstreamRelicTeeTests(ReliquaryTestCase):
+    def tee(self, chunks, headers=None, expected=None):
+        import contextlib
+        from reliquary.utils import UpstreamRelicTee, single_flight
+        self.folder = os.path.join(self.location, 'chan', 'idx')
+        os.makedirs(self.folder, exist_ok=True)
+        self.relic_path = os.path.join(self.folder, 'relic-1.0.tar.gz')
+        self.flight = contextlib.ExitStack()
+        self.flight.enter_context(single_flight(self.relic_path))
+        self.resp = FakeUpstreamResponse(chunks, headers)
+        return UpstreamRelicTee(testing.DummyRequest(), 'chan', 'idx', 'relic-1.0.tar.gz',
+                                self.folder, self.relic_path, self.resp, self.flight,
+                                expected=expected, blocksize=4)
+
+    def test_tee(self):
+        import hashlib
+        from reliquary.models import DBSession, Relic
+        data = b'0123456789abcdef'
+        tee = self.tee([data[:5], data[5:11], data[11:]],
+                       headers={'Content-Length': str(len(data))},
+                       expected={'sha256': hashlib.sha256(data).hexdigest()})
+        self.assertEqual(b''.join(tee), data)
+        tee.thread.join()
+        with open(self.relic_path, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(DBSession.query(Relic.sha256).filter_by(name='relic-1.0.tar.gz').scalar(),
+                         hashlib.sha256(data).hexdigest())
+        self.assertTrue(self.resp.closed)
+        # nothing left behind but the relic
+        self.assertEqual(os.listdir(self.folder), ['relic-1.0.tar.gz'])
+
+    def test_tee_verification_failed(self):
+        data = b'0123456789abcdef'
+        tee = self.tee([data], expected={'sha256': '0' * 64})
+        received = b''
+        with self.assertRaises(ValueError):
+            for chunk in tee:
+                received += chunk
+        tee.thread.join()
+        # never all of it
+        self.assertLess(len(received), len(data))
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_tee_upstream_failed(self):
+        tee = self.tee([b'0123', IOError('connection reset')])
+        with self.assertRaises(IOError):
+            list(tee)
+        tee.thread.join()
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_tee_slow_client(self):
+        import threading
+        from reliquary.utils import single_flight
+        data = b'0123456789abcdef'
+        tee = self.tee([data])
+        self.assertEqual(next(tee), b'0123')
+        # the fetch (and the single flight) is done without waiting for the
+        # client to read the rest
+        tee.thread.join(5)
+        self.assertFalse(tee.thread.is_alive())
+        with single_flight(self.relic_path, timeout=1):
+            pass
+        self.assertEqual(b''.join(tee), data[4:])
+        tee.close()
+
+
+class DebianCacheKeyTests(ReliquaryTestCase):
+    def test_keys_of_different_indices(self):
+        from reliquary.cache import cache_keys, cache_put
+        from reliquary.utils import (
+            debian_package_key,
+            debian_pdiff_key,
+            debian_release_key,
+            debian_translation_key,
+        )
+        for key in (debian_package_key, debian_translation_key, debian_release_key):
+            args = ('amd64',) if key is debian_package_key else ()
+            self.assertNotEqual(key('a-b', 'c', *args), key('a', 'b-c', *args))
+        self.assertNotEqual(debian_pdiff_key('a-b', 'c', 'amd64', 'Index'),
+                            debian_pdiff_key('a', 'b-c', 'amd64', 'Index'))
+
+        # a prefix only ever matches keys of its own index and architecture
+        mine = debian_pdiff_key('a', 'b', 'amd64', 'Index')
+        cache_put(mine, b'mine')
+        for channel, index, arch in (('a', 'b-c', 'amd64'), ('a-b', 'c', 'amd64'),
+                                     ('a', 'bb', 'amd64'), ('a', 'b', 'amd64x')):
+            cache_put(debian_pdiff_key(channel, index, arch, 'Index'), b'theirs')
+            cache_put(debian_package_key(channel, index, arch), b'theirs')
+        self.assertEqual(cache_keys(debian_pdiff_key('a', 'b', 'amd64', '')), set([mine]))
+
+
+class CachedFileResponseTests(ReliquaryTestCase):
+    def response(self, entry, method='GET'):
+        from pyramid.request import Request
+        from reliquary.utils import cached_file_response
+        req = Request.blank('/', method=method)
+        req.registry = self.config.registry
+        return cached_file_response(req, entry, 'text/plain')
+
+    def test_cached_file_response(self):
+        from reliquary.cache import cache_put, memory_cache
+        value = os.urandom(200000)
+        entry = cache_put('packages', value)
+        memory_cache.entries.clear()
+        memory_cache.size = 0
+
+        resp = self.response(entry)
+        self.assertEqual(resp.headers['Content-Length'], str(len(value)))
+        self.assertEqual(b''.join(resp.app_iter), value)
+        # streamed from the file, not read into memory
+        self.assertIsNone(memory_cache.get(entry.sha256))
+
+        resp = self.response(entry, method='HEAD')
+        self.assertEqual(resp.headers['Content-Length'], str(len(value)))
+        self.assertEqual(resp.body, b'')
+
+    def test_cached_file_response_removed(self):
+        from reliquary.cache import cache_path, cache_put, memory_cache
+        entry = cache_put('packages', b'packages')
+        memory_cache.entries.clear()
+        memory_cache.size = 0
+        os.remove(cache_path(entry.sha256))
+        self.assertEqual(self.response(entry).status_int, 404)
+
+
+class UpstreamTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'reliquary.upstream.retries': '0',
+            'reliquary.upstream.connect_timeout': '1',
+            'reliquary.upstream.read_timeout': '1',
+        })
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        testing.tearDown()
+
+    # a mirror on localhost answering every GET with 'status', returns its url
+    def mirror(self, status, hits):
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits.append(self.path)
+                body = 'mirror {}'.format(status).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+    # a url nothing listens on
+    def refused(self):
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return 'http://127.0.0.1:{}'.format(port)
+
+    def test_upstream_urls(self):
+        from reliquary.upstream import upstream_urls
+        self.config.registry.settings['reliquary.upstream.pypi'] = \
+            'http://one/\n    http://two'
+        self.assertEqual(upstream_urls(self.config.registry, 'pypi', '/simple/a/'),
+                         ['http://one/simple/a/', 'http://two/simple/a/'])
+
+    def test_upstream_get_failover(self):
+        from reliquary.upstream import upstream_get
+        bad, good = [], []
+        urls = [self.refused() + '/simple/a/',
+                self.mirror(500, bad) + '/simple/a/',
+                self.mirror(200, good) + '/simple/a/']
+        resp = upstream_get(self.config.registry, urls)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b'mirror 200')
+        self.assertEqual(bad, ['/simple/a/'])
+        self.assertEqual(good, ['/simple/a/'])
+
+    def test_upstream_get_client_error(self):
+        from reliquary.upstream import upstream_get
+        missing, good = [], []
+        urls = [self.mirror(404, missing) + '/simple/a/',
+                self.mirror(200, good) + '/simple/a/']
+        # a 404 is an answer, not a reason to ask the next mirror
+        self.assertEqual(upstream_get(self.config.registry, urls).status_code, 404)
+        self.assertEqual(good, [])
+
+    def test_upstream_get_unreachable(self):
+        from reliquary.upstream import upstream_get
+        bad = []
+        self.assertIsNone(upstream_get(self.config.registry, [self.refused()]))
+        # the last server error when every mirror had one
+        resp = upstream_get(self.config.registry, [self.refused(), self.mirror(503, bad)])
+        self.assertEqual(resp.status_code, 503)
+
+
+class OffloadTests(ReliquaryTestCase):
+    def nginx(self, **settings):
+        from reliquary.offload import NginxOffload
+        settings = dict(settings)
+        settings['reliquary.location'] = self.location
+        return NginxOffload(settings)
+
+    def test_nginx_uri(self):
+        offload = self.nginx(**{'reliquary.xsendfile_nginx_location': '_relics',
+                                'reliquary.xsendfile_nginx_cache_location': '/_cache/'})
+        self.assertEqual(offload.uri(os.path.join(self.location, 'chan', 'idx', 'a b#1.tar.gz')),
+                         '/_relics/chan/idx/a%20b%231.tar.gz')
+        # the cache is inside of reliquary.location by default, but has a
+        # location of its own
+        self.assertEqual(offload.uri(os.path.join(self.location, '.cache', 'ab', 'abcd')),
+                         '/_cache/ab/abcd')
+        with self.assertRaises(ValueError):
+            offload.uri(os.path.join(self.location + 'x', 'chan', 'idx', 'a.tar.gz'))
+        with self.assertRaises(ValueError):
+            offload.uri('/etc/passwd')
+
+    def test_nginx_cache_in_location(self):
+        offload = self.nginx(**{'reliquary.xsendfile_nginx_location': '/_relics/'})
+        self.assertEqual(offload.uri(os.path.join(self.location, '.cache', 'ab', 'abcd')),
+                         '/_relics/.cache/ab/abcd')
+
+    def test_nginx_locations_required(self):
+        with self.assertRaises(ValueError):
+            self.nginx()
+        # a cache outside of reliquary.location needs a location of its own
+        with self.assertRaises(ValueError):
+            self.nginx(**{'reliquary.xsendfile_nginx_location': '/_relics/',
+                          'reliquary.cache_location': self.location + '-cache'})
+
+    def test_nginx_headers(self):
+        path = os.path.join(self.location, 'chan', 'idx', 'a.tar.gz')
+        offload = self.nginx(**{'reliquary.xsendfile_nginx_location': '/_relics/'})
+        self.assertEqual(offload.headers(path), {'X-Accel-Redirect': '/_relics/chan/idx/a.tar.gz'})
+        offload = self.nginx(**{'reliquary.xsendfile_nginx_location': '/_relics/',
+                                'reliquary.xsendfile_nginx_buffering': 'no',
+                                'reliquary.xsendfile_nginx_limit_rate': '1048576'})
+        self.assertEqual(offload.headers(path), {
+            'X-Accel-Redirect': '/_relics/chan/idx/a.tar.gz',
+            'X-Accel-Buffering': 'no',
+            'X-Accel-Limit-Rate': '1048576',
+        })
+
+    def test_sendfile_headers(self):
+        from reliquary.offload import SendfileOffload
+        path = os.path.join(self.location, 'chan', 'idx', '..', 'idx', 'a.tar.gz')
+        self.assertEqual(SendfileOffload(self.settings).headers(path),
+                         {'X-Sendfile': os.path.join(self.location, 'chan', 'idx', 'a.tar.gz')})
+
+    def test_offload_backend(self):
+        from reliquary.offload import NginxOffload, SendfileOffload, offload_backend
+        registry = self.config.registry
+        self.assertIsNone(offload_backend(registry))
+
+        for frontend, backend in (('nginx', NginxOffload), (' Apache ', SendfileOffload),
+                                  ('lighttpd', SendfileOffload)):
+            del registry.reliquary_offload
+            registry.settings.update({
+                'reliquary.xsendfile_enabled': 'true',
+                'reliquary.xsendfile_frontend': frontend,
+                'reliquary.xsendfile_nginx_location': '/_relics/',
+            })
+            self.assertIsInstance(offload_backend(registry), backend)
+            # made once per registry
+            self.assertIs(offload_backend(registry), offload_backend(registry))
+
+        del registry.reliquary_offload
+        registry.settings['reliquary.xsendfile_frontend'] = 'iis'
+        with self.assertRaises(ValueError):
+            offload_backend(registry)
+
+    def test_cached_file_offloaded(self):
+        from pyramid.request import Request
+        from reliquary.cache import cache_path, cache_put
+        from reliquary.utils import cached_file_response
+        self.config.registry.settings.update({
+            'reliquary.xsendfile_enabled': 'true',
+            'reliquary.xsendfile_nginx_location': '/_relics/',
+            'reliquary.xsendfile_nginx_cache_location': '/_cache/',
+        })
+        entry = cache_put('packages', b'packages')
+        req = Request.blank('/')
+        req.registry = self.config.registry
+        resp = cached_file_response(req, entry, 'text/plain')
+        self.assertEqual(resp.headers['X-Accel-Redirect'],
+                         '/_cache/' + os.path.relpath(cache_path(entry.sha256),
+                                                      os.path.join(self.location, '.cache')))
+        self.assertEqual(resp.headers['Content-Length'], '8')
+        self.assertEqual(resp.body, b'')
+
+
+# indexes deb info the way read_deb_info and index_relic would have, without
+# needing actual .deb files
+class DebianIndexTestCase(ReliquaryTestCase):
+    def add_deb(self, channel, index, package, version, architecture, stanza=True, **info):
+        import hashlib
+        import transaction
+        from reliquary.models import DBSession, Relic
+        from reliquary.utils import (
+            debian_normalize_architecture,
+            fetch_or_create_index,
+            render_debian_stanza,
+            upsert_deb_info,
+        )
+        name = '{}_{}_{}.deb'.format(package, version, architecture.split()[0])
+        columns = dict(
+            filename='pool/{}/{}'.format(index, name),
+            md5sum='0' * 32, sha1='0' * 40, sha256='0' * 64, sha512='0' * 128,
+            multi_arch=None, package=package, source=None, version=version,
+            section=None, priority=None, architecture=architecture,
+            essential=None, depends=None, recommends=None, suggests=None,
+            enhances=None, pre_depends=None, installed_size=None,
+            maintainer='Maintainer <maintainer@example.com>',
+            description='{} package\n long description of {}'.format(package, package),
+            description_md5=hashlib.md5(package.encode()).hexdigest(),
+            homepage=None, built_using=None)
+        columns.update(info)
+        columns['arch'] = debian_normalize_architecture(architecture)
+        if stanza:
+            columns['stanza'] = render_debian_stanza(columns, 100)
+            columns['stanza_short'] = render_debian_stanza(columns, 100, long_description=False)
+
+        index_id = fetch_or_create_index(channel, index).uid
+        with transaction.manager:
+            relic = Relic(dirty=False, index_id=index_id, name=name, mtime='0', size=100)
+            DBSession.add(relic)
+            DBSession.flush()
+            upsert_deb_info(relic.uid, index_id, columns)
+        return index_id
+
+    def packages(self, channel, index, arch, compression=None):
+        from reliquary.cache import cache_value
+        from reliquary.utils import generate_debian_package_index
+        return cache_value(generate_debian_package_index(channel, index, arch, compression))
+
+
+class DebianArchitectureTests(DebianIndexTestCase):
+    def test_debian_normalize_architecture(self):
+        from reliquary.utils import debian_normalize_architecture
+        self.assertEqual(debian_normalize_architecture('AMD64'), 'amd64')
+        self.assertEqual(debian_normalize_architecture('all'), 'all')
+        self.assertEqual(debian_normalize_architecture('i386 amd64'), 'i386')
+
+    def test_packages_architecture(self):
+        self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        self.add_deb('chan', 'idx', 'two', '1.0', 'all')
+        self.add_deb('chan', 'idx', 'three', '1.0', 'amd64x')
+        self.add_deb('chan', 'idx', 'four', '1.0', 'i386')
+        self.add_deb('chan', 'other', 'five', '1.0', 'amd64')
+
+        packages = self.packages('chan', 'idx', 'amd64')
+        found = [line for line in packages.decode().splitlines() if line.startswith('Package: ')]
+        # the exact architecture plus 'all', from this index only
+        self.assertEqual(found, ['Package: one', 'Package: two'])
+
+    def test_get_unique_architectures_set(self):
+        from reliquary.utils import get_unique_architectures_set
+        index_id = self.add_deb('chan', 'idx', 'two', '1.0', 'all')
+        self.add_deb('chan', 'other', 'one', '1.0', 'amd64')
+        self.assertEqual(get_unique_architectures_set(index_id), set(['all']))
+        self.add_deb('chan', 'idx', 'one', '1.0', 'AMD64')
+        self.add_deb('chan', 'idx', 'three', '1.0', 'armhf')
+        self.assertEqual(get_unique_architectures_set(index_id), set(['amd64', 'armhf']))
+
+
+class DebianStanzaTests(DebianIndexTestCase):
+    def test_render_debian_stanza(self):
+        from reliquary.utils import render_debian_stanza
+        info = dict(filename='pool/idx/one_1.0_amd64.deb', md5sum='md5', sha1='sha1',
+                    sha256='sha256', sha512='sha512', multi_arch=None, package='one',
+                    source=None, version='1.0', section=None, priority='optional',
+                    architecture='amd64', essential=None, depends='two (>= 1.0)',
+                    recommends=None, suggests=None, enhances=None, pre_depends=None,
+                    installed_size=12, maintainer='m', description='short\n long',
+                    description_md5='abc', homepage=None, built_using=None)
+        stanza = render_debian_stanza(info, 100)
+        self.assertEqual(stanza.splitlines(), [
+            'Package: one',
+            'Version: 1.0',
+            # not dropped without a Section
+            'Priority: optional',
+            'Architecture: amd64',
+            'Depends: two (>= 1.0)',
+            'Installed-Size: 12',
+            'Maintainer: m',
+            'Description: short',
+            ' long',
+            'Filename: pool/idx/one_1.0_amd64.deb',
+            'Size: 100',
+            'MD5Sum: md5',
+            'SHA1: sha1',
+            'SHA256: sha256',
+            'SHA512: sha512',
+            'Description-md5: abc',
+        ])
+        self.assertTrue(stanza.endswith('\n'))
+        self.assertIn('Description: short\nFilename:',
+                      render_debian_stanza(info, 100, long_description=False))
+
+    def test_packages_from_stanzas(self):
+        import transaction
+        from reliquary.models import DBSession, DebInfo
+        self.add_deb('chan', 'idx', 'two', '1.0', 'amd64')
+        self.add_deb('chan', 'idx', 'one', '2.0', 'amd64')
+        self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        with transaction.manager:
+            DBSession.query(DebInfo).filter_by(package='two') \
+                     .update({'stanza': 'Package: two\nStored: yes\n'})
+
+        packages = self.packages('chan', 'idx', 'amd64').decode()
+        stanzas = packages.split('\n\n')
+        # ordered by package and version, each as it was stored
+        self.assertEqual(len(stanzas), 3)
+        self.assertTrue(stanzas[0].startswith('Package: one\nVersion: 1.0\n'))
+        self.assertTrue(stanzas[1].startswith('Package: one\nVersion: 2.0\n'))
+        self.assertEqual(stanzas[2], 'Package: two\nStored: yes\n')
+
+    def test_packages_without_stanza(self):
+        self.add_deb('chan', 'idx', 'one', '1.0', 'amd64', stanza=False)
+        self.add_deb('chan', 'idx', 'two', '1.0', 'amd64')
+        packages = self.packages('chan', 'idx', 'amd64').decode()
+        # deb info indexed before stanzas were stored is rendered on the fly
+        self.assertTrue(packages.startswith('Package: one\nVersion: 1.0\n'))
+        self.assertIn('Size: 100\n', packages.split('\n\n')[0])
+
+
+class DebianCompressionTests(DebianIndexTestCase):
+    def test_compress_debian_package_index(self):
+        import bz2
+        import gzip
+        import lzma
+        from reliquary.utils import compress_debian_package_index
+        data = b'Package: one\n' * 1000
+        for compression, decompress in (('gz', gzip.decompress),
+                                        ('bz2', bz2.decompress),
+                                        ('xz', lzma.decompress)):
+            for level in (1, 6, 9):
+                compressed = compress_debian_package_index(data, compression, level)
+                self.assertLess(len(compressed), len(data))
+                self.assertEqual(decompress(compressed), data)
+        self.assertIs(compress_debian_package_index(data, None, 9), data)
+
+    def test_debian_compression_level(self):
+        from reliquary.utils import debian_compression_level
+        self.assertEqual(debian_compression_level('xz'), 6)
+        self.config.registry.settings['reliquary.debian.xz_level'] = '9'
+        self.assertEqual(debian_compression_level('xz'), 9)
+
+    def test_pregenerate_debian_index(self):
+        import bz2
+        import gzip
+        import lzma
+        from reliquary.cache import cache_get, cache_value
+        from reliquary.utils import debian_package_key, pregenerate_debian_index
+        self.config.registry.settings['reliquary.debian.compression_workers'] = '2'
+        index_id = self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        self.add_deb('chan', 'idx', 'two', '1.0', 'i386')
+        pregenerate_debian_index('chan', 'idx', index_id)
+
+        for arch in ('amd64', 'i386'):
+            data = cache_value(cache_get(debian_package_key('chan', 'idx', arch)))
+            for compression, decompress in (('gz', gzip.decompress),
+                                            ('bz2', bz2.decompress),
+                                            ('xz', lzma.decompress)):
+                entry = cache_get(debian_package_key('chan', 'idx', arch, compression))
+                self.assertEqual(decompress(cache_value(entry)), data)
+
+
+class DebianByHashTests(DebianIndexTestCase):
+    def test_find_debian_by_hash(self):
+        from reliquary.utils import find_debian_by_hash, generate_debian_package_index
+        self.config.registry.settings['reliquary.debian.by_hash_history'] = '1'
+        self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        self.add_deb('chan', 'other', 'one', '1.0', 'amd64')
+        first = generate_debian_package_index('chan', 'idx', 'amd64', 'gz')
+
+        found = find_debian_by_hash('chan', 'idx', 'amd64', first.sha256)
+        self.assertEqual((found[0].sha256, found[1]), (first.sha256, 'gz'))
+        self.assertIsNone(find_debian_by_hash('chan', 'idx', 'i386', first.sha256))
+        self.assertIsNone(find_debian_by_hash('chan', 'idx', 'amd64', '0' * 64))
+        uncompressed = generate_debian_package_index('chan', 'other', 'amd64')
+        self.assertIsNone(find_debian_by_hash('chan', 'idx', 'amd64', uncompressed.sha256))
+
+        # a superseded version is still there for clients with the older Release
+        self.add_deb('chan', 'idx', 'two', '1.0', 'amd64')
+        generate_debian_package_index('chan', 'idx', 'amd64', force=True)
+        second = generate_debian_package_index('chan', 'idx', 'amd64', 'gz', force=True)
+        self.assertNotEqual(first.sha256, second.sha256)
+        for entry in (first, second):
+            found = find_debian_by_hash('chan', 'idx', 'amd64', entry.sha256)
+            self.assertEqual((found[0].sha256, found[1]), (entry.sha256, 'gz'))
+
+        # but only reliquary.debian.by_hash_history of them
+        self.add_deb('chan', 'idx', 'three', '1.0', 'amd64')
+        generate_debian_package_index('chan', 'idx', 'amd64', force=True)
+        generate_debian_package_index('chan', 'idx', 'amd64', 'gz', force=True)
+        self.assertIsNone(find_debian_by_hash('chan', 'idx', 'amd64', first.sha256))
+        self.assertIsNotNone(find_debian_by_hash('chan', 'idx', 'amd64', second.sha256))
+
+
+class DebianTranslationTests(DebianIndexTestCase):
+    def test_split_descriptions(self):
+        import hashlib
+        from reliquary.cache import cache_value
+        from reliquary.utils import generate_debian_translation_index
+        self.config.registry.settings['reliquary.debian.split_descriptions'] = 'true'
+        self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        self.add_deb('chan', 'idx', 'one', '1.0', 'i386')
+        self.add_deb('chan', 'other', 'two', '1.0', 'amd64')
+
+        packages = self.packages('chan', 'idx', 'amd64').decode()
+        self.assertIn('Description: one package\nFilename:', packages)
+        self.assertNotIn('long description', packages)
+
+        translation = cache_value(generate_debian_translation_index('chan', 'idx')).decode()
+        # once per description, from this index only
+        self.assertEqual(translation.splitlines(), [
+            'Package: one',
+            'Description-md5: {}'.format(hashlib.md5(b'one').hexdigest()),
+            'Description-en: one package',
+            ' long description of one',
+        ])
+
+    def test_enqueue_debian_settings_rebuild(self):
+        from reliquary.models import DBSession, RebuildQueue
+        from reliquary.utils import enqueue_debian_settings_rebuild
+        index_id = self.add_deb('chan', 'idx', 'one', '1.0', 'amd64')
+        other_id = self.add_deb('chan', 'other', 'two', '1.0', 'amd64')
+
+        def queued():
+            return sorted(DBSession.query(RebuildQueue.index_id, RebuildQueue.arch))
+
+        # the first time, nothing knows what the indices were generated with
+        self.assertTrue(enqueue_debian_settings_rebuild())
+        self.assertEqual(queued(), [(index_id, 'all'), (other_id, 'all')])
+        DBSession.query(RebuildQueue).delete()
+
+        self.assertFalse(enqueue_debian_settings_rebuild())
+        self.assertEqual(queued(), [])
+
+        self.config.registry.settings['reliquary.debian.split_descriptions'] = 'true'
+        self.assertTrue(enqueue_debian_settings_rebuild())
+        self.assertEqual(queued(), [(index_id, 'all'), (other_id, 'all')])
+
+
+class UpstreamDocumentTests(ReliquaryTestCase):
+    def setUp(self):
+        import hashlib
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        super(UpstreamDocumentTests, self).setUp()
+        # what the upstream mirror answers with, and the requests it got
+        self.status = 200
+        self.body = b'<html>one</html>'
+        self.requests = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.requests.append(dict(self.headers))
+                status, body = test.status, test.body
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if status == 200 and self.headers.get('If-None-Match', None) == etag:
+                    status, body = 304, b''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if status in (200, 304):
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config.registry.settings.update({
+            'reliquary.upstream.pypi': 'http://127.0.0.1:{}'.format(self.server.server_port),
+            'reliquary.upstream.retries': '0',
+            'reliquary.upstream.metadata_ttl': '300',
+            'reliquary.upstream.negative_ttl': '60',
+        })
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        super(UpstreamDocumentTests, self).tearDown()
+
+    def document(self):
+        from reliquary.upstream import upstream_document
+        return upstream_document(self.config.registry, 'pypi', '/simple/one/')
+
+    # as if upstream was last asked 'seconds' ago
+    def age(self, seconds):
+        import datetime
+        import transaction
+        from reliquary.models import DBSession, UpstreamDocument
+        with transaction.manager:
+            DBSession.query(UpstreamDocument).update(
+                {'checked': datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)})
+
+    def test_metadata_ttl(self):
+        import hashlib
+        self.assertEqual(self.document().content, b'<html>one</html>')
+        self.age(299)
+        self.assertEqual(self.document().content, b'<html>one</html>')
+        self.assertEqual(len(self.requests), 1)
+
+        # revalidated once it's older than the ttl
+        self.age(301)
+        self.assertEqual(self.document().content, b'<html>one</html>')
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1]['If-None-Match'],
+                         '"{}"'.format(hashlib.md5(b'<html>one</html>').hexdigest()))
+        self.assertEqual(self.requests[1]['If-Modified-Since'], 'Mon, 01 Jan 2024 00:00:00 GMT')
+        # and the ttl starts over
+        self.assertEqual(self.document().content, b'<html>one</html>')
+        self.assertEqual(len(self.requests), 2)
+
+        self.body = b'<html>two</html>'
+        self.age(301)
+        self.assertEqual(self.document().content, b'<html>two</html>')
+        self.assertEqual(self.document().content, b'<html>two</html>')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_negative_ttl(self):
+        self.status = 404
+        self.assertEqual(self.document().status_code, 404)
+        self.status = 200
+        self.assertEqual(self.document().status_code, 404)
+        self.assertEqual(len(self.requests), 1)
+        self.age(61)
+        self.assertEqual(self.document().content, b'<html>one</html>')
+
+    def test_upstream_unavailable(self):
+        self.document()
+        self.age(301)
+        self.status = 503
+        # used however old it is while upstream can't be reached
+        self.assertEqual(self.document().content, b'<html>one</html>')
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.assertEqual(self.document().content, b'<html>one</html>')
+
+    def test_upstream_error(self):
+        self.status = 500
+        self.assertEqual(self.document().status_code, 500)
+        self.status = 403
+        self.assertEqual(self.document().status_code, 403)
+        # neither is cached
+        self.status = 200
+        self.assertEqual(self.document().content, b'<html>one</html>')
@@ -0,0 +1,199 @@
+import datetime
+import json
+import logging
+import requests
+import threading
+import transaction
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from sqlalchemy.exc import IntegrityError
+
+from reliquary.cache import cache_get, cache_invalidate, cache_put, cache_value
+from reliquary.models import DBSession, UpstreamDocument
+
+
+logger = logging.getLogger(__name__)
+
+# upstream mirrors per ecosystem, overridden by the reliquary.upstream.<ecosystem>
+# settings (whitespace separated, tried in order)
+UPSTREAM_MIRRORS = {
+    'pypi': 'https://pypi.python.org',
+    'commonjs': 'http://registry.npmjs.org',
+}
+
+# statuses worth retrying (and failing over to the next mirror for)
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# defaults for how many seconds a metadata document (or its absence) is used
+# before it's revalidated with upstream
+METADATA_TTL = 300
+NEGATIVE_TTL = 60
+
+_session_lock = threading.Lock()
+
+
+def _setting(registry, name, default):
+    return (registry.settings or {}).get('reliquary.upstream.' + name, default)
+
+
+# the (connect, read) timeouts for upstream requests, in seconds
+def upstream_timeout(registry):
+    return (float(_setting(registry, 'connect_timeout', 5)),
+            float(_setting(registry, 'read_timeout', 30)))
+
+
+# how many seconds a request waits for another one fetching the same relic
+# from upstream, before it gives up
+def upstream_flight_timeout(registry):
+    return float(_setting(registry, 'flight_timeout', 60))
+
+
+# the pooled, keep-alive session upstream requests share, created on first use
+def upstream_session(registry):
+    session = getattr(registry, 'reliquary_upstream_session', None)
+    if session is not None:
+        return session
+
+    with _session_lock:
+        session = getattr(registry, 'reliquary_upstream_session', None)
+        if session is None:
+            retries = Retry(
+                total=int(_setting(registry, 'retries', 3)),
+                backoff_factor=float(_setting(registry, 'backoff', 0.5)),
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False)
+            poolsize = int(_setting(registry, 'pool_size', 10))
+            adapter = HTTPAdapter(max_retries=retries,
+                                  pool_connections=poolsize,
+                                  pool_maxsize=poolsize)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            registry.reliquary_upstream_session = session
+    return session
+
+
+# 'path' on each of the upstream mirrors of 'ecosystem', in the order to try them
+def upstream_urls(registry, ecosystem, path):
+    mirrors = _setting(registry, ecosystem, UPSTREAM_MIRRORS[ecosystem]).split()
+    return [mirror.rstrip('/') + path for mirror in mirrors]
+
+
+# GETs the first of 'urls' (a url, or a list of mirrored urls) that answers
+# without a server error, retrying each with backoff first. returns the
+# requests response, or None if no upstream could be reached.
+def upstream_get(registry, urls, **kwargs):
+    if isinstance(urls, str):
+        urls = [urls]
+    kwargs.setdefault('timeout', upstream_timeout(registry))
+
+    session = upstream_session(registry)
+    resp = None
+    for url in urls:
+        try:
+            resp = session.get(url, **kwargs)
+        except requests.RequestException as ex:
+            logger.warning('upstream {} failed: {}'.format(url, ex))
+            continue
+        if resp.status_code not in RETRY_STATUSES:
+            return resp
+        logger.warning('upstream {} had error {}'.format(url, resp.status_code))
+    return resp
+
+
+# a metadata document as upstream_document returns it, with the parts of a
+# requests response the proxy views use
+class CachedDocument(object):
+    def __init__(self, status_code, content=b'', encoding=None):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _document_cache_key(key):
+    return 'upstream-' + key
+
+
+def _save_document(key, **columns):
+    columns['checked'] = datetime.datetime.utcnow()
+    try:
+        with transaction.manager:
+            updated = DBSession.query(UpstreamDocument) \
+                               .filter_by(key=key) \
+                               .update(columns, synchronize_session=False)
+            if not updated:
+                DBSession.add(UpstreamDocument(key=key, **columns))
+    except IntegrityError:
+        # someone else saved it at the same time -- theirs is as good
+        logger.warning('upstream document "{}" was saved concurrently'.format(key))
+
+
+# GETs a metadata document (a simple page, a packument) at 'path' on the
+# upstream mirrors of 'ecosystem', through a local cache. it's used as is for
+# reliquary.upstream.metadata_ttl seconds after upstream was last asked, and
+# then revalidated with If-None-Match/If-Modified-Since. an upstream 404 is
+# cached the same way, for reliquary.upstream.negative_ttl seconds. while
+# upstream can't be reached, what's cached is used however old it is. returns
+# a CachedDocument (or the response, for other upstream errors), or None if
+# upstream couldn't be reached and nothing is cached.
+def upstream_document(registry, ecosystem, path):
+    key = '{}:{}'.format(ecosystem, path)
+    doc = DBSession.query(UpstreamDocument).filter_by(key=key).one_or_none()
+
+    cached = None
+    if doc and doc.status == 200:
+        entry = cache_get(_document_cache_key(key))
+        if entry:
+            cached = CachedDocument(200, cache_value(entry), doc.encoding)
+    elif doc:
+        cached = CachedDocument(doc.status)
+
+    headers = dict()
+    if cached:
+        if cached.status_code == 200:
+            ttl = float(_setting(registry, 'metadata_ttl', METADATA_TTL))
+        else:
+            ttl = float(_setting(registry, 'negative_ttl', NEGATIVE_TTL))
+        age = datetime.datetime.utcnow() - doc.checked
+        if age.total_seconds() < ttl:
+            return cached
+        if cached.status_code == 200:
+            if doc.etag:
+                headers['If-None-Match'] = doc.etag
+            if doc.last_modified:
+                headers['If-Modified-Since'] = doc.last_modified
+
+    resp = upstream_get(registry, upstream_urls(registry, ecosystem, path), headers=headers)
+    if resp is None or resp.status_code in RETRY_STATUSES:
+        if cached:
+            logger.warning('upstream unavailable, using cached {}'.format(key))
+            return cached
+        return resp
+
+    if resp.status_code == 304 and cached and cached.status_code == 200:
+        _save_document(key)
+        return cached
+
+    if resp.status_code == 200:
+        cache_put(_document_cache_key(key), resp.content)
+        _save_document(key,
+                       status=200,
+                       etag=resp.headers.get('ETag', None),
+                       last_modified=resp.headers.get('Last-Modified', None),
+                       encoding=resp.encoding)
+        return CachedDocument(200, resp.content, resp.encoding)
+
+    if resp.status_code == 404:
+        cache_invalidate([_document_cache_key(key)])
+        _save_document(key, status=404, etag=None, last_modified=None, encoding=None)
+        return CachedDocument(404)
+
+    return resp
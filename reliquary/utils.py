@@ -1,29 +1,73 @@
 import bz2
+import contextlib
 import datetime
+import difflib
 import gzip
 import hashlib
 import logging
+import lzma
 import os
 import re
-import requests
+import tempfile
+import threading
+import time
 import transaction
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+from debian import debfile
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from mimetypes import guess_type
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import Response
-
+from pyramid.threadlocal import get_current_registry, manager
+from sqlalchemy.exc import IntegrityError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from reliquary.blobs import blob_store_enabled, store_blob
+from reliquary.cache import (
+    cache_get,
+    cache_history,
+    cache_invalidate,
+    cache_keys,
+    cache_path,
+    cache_put,
+    cache_value,
+    memory_cache,
+)
 from reliquary.models import (
     Channel,
     DBSession,
     DebInfo,
     FileCache,
     Index,
+    RebuildQueue,
     Relic,
 )
+from reliquary.offload import offload_backend
+from reliquary.upstream import upstream_flight_timeout, upstream_get
 
 
 logger = logging.getLogger(__name__)
 
+# Packages variants served for each architecture; the compressed ones are all
+# built from the uncompressed (None) one
+DEBIAN_COMPRESSIONS = (None, 'gz', 'bz2', 'xz')
+# default levels, overridden by the reliquary.debian.<compression>_level settings
+DEBIAN_COMPRESSION_LEVELS = {'gz': 9, 'bz2': 9, 'xz': 6}
+# how many superseded versions of each Packages file are kept for clients
+# that fetched a Release listing them (Acquire-By-Hash), overridden by the
+# reliquary.debian.by_hash_history setting
+DEBIAN_BY_HASH_HISTORY = 3
+# how many previous generations of each Packages file clients can update
+# from with Packages.diff (PDiff), overridden by the
+# reliquary.debian.pdiff_history setting
+DEBIAN_PDIFF_HISTORY = 8
+
 
 def fetch_channel_from_name(name):
     if not name:
@@ -62,6 +106,26 @@ def fetch_index_from_names(channel, index):
     return fetch_index_from_name(channelobj, index)
 
 
+def fetch_or_create_index(channel, index):
+    channelobj = DBSession.query(Channel).filter_by(name=channel).first()
+    if not channelobj:
+        channelobj = Channel(dirty=False, name=channel)
+        with transaction.manager:
+            DBSession.add(channelobj)
+            DBSession.flush()
+
+    indexobj = DBSession.query(Index) \
+                        .filter_by(channel_id=channelobj.uid, name=index) \
+                        .first()
+    if not indexobj:
+        indexobj = Index(dirty=False, name=index, channel_id=channelobj.uid)
+        with transaction.manager:
+            DBSession.add(indexobj)
+            DBSession.flush()
+
+    return indexobj
+
+
 def validate_reliquary_location(req, channel, index, relic_name=None):
     if not channel or not index:
         return HTTPNotFound()
@@ -95,43 +159,916 @@ def validate_reliquary_location(req, channel, index, relic_name=None):
     return (reliquary, relic_folder, relic_path)
 
 
+def new_digest_hashers():
+    return dict(md5sum=hashlib.md5(),
+                sha1=hashlib.sha1(),
+                sha256=hashlib.sha256(),
+                sha512=hashlib.sha512())
+
+
+def file_digests(path, blocksize=65536):
+    hashers = new_digest_hashers()
+    with open(path, 'rb') as fin:
+        buf = fin.read(blocksize)
+        while len(buf) > 0:
+            for hasher in hashers.values():
+                hasher.update(buf)
+            buf = fin.read(blocksize)
+    return dict((k, h.hexdigest()) for k, h in hashers.items())
+
+
+# streams 'fin' into a temporary file in the relic's folder, hashing it on the
+# way through, and then renames it to 'relic_path'. the relic is never
+# partially visible at its final path, and only 'blocksize' bytes of it are
+# ever held in memory. returns the hex digests of what was written.
+def save_relic_stream(fin, relic_folder, relic_path, blocksize=65536):
+    hashers = new_digest_hashers()
+    fd, temp_path = tempfile.mkstemp(dir=relic_folder, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            buf = fin.read(blocksize)
+            while len(buf) > 0:
+                fout.write(buf)
+                for hasher in hashers.values():
+                    hasher.update(buf)
+                buf = fin.read(blocksize)
+        # mkstemp creates the file as 0600
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, relic_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return dict((k, h.hexdigest()) for k, h in hashers.items())
+
+
+# pulls the Packages index information out of a .deb -- returns a dict of
+# DebInfo column values, or None if the .deb is missing required fields.
+# 'digests' can be given if the file has already been hashed (see
+# save_relic_stream), otherwise the file is read and hashed here.
+def read_deb_info(name, path, indexname, digests=None):
+    # relative to the repository root, which would be something
+    # like /api/v1/{channel}/
+    filename = "pool/{}/{}".format(indexname, name)
+
+    # md5, sha1, sha256 and sha512 of file
+    if not digests:
+        digests = file_digests(path)
+
+    # the rest is ripped out of the .deb file or generated based
+    # on the information there.
+    deb = debfile.DebFile(path)
+    control = deb.control.debcontrol()
+
+    # deb control is dict-like object where key lookups are case-insensitive
+    info = dict(
+        filename=filename,
+        md5sum=digests['md5sum'],
+        sha1=digests['sha1'],
+        sha256=digests['sha256'],
+        sha512=digests['sha512'],
+        multi_arch=control.get("multi-arch", None),
+        package=control.get("package", None),
+        source=control.get("source", None),
+        version=control.get("version", None),
+        section=control.get("section", None),
+        priority=control.get("priority", None),
+        architecture=control.get("architecture", None),
+        essential=control.get("essential", None),
+        depends=control.get("depends", None),
+        recommends=control.get("recommends", None),
+        suggests=control.get("suggests", None),
+        enhances=control.get("enhances", None),
+        pre_depends=control.get("pre-depends", None),
+        installed_size=control.get("installed-size", None),
+        maintainer=control.get("maintainer", None),
+        description=control.get("description", None),
+        description_md5=control.get("description-md5", None),
+        homepage=control.get("homepage", None),
+        built_using=control.get("built_using", None))
+
+    # missing required fields are a deal breaker for including this package
+    # in the index
+    msg = name+" skipped for deb info: '{}' not found in control"
+    for field, key in (('Package', 'package'),
+                       ('Version', 'version'),
+                       ('Architecture', 'architecture'),
+                       ('Maintainer', 'maintainer'),
+                       ('Description', 'description')):
+        if not info[key]:
+            logger.error(msg.format(field))
+            return None
+
+    # binary packages are built for a single architecture (or 'all'), which
+    # is what Packages indices are selected by
+    info['arch'] = debian_normalize_architecture(info['architecture'])
+
+    # if the description-md5 wasn't specified, comput it!
+    # the computed value starts at the second character after the colon in the
+    # control file (basically, allowing the 'Header: ' format of the text file)
+    # and includes a trailing newline character. The value must be lowercase
+    # hex md5.
+    if not info['description_md5']:
+        description = info['description']
+        if description[-1] != "\n":
+            description += "\n"
+        info['description_md5'] = hashlib.md5(description.encode()).hexdigest()
+
+    # rendered once here, so Packages indices only need to concatenate them
+    size = os.path.getsize(path)
+    info['stanza'] = render_debian_stanza(info, size)
+    info['stanza_short'] = render_debian_stanza(info, size, long_description=False)
+
+    return info
+
+
+# the Packages index entry for a .deb, from a dict of DebInfo values (see
+# read_deb_info) and the size of the .deb. without 'long_description', only
+# the first line of the description is included (the rest is in
+# Translation-en).
+def render_debian_stanza(info, size, long_description=True):
+    lines = []
+    lines.append("Package: {}".format(info['package']))
+    if info['source']:
+        lines.append("Source: {}".format(info['source']))
+    lines.append("Version: {}".format(info['version']))
+    if info['section']:
+        lines.append("Section: {}".format(info['section']))
+    if info['priority']:
+        lines.append("Priority: {}".format(info['priority']))
+    lines.append("Architecture: {}".format(info['architecture']))
+    if info['essential']:
+        lines.append("Essential: {}".format(info['essential']))
+    if info['depends']:
+        lines.append("Depends: {}".format(info['depends']))
+    if info['recommends']:
+        lines.append("Recommends: {}".format(info['recommends']))
+    if info['suggests']:
+        lines.append("Suggests: {}".format(info['suggests']))
+    if info['enhances']:
+        lines.append("Enhances: {}".format(info['enhances']))
+    if info['pre_depends']:
+        lines.append("Pre-Depends: {}".format(info['pre_depends']))
+    if info['installed_size']:
+        lines.append("Installed-Size: {}".format(info['installed_size']))
+    lines.append("Maintainer: {}".format(info['maintainer']))
+    description = info['description']
+    if not long_description:
+        description = description.split("\n", 1)[0]
+    lines.append("Description: {}".format(description))
+    if info['homepage']:
+        lines.append("Homepage: {}".format(info['homepage']))
+    if info['built_using']:
+        lines.append("Built-Using: {}".format(info['built_using']))
+    lines.append("Filename: {}".format(info['filename']))
+    lines.append("Size: {}".format(size))
+    lines.append("MD5Sum: {}".format(info['md5sum']))
+    lines.append("SHA1: {}".format(info['sha1']))
+    lines.append("SHA256: {}".format(info['sha256']))
+    lines.append("SHA512: {}".format(info['sha512']))
+    lines.append("Description-md5: {}".format(info['description_md5']))
+    if info['multi_arch']:
+        lines.append("Multi-Arch: {}".format(info['multi_arch']))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def debian_normalize_architecture(architecture):
+    arches = architecture.lower().split()
+    if len(arches) > 1:
+        logger.warning('using "{}" out of multiple architectures "{}"'
+                       .format(arches[0], architecture))
+    return arches[0]
+
+
+# adds or updates the DebInfo for a relic -- expected to be called inside of
+# a transaction
+def upsert_deb_info(relic_id, index_id, info):
+    debinfo_dbobj = DBSession.query(DebInfo) \
+                             .filter_by(relic_id=relic_id) \
+                             .one_or_none()
+    if debinfo_dbobj:
+        DBSession.query(DebInfo) \
+                 .filter_by(uid=debinfo_dbobj.uid) \
+                 .update(dict(info, index_id=index_id))
+    else:
+        kwargs = dict(info)
+        kwargs['relic_id'] = relic_id
+        kwargs['index_id'] = index_id
+        DBSession.add(DebInfo(**kwargs))
+
+
+# queues the given architecture(s) of an index to be regenerated in the
+# background (see process_debian_rebuild_queue). until then, the cached
+# Packages/Release keep being served. asking again for something already
+# queued only pushes back when it's regenerated (debouncing bursts of uploads).
+def enqueue_debian_rebuild(index_id, architecture):
+    now = datetime.datetime.utcnow()
+    for arch in set(architecture.lower().split()):
+        try:
+            with transaction.manager:
+                queued = DBSession.query(RebuildQueue) \
+                                  .filter_by(index_id=index_id, arch=arch) \
+                                  .update({'requested': now}, synchronize_session=False)
+                if not queued:
+                    DBSession.add(RebuildQueue(index_id=index_id,
+                                               arch=arch,
+                                               first_requested=now,
+                                               requested=now))
+        except IntegrityError:
+            # queued by someone else in the meantime
+            pass
+
+
+# cache key of the settings the cached debian indices were generated with
+DEBIAN_SETTINGS_KEY = 'debian-settings'
+
+
+# queues every debian index to be regenerated when the settings that change
+# what's in them (reliquary.debian.split_descriptions) differ from the ones
+# the cached indices were generated with. returns whether they differed.
+def enqueue_debian_settings_rebuild():
+    current = 'split_descriptions={}\n'.format(
+        'true' if debian_split_descriptions() else 'false').encode()
+    entry = cache_get(DEBIAN_SETTINGS_KEY)
+    if entry and cache_value(entry) == current:
+        return False
+
+    for (index_id,) in DBSession.query(DebInfo.index_id).distinct():
+        enqueue_debian_rebuild(index_id, 'all')
+    cache_put(DEBIAN_SETTINGS_KEY, current)
+    return True
+
+
+# regenerates the queued debian indices that haven't been asked for again in
+# 'debounce' seconds, or have been waiting for 'max_delay' seconds. each queued
+# row is claimed by deleting it, so several workers can share the queue.
+# returns how many indices were regenerated.
+def process_debian_rebuild_queue(debounce=0, max_delay=None):
+    now = datetime.datetime.utcnow()
+    due = RebuildQueue.requested <= now - datetime.timedelta(seconds=debounce)
+    if max_delay is not None:
+        due = due | (RebuildQueue.first_requested <= now - datetime.timedelta(seconds=max_delay))
+    queued = DBSession.query(RebuildQueue.uid,
+                             RebuildQueue.index_id,
+                             RebuildQueue.arch,
+                             RebuildQueue.requested) \
+                      .filter(due) \
+                      .all()
+
+    rebuilds = dict()
+    for (uid, index_id, arch, requested) in queued:
+        with transaction.manager:
+            claimed = DBSession.query(RebuildQueue) \
+                               .filter_by(uid=uid, requested=requested) \
+                               .delete(synchronize_session=False)
+        if claimed:
+            rebuilds.setdefault(index_id, set()).add(arch)
+
+    for index_id, arches in rebuilds.items():
+        names = DBSession.query(Channel.name, Index.name) \
+                         .filter(Index.channel_id == Channel.uid) \
+                         .filter(Index.uid == index_id) \
+                         .first()
+        if not names:
+            continue
+        channel, index = names
+        try:
+            pregenerate_debian_index(channel, index, index_id, arches)
+        except Exception:
+            logger.exception("Failed to regenerate debian/{}/dist/{}, queueing it again".format(channel, index))
+            enqueue_debian_rebuild(index_id, " ".join(arches))
+    return len(rebuilds)
+
+
+# adds or updates the Relic row (and DebInfo for a .deb) for a relic that's
+# been saved to 'relic_path', so it's available without a reindex
+def index_relic(channel, index, relic_name, relic_path, digests=None):
+    indexobj = fetch_or_create_index(channel, index)
+
+    debinfo = None
+    if relic_name[-4:] == ".deb":
+        # a malformed .deb is still indexed, just without its deb info
+        try:
+            debinfo = read_deb_info(relic_name, relic_path, index, digests=digests)
+        except Exception as ex:
+            logger.error("failed to extract deb info from {}: {}".format(relic_path, ex))
+
+    # the relic may become a hardlink to a stored copy (and its mtime)
+    if digests and blob_store_enabled():
+        store_blob(relic_path, digests['sha256'])
+
+    relic_stat = os.stat(relic_path)
+    columns = relic_name_columns(relic_name)
+    columns.update(dirty=False,
+                   mtime=str(relic_stat.st_mtime),
+                   size=relic_stat.st_size)
+    if digests:
+        columns['sha256'] = digests['sha256']
+
+    with transaction.manager:
+        relicobj = DBSession.query(Relic) \
+                            .filter_by(index_id=indexobj.uid, name=relic_name) \
+                            .first()
+        # without digests, the stored sha256 is kept as long as it's still of
+        # what's on disk
+        if not digests and (not relicobj
+                            or relicobj.mtime != columns['mtime']
+                            or relicobj.size != columns['size']):
+            columns['sha256'] = None
+        if relicobj:
+            DBSession.query(Relic) \
+                     .filter_by(uid=relicobj.uid) \
+                     .update(columns)
+        else:
+            relicobj = Relic(index_id=indexobj.uid, name=relic_name, **columns)
+            DBSession.add(relicobj)
+            DBSession.flush()
+        if debinfo:
+            upsert_deb_info(relicobj.uid, indexobj.uid, debinfo)
+
+    if debinfo:
+        enqueue_debian_rebuild(indexobj.uid, debinfo['architecture'])
+
+    return relicobj
+
+
+# the architecture of an indexed .deb relic, or None if it isn't one
+def relic_debian_architecture(channel, index, relic_name):
+    result = DBSession.query(DebInfo.architecture) \
+                      .join(Relic, Relic.uid == DebInfo.relic_id) \
+                      .join(Index, Index.uid == Relic.index_id) \
+                      .join(Channel, Channel.uid == Index.channel_id) \
+                      .filter(Channel.name == channel) \
+                      .filter(Index.name == index) \
+                      .filter(Relic.name == relic_name) \
+                      .first()
+    return result[0] if result else None
+
+
+# whether the relic is indexed with the mtime and size of 'relic_stat', so
+# there's nothing to index again
+def relic_stat_matches(channel, index, relic_name, relic_stat):
+    result = DBSession.query(Relic.mtime, Relic.size) \
+                      .join(Index, Index.uid == Relic.index_id) \
+                      .join(Channel, Channel.uid == Index.channel_id) \
+                      .filter(Channel.name == channel) \
+                      .filter(Index.name == index) \
+                      .filter(Relic.name == relic_name) \
+                      .first()
+    return result is not None \
+        and result[0] == str(relic_stat.st_mtime) \
+        and result[1] == relic_stat.st_size
+
+
+# removes a relic (and its DebInfo) that no longer exists on disk. returns the
+# architecture of the relic if it was a .deb (whose Debian indices are queued
+# to be regenerated).
+def unindex_relic(channel, index, relic_name):
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return None
+
+    architecture = relic_debian_architecture(channel, index, relic_name)
+    with transaction.manager:
+        relic_uids = [uid for (uid,) in DBSession.query(Relic.uid)
+                                                 .filter_by(index_id=indexobj.uid,
+                                                            name=relic_name)]
+        if relic_uids:
+            DBSession.query(DebInfo) \
+                     .filter(DebInfo.relic_id.in_(relic_uids)) \
+                     .delete(synchronize_session=False)
+            DBSession.query(Relic) \
+                     .filter(Relic.uid.in_(relic_uids)) \
+                     .delete(synchronize_session=False)
+
+    if architecture:
+        enqueue_debian_rebuild(indexobj.uid, architecture)
+    return architecture
+
+
 def pypi_normalize_package_name(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
-def fetch_relic_if_not_exists(req, channel, index, relic_name, upstream):
+# the digests pypi publishes for a file in its url -- warehouse stores files
+# under their blake2b_256 split as <ab>/<cd>/<rest>, and a '#<hash>=<hexdigest>'
+# fragment may have been passed through (encoded) on the package name
+def pypi_upstream_digests(parta, partb, hashval, package):
+    digests = dict()
+    blake2b = (parta + partb + hashval).lower()
+    if hasattr(hashlib, 'blake2b') and re.match(r'^[0-9a-f]{64}$', blake2b):
+        digests['blake2b_256'] = blake2b
+    if '#' in package:
+        name, _, hexdigest = package.split('#', 1)[1].partition('=')
+        if name in hashlib.algorithms_available and re.match(r'^[0-9a-fA-F]+$', hexdigest):
+            digests[name] = hexdigest
+    return digests
+
+
+# relic path -> [lock, number of threads using it] for single_flight
+_flights = dict()
+_flights_lock = threading.Lock()
+
+# seconds between attempts at taking a lock file held by another process
+FLIGHT_POLL_INTERVAL = 0.1
+
+
+def _flight_lock_path(relic_path):
+    return os.path.join(os.path.dirname(relic_path),
+                        '.{}.lock'.format(os.path.basename(relic_path)))
+
+
+def _flock(lock_file, deadline=None):
+    if deadline is None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError('timed out waiting for the lock on {}'.format(lock_file.name))
+            time.sleep(FLIGHT_POLL_INTERVAL)
+
+
+# opens and locks the lock file of 'relic_path'. whoever holds a lock file
+# last removes it, so one that was removed while waiting for it is opened (and
+# created) again.
+def _lock_flight_file(relic_path, deadline=None):
+    lock_path = _flight_lock_path(relic_path)
+    while True:
+        lock_file = open(lock_path, 'a')
+        if not fcntl:
+            return lock_file
+        try:
+            _flock(lock_file, deadline)
+            try:
+                current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path))
+            except FileNotFoundError:
+                current = False
+        except:
+            lock_file.close()
+            raise
+        if current:
+            return lock_file
+        lock_file.close()
+
+
+def _unlock_flight_file(lock_file):
+    if fcntl:
+        # removed before it's unlocked, so nobody can lock it in between
+        try:
+            os.remove(lock_file.name)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    else:
+        lock_file.close()
+        try:
+            os.remove(lock_file.name)
+        except OSError:
+            pass
+
+
+# holds an exclusive lock on 'relic_path' -- between the threads of this
+# process, and between processes with a (hidden) lock file next to it, which
+# is removed again -- so only one of the requests missing the same relic
+# fetches it, while the others wait for it to be done. raises TimeoutError if
+# the lock isn't had within 'timeout' seconds.
+@contextlib.contextmanager
+def single_flight(relic_path, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _flights_lock:
+        flight = _flights.setdefault(relic_path, [threading.Lock(), 0])
+        flight[1] += 1
+    try:
+        if not flight[0].acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError('timed out waiting for {} to be fetched'.format(relic_path))
+        try:
+            lock_file = _lock_flight_file(relic_path, deadline)
+            try:
+                yield
+            finally:
+                _unlock_flight_file(lock_file)
+        finally:
+            flight[0].release()
+    finally:
+        with _flights_lock:
+            flight[1] -= 1
+            if not flight[1]:
+                del _flights[relic_path]
+
+
+def relic_is_local(index_id, relic_name, relic_path):
+    return os.path.exists(relic_path) \
+        and DBSession.query(Relic.uid) \
+                     .filter_by(index_id=index_id, name=relic_name) \
+                     .first() is not None
+
+
+# hashlib hasher for a digest named the way upstreams publish them
+def new_hasher(name):
+    if name == 'blake2b_256':
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(name)
+
+
+# fetches a relic from an upstream response in a thread of its own, writing it
+# to a temporary file in the relic's folder and hashing it on the way through,
+# while the client is sent what's been written so far. once upstream is done,
+# and what was received has the expected size and digests, the file is renamed
+# into place and indexed. the last byte is held back until then, so a client
+# never receives all of a relic that failed verification. the fetch doesn't
+# wait for the client, so 'flight' (the single_flight, in an ExitStack) is
+# released as soon as the relic is in place, however slowly the client reads.
+class UpstreamRelicTee(object):
+    def __init__(self, req, channel, index, relic_name, relic_folder,
+                 relic_path, resp, flight, expected=None, blocksize=65536):
+        self.registry = req.registry
+        self.channel = channel
+        self.index = index
+        self.relic_name = relic_name
+        self.relic_path = relic_path
+        self.resp = resp
+        self.flight = flight
+        self.blocksize = blocksize
+        self.chunks = resp.iter_content(blocksize)
+
+        # the size is only known if upstream didn't compress it for transfer
+        self.expected_size = None
+        if 'Content-Encoding' not in resp.headers and 'Content-Length' in resp.headers:
+            self.expected_size = int(resp.headers['Content-Length'])
+
+        self.hashers = new_digest_hashers()
+        self.expected = dict()
+        for name, hexdigest in (expected or {}).items():
+            key = 'md5sum' if name == 'md5' else name
+            if key not in self.hashers:
+                self.hashers[key] = new_hasher(name)
+            self.expected[key] = hexdigest.lower()
+
+        fd, self.temp_path = tempfile.mkstemp(dir=relic_folder, prefix='.', suffix='.part')
+        self.fout = os.fdopen(fd, 'wb')
+        # still reads the file once it's renamed into place
+        self.fin = open(self.temp_path, 'rb')
+
+        # guarded by 'condition' -- how much of the relic is written, and
+        # whether (and how) the fetch is over
+        self.condition = threading.Condition()
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.sent = 0
+
+        self.thread = threading.Thread(target=self.fetch,
+                                       name='reliquary-fetch',
+                                       daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    self.close()
+                    raise self.error
+                available = self.size if self.done else self.size - 1
+                if available > self.sent:
+                    break
+                if self.done:
+                    self.close()
+                    raise StopIteration
+                self.condition.wait()
+        chunk = self.fin.read(min(self.blocksize, available - self.sent))
+        self.sent += len(chunk)
+        return chunk
+
+    def fetch(self):
+        error = None
+        try:
+            for chunk in self.chunks:
+                if not chunk:
+                    continue
+                self.fout.write(chunk)
+                self.fout.flush()
+                for hasher in self.hashers.values():
+                    hasher.update(chunk)
+                with self.condition:
+                    self.size += len(chunk)
+                    self.condition.notify_all()
+            self.commit()
+        except Exception as ex:
+            logger.error('fetching {} from upstream failed: {}'.format(self.relic_name, ex))
+            error = ex
+        finally:
+            self.cleanup()
+            with self.condition:
+                self.error = error
+                self.done = True
+                self.condition.notify_all()
+
+    def commit(self):
+        self.fout.close()
+        if self.expected_size is not None and self.size != self.expected_size:
+            raise ValueError('{} was {} bytes instead of {}'.format(
+                self.relic_name, self.size, self.expected_size))
+        digests = dict((k, h.hexdigest()) for k, h in self.hashers.items())
+        for key, hexdigest in self.expected.items():
+            if digests[key] != hexdigest:
+                raise ValueError('{} {} was {} instead of {}'.format(
+                    self.relic_name, key, digests[key], hexdigest))
+
+        # mkstemp creates the file as 0600
+        os.chmod(self.temp_path, 0o644)
+        os.replace(self.temp_path, self.relic_path)
+        # the settings are needed by what's indexed, and this thread doesn't
+        # have the current registry
+        manager.push({'registry': self.registry, 'request': None})
+        try:
+            index_relic(self.channel, self.index, self.relic_name, self.relic_path, digests=digests)
+        finally:
+            manager.pop()
+            transaction.abort()
+            DBSession.remove()
+
+    # runs in the fetching thread once it's done, either way
+    def cleanup(self):
+        if not self.fout.closed:
+            self.fout.close()
+        if os.path.exists(self.temp_path):
+            logger.error('fetching {} from upstream was not completed'.format(self.relic_name))
+            os.remove(self.temp_path)
+        self.resp.close()
+        self.flight.close()
+
+    # the client is done (or gone) -- the fetch goes on regardless, so the
+    # relic is still saved for the next request
+    def close(self):
+        self.fin.close()
+
+
+# response for a relic proxied from upstream -- served from the reliquary if
+# it's already there, otherwise streamed from upstream while it's saved (see
+# UpstreamRelicTee). 'upstream' is the url of the relic, or a list of mirrored
+# urls (see reliquary.upstream.upstream_get). 'expected' are the digests
+# upstream published for the relic, by hashlib name.
+def proxy_relic_response(req, channel, index, relic_name, upstream, expected=None):
     indexobj = fetch_index_from_names(channel, index)
     if not indexobj:
-        return
+        return download_response(req, channel, index, relic_name)
 
-    relics = DBSession.query(Relic) \
-                      .filter_by(index_id=indexobj.uid, name=relic_name)
-    # doesn't exist locally yet
-    if relics.count() <= 0:
-        # get valid paths, if there are valid paths to be had
-        pathcheck = validate_reliquary_location(req, channel, index, relic_name=relic_name)  # noqa
-        if type(pathcheck) == Response:
-            return
-        reliquary, relic_folder, relic_path = pathcheck
+    # get valid paths, if there are valid paths to be had
+    pathcheck = validate_reliquary_location(req, channel, index, relic_name=relic_name)  # noqa
+    if type(pathcheck) == Response:
+        return pathcheck
+    reliquary, relic_folder, relic_path = pathcheck
+
+    if relic_is_local(indexobj.uid, relic_name, relic_path):
+        return download_response(req, channel, index, relic_name)
+
+    # create the channel/index if it doesn't exist
+    if not os.path.exists(relic_folder):
+        os.makedirs(relic_folder, exist_ok=True)
+
+    # only one request fetches a missing relic, any others wait for it to be
+    # done and then serve it from the reliquary
+    flight = contextlib.ExitStack()
+    try:
+        flight.enter_context(single_flight(relic_path, timeout=upstream_flight_timeout(req.registry)))
+    except TimeoutError:
+        logger.warning('timed out waiting for {} to be fetched from upstream'.format(relic_name))
+        resp = Response('{"status":"error","still fetching from upstream"}',
+                        content_type='application/json',
+                        status_code=503)
+        resp.headers['Retry-After'] = '5'
+        return resp
+    try:
+        if relic_is_local(indexobj.uid, relic_name, relic_path):
+            flight.close()
+            return download_response(req, channel, index, relic_name)
+
+        resp = upstream_get(req.registry, upstream, stream=True)
+        if resp is None or resp.status_code != 200:
+            logger.error("unable to fetch {} from upstream ({})".format(
+                relic_name, resp.status_code if resp is not None else 'unavailable'))
+            flight.close()
+            if resp is None:
+                return Response('{"status":"error","upstream unavailable"}',
+                                content_type='application/json',
+                                status_code=502)
+            resp.close()
+            return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
+                            content_type='application/json',
+                            status_code=404)
 
-        # create the channel/index if it doesn't exist
-        if not os.path.exists(relic_folder):
-            os.makedirs(relic_folder)
+        tee = UpstreamRelicTee(req, channel, index, relic_name, relic_folder,
+                               relic_path, resp, flight, expected=expected)
+    except:
+        flight.close()
+        raise
 
-        # fetch
-        resp = requests.get(upstream)
+    return Response(app_iter=tee,
+                    headers=relic_headers(relic_name, tee.expected_size),
+                    status=200)
 
-        # save
-        with open(relic_path, 'wb') as fout:
-            fout.write(resp.content)
 
-        # index
-        with transaction.manager:
-            DBSession.add(Relic(dirty=False,
-                                index_id=indexobj.uid,
-                                name=relic_name,
-                                mtime=str(os.path.getmtime(relic_path)),
-                                size=os.path.getsize(relic_path)))
+# header values for a relic response ('size' is left out if it isn't known)
+def relic_headers(relic_name, size=None):
+    mime_type, encoding = guess_type(relic_name)
+    if not mime_type:
+        mime_type = 'application/octet-stream'
+    headers = dict()
+    headers['Content-Type'] = mime_type
+    headers['Content-Disposition'] = 'attachment; filename="{}"'.format(relic_name)  # noqa
+    if size is not None:
+        headers['Content-Length'] = str(size)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+
+# default for the reliquary.download_cache_control setting -- the Cache-Control
+# of relic downloads (which are revalidated with their ETag once it expires)
+DOWNLOAD_CACHE_CONTROL = 'public, max-age=86400'
+
+
+# default for the reliquary.download_blocksize setting -- how many bytes of a
+# file are read at a time when it's sent by the app (not offloaded)
+DOWNLOAD_BLOCKSIZE = 65536
+
+
+# strong ETag for a relic -- its sha256 when the one stored for it is still of
+# what's on disk, otherwise its mtime and size
+def relic_etag(channel, index, relic_name, relic_stat):
+    result = DBSession.query(Relic.sha256, Relic.mtime, Relic.size) \
+                      .join(Index, Index.uid == Relic.index_id) \
+                      .join(Channel, Channel.uid == Index.channel_id) \
+                      .filter(Channel.name == channel) \
+                      .filter(Index.name == index) \
+                      .filter(Relic.name == relic_name) \
+                      .first()
+    if result:
+        sha256, mtime, size = result
+        if sha256 and mtime == str(relic_stat.st_mtime) and size == relic_stat.st_size:
+            return '"{}"'.format(sha256)
+    return '"{:x}-{:x}"'.format(int(relic_stat.st_mtime), relic_stat.st_size)
+
+
+# whether the client already has the version of a file with 'etag' and
+# 'mtime', going by If-None-Match, or If-Modified-Since if that isn't given
+def is_not_modified(req, etag, mtime):
+    if req.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = req.headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return '*' in tags or etag in tags
+    if_modified_since = req.headers.get('If-Modified-Since', None)
+    if if_modified_since is not None:
+        since = parsedate_tz(if_modified_since)
+        return since is not None and int(mtime) <= mktime_tz(since)
+    return False
+
+
+# most ranges a request can ask for before it's sent the whole file instead
+# (a client asking for hundreds of ranges isn't resuming a download)
+MAX_BYTE_RANGES = 32
+
+
+# parses a 'bytes=' Range header into (start, stop) offsets (stop exclusive)
+# into a file of 'size' bytes. returns None if the header is to be ignored
+# (it isn't valid, or asks for too many ranges), or an empty list if none of
+# its ranges can be satisfied.
+def parse_byte_ranges(header, size):
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_BYTE_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = re.match(r'^(\d*)\s*-\s*(\d*)$', spec)
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        first, last = match.groups()
+        if not first:
+            # a suffix range -- the last 'last' bytes
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        stop = min(int(last) + 1, size) if last else size
+        ranges.append((start, stop))
+    return ranges
+
+
+# whether the Range of a request still applies -- an If-Range has to match
+# the (strong) 'etag' or 'last_modified' of the file exactly
+def if_range_matches(req, etag=None, last_modified=None):
+    if_range = req.headers.get('If-Range', None)
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('W/'):
+        return False
+    if if_range.startswith('"'):
+        return etag is not None and if_range == etag
+    return last_modified is not None and if_range == last_modified
+
+
+# iterates over 'parts' of an open file -- (start, stop) offsets to read, or
+# bytes to send as they are -- 'blocksize' bytes at a time, and closes the
+# file when it's done (or when the response is closed before that)
+class FileRangeIter(object):
+    def __init__(self, fin, parts, blocksize=65536):
+        self.fin = fin
+        self.parts = parts
+        self.blocksize = blocksize
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, stop = part
+            self.fin.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                buf = self.fin.read(min(self.blocksize, remaining))
+                if not buf:
+                    break
+                remaining -= len(buf)
+                yield buf
+        self.close()
+
+    def close(self):
+        self.fin.close()
+
+
+# response for an open file of 'size' bytes, or the ranges of it the request
+# asked for (a 206, multipart/byteranges for several ranges). 'headers' are
+# those of the whole file. the file is only read from, never loaded whole --
+# and the whole file is handed to the server's wsgi.file_wrapper, when it has
+# one, so it can send it without going through python (e.g. with sendfile).
+def file_range_response(req, fin, size, headers, etag=None, last_modified=None,
+                        blocksize=DOWNLOAD_BLOCKSIZE):
+    headers = dict(headers)
+    ranges = None
+    if req.method == 'GET' and 'Range' in req.headers \
+            and if_range_matches(req, etag, last_modified):
+        ranges = parse_byte_ranges(req.headers['Range'], size)
+
+    if ranges is None:
+        file_wrapper = req.environ.get('wsgi.file_wrapper', None)
+        if file_wrapper is not None:
+            app_iter = file_wrapper(fin, blocksize)
+        else:
+            app_iter = FileRangeIter(fin, [(0, size)], blocksize)
+        return Response(app_iter=app_iter, headers=headers, status=200)
+
+    if not ranges:
+        fin.close()
+        return Response(headers={'Accept-Ranges': 'bytes',
+                                 'Content-Range': 'bytes */{}'.format(size)},
+                        status=416)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        headers['Content-Length'] = str(stop - start)
+        return Response(app_iter=FileRangeIter(fin, ranges, blocksize),
+                        headers=headers,
+                        status=206)
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, stop in ranges:
+        parts.append('\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'
+                     .format(boundary, headers['Content-Type'], start, stop - 1, size)
+                     .encode('ascii'))
+        parts.append((start, stop))
+    parts.append('\r\n--{}--\r\n'.format(boundary).encode('ascii'))
+
+    # the encoding applies to each part, not the multipart body
+    headers.pop('Content-Encoding', None)
+    headers['Content-Type'] = 'multipart/byteranges; boundary={}'.format(boundary)
+    headers['Content-Length'] = str(sum(len(part) if isinstance(part, bytes) else part[1] - part[0]
+                                        for part in parts))
+    return Response(app_iter=FileRangeIter(fin, parts, blocksize),
+                    headers=headers,
+                    status=206)
 
 
 def download_response(req, channel, index, relic_name):
@@ -150,37 +1087,69 @@ def download_response(req, channel, index, relic_name):
     relic_abs_path = os.path.abspath(os.path.join(reliquary, relic_path))
 
     settings = req.registry.settings
-    xsend_enabled = settings.get('reliquary.xsendfile_enabled', None) == 'true'
-    xsend_frontend = settings.get('reliquary.xsendfile_frontend', 'nginx') \
-                             .strip().lower()
-
-    # TODO: implement other xsend implementations besides nginx
-    if xsend_enabled and xsend_frontend != 'nginx':
-        return Response('{"status":"not implemented yet -- only nginx xsend '
-                        'support is enabled"}',
-                        content_type='application/json')
-
-    # header values for response
-    mime_type, encoding = guess_type(relic_abs_path)
-    if not mime_type:
-        mime_type = 'application/octet-stream'
-    content_length = str(os.path.getsize(relic_abs_path))
-    headers = dict()
-    headers['Content-Type'] = mime_type
-    headers['Content-Disposition'] = 'attachment; filename="{}"'.format(relic_name)  # noqa
-    headers['Content-Length'] = content_length
-    if encoding:
-        headers['Content-Encoding'] = encoding
+
+    # a client that already has the relic is told so without opening it
+    relic_stat = os.stat(relic_abs_path)
+    etag = relic_etag(channel, index, relic_name, relic_stat)
+    last_modified = formatdate(relic_stat.st_mtime, usegmt=True)
+    validators = dict()
+    validators['ETag'] = etag
+    validators['Last-Modified'] = last_modified
+    cache_control = settings.get('reliquary.download_cache_control', DOWNLOAD_CACHE_CONTROL)
+    if cache_control:
+        validators['Cache-Control'] = cache_control
+    if is_not_modified(req, etag, relic_stat.st_mtime):
+        return Response(headers=validators, status=304)
+
+    headers = relic_headers(relic_name, relic_stat.st_size)
+    headers.update(validators)
+    headers['Accept-Ranges'] = 'bytes'
 
     # only send back a response with xsend headers for proxy server
     # to handle
-    if xsend_enabled and xsend_frontend == 'nginx':
-        headers['X-Accel-Redirect'] = relic_abs_path
+    offload = offload_backend(req.registry)
+    if offload:
+        headers.update(offload.headers(relic_abs_path))
         return Response(headers=headers, status=200)
 
-    # return the actual object in the response
+    if req.method == 'HEAD':
+        return Response(headers=headers, status=200)
+
+    # return the actual object (or the requested ranges of it) in the response
     relic_fp = open(relic_abs_path, 'rb')
-    return Response(body_file=relic_fp, headers=headers, status=200)
+    return file_range_response(req, relic_fp, relic_stat.st_size, headers,
+                               etag=etag, last_modified=last_modified,
+                               blocksize=int(settings.get('reliquary.download_blocksize', DOWNLOAD_BLOCKSIZE)))
+
+
+# response for a cached file (see reliquary.cache) -- from memory if it's
+# already there, otherwise the file is sent like a relic (see
+# download_response), without ever being read into memory whole
+def cached_file_response(req, entry, content_type, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = content_type
+    headers['Content-Length'] = str(entry.size)
+
+    offload = offload_backend(req.registry)
+    if offload:
+        headers.update(offload.headers(cache_path(entry.sha256)))
+        return Response(headers=headers, status=200)
+
+    if req.method == 'HEAD':
+        return Response(headers=headers, status=200)
+
+    value = memory_cache.get(entry.sha256)
+    if value is not None:
+        return Response(body=value, headers=headers, status=200)
+
+    try:
+        cached_fp = open(cache_path(entry.sha256), 'rb')
+    except FileNotFoundError:
+        # superseded (and removed) since it was looked up
+        return HTTPNotFound()
+    settings = req.registry.settings or {}
+    return file_range_response(req, cached_fp, entry.size, headers,
+                               blocksize=int(settings.get('reliquary.download_blocksize', DOWNLOAD_BLOCKSIZE)))
 
 
 # based on commonjs packaging/1.1 spec (basically <name>-<semver>.<ext>)
@@ -242,6 +1211,21 @@ def split_pypi_name(name):
     return (name, None, None)
 
 
+# returns the Relic column values derived from a relic name, so they can be
+# computed once when the relic is indexed rather than on every request.
+# commonjs naming is stricter, so it's tried first; anything it doesn't match
+# falls back to the pypi conventions. the normalized name follows PEP-503,
+# which is also close enough for commonjs lookups to narrow down candidates.
+def relic_name_columns(name):
+    package_name, version, extension = split_commonjs_name(name)
+    if not version:
+        package_name, version, extension = split_pypi_name(name)
+    return dict(package_name=package_name,
+                normalized_name=pypi_normalize_package_name(package_name),
+                version=version,
+                extension=extension)
+
+
 # naming convention based on: https://www.debian.org/doc/debian-policy/ch-controlfields.html#s-f-Source
 # returns a tuple of the following values:
 #   2. name
@@ -262,156 +1246,256 @@ def split_debian_name(name):
     return None
 
 
-# 'compression' can be one of None, 'gz', or 'bz2'
-# if 'force' is True, the data is not pulled from the database
+# cache keys of the generated debian files. their parts are separated by '/',
+# which can't be in a channel, index or architecture name, so keys (and key
+# prefixes, which end with a '/') of different indices never overlap.
+def debian_package_key(channel, index, arch, compression=None):
+    return 'debian/{}/{}/binary-{}/{}'.format(channel, index, arch, compression or 'none')
+
+
+def debian_translation_key(channel, index, compression=None):
+    return 'debian/{}/{}/translation-en/{}'.format(channel, index, compression or 'none')
+
+
+# 'name' is 'Index' or the name of a patch in Packages.diff
+def debian_pdiff_key(channel, index, arch, name):
+    return 'debian/{}/{}/binary-{}/diff/{}'.format(channel, index, arch, name)
+
+
+def debian_release_key(channel, index):
+    return 'debian/{}/{}/release'.format(channel, index)
+
+
+def debian_compression_level(compression):
+    settings = get_current_registry().settings or {}
+    return int(settings.get('reliquary.debian.{}_level'.format(compression),
+                            DEBIAN_COMPRESSION_LEVELS[compression]))
+
+
+def debian_by_hash_history():
+    settings = get_current_registry().settings or {}
+    return int(settings.get('reliquary.debian.by_hash_history', DEBIAN_BY_HASH_HISTORY))
+
+
+# whether Packages only has the short descriptions, with the long ones in
+# i18n/Translation-en
+def debian_split_descriptions():
+    settings = get_current_registry().settings or {}
+    return settings.get('reliquary.debian.split_descriptions', None) == 'true'
+
+
+def debian_pdiff_history():
+    settings = get_current_registry().settings or {}
+    return int(settings.get('reliquary.debian.pdiff_history', DEBIAN_PDIFF_HISTORY))
+
+
+# superseded versions of the uncompressed Packages are also what PDiffs are
+# generated from
+def debian_package_history(compression):
+    if compression:
+        return debian_by_hash_history()
+    return max(debian_by_hash_history(), debian_pdiff_history())
+
+
+def compress_debian_package_index(data, compression, level):
+    if compression == "gz":
+        return gzip.compress(data, compresslevel=level)
+    elif compression == "bz2":
+        return bz2.compress(data, compresslevel=level)
+    elif compression == "xz":
+        return lzma.compress(data, preset=level)
+    return data
+
+
+# 'compression' can be one of None, 'gz', 'bz2', or 'xz'
+# if 'force' is True, the data is not pulled from the cache -- it's regenerated
+# and replaces the cached version in place, so requests keep getting the old
+# version (and what was generated from it) until then
 def generate_debian_package_index(channel, index, arch, compression=None, force=False):
-    basekey = '{}-{}-{}-'.format(channel, index, arch)
-    key = basekey
-    key += compression if compression else 'none'
+    key = debian_package_key(channel, index, arch, compression)
     if not force:
-        try:
-            cacheddata = DBSession.query(FileCache).filter_by(key=key).one_or_none()
-            if cacheddata:
-                return (cacheddata.value,
-                        cacheddata.mtime,
-                        cacheddata.size,
-                        cacheddata.md5sum,
-                        cacheddata.sha1,
-                        cacheddata.sha256)
-        except:
-            logger.error('multiple values with cache key "{}"'.format(key))
+        cacheddata = cache_get(key)
+        if cacheddata:
+            return cacheddata
+
+    # compressed files are based off of the (cached) uncompressed file, mainly
+    # so the cached files remain in sync in terms of content
+    if compression:
+        uncompressed = generate_debian_package_index(channel, index, arch)
+        if not uncompressed:
             return None
+        bytedata = cache_value(uncompressed)
+        depends = [debian_package_key(channel, index, arch)]
     else:
-        with transaction.manager:
-            DBSession.query(FileCache).filter_by(key=key).delete()
+        indexobj = fetch_index_from_names(channel, index)
+        if not indexobj:
+            return None
+
+        # generate Package file -- packages for 'all' architectures are
+        # included in the Packages for every architecture
+        arches = [arch] if arch == 'all' else [arch, 'all']
+        long_description = not debian_split_descriptions()
+        stanzacolumn = DebInfo.stanza if long_description else DebInfo.stanza_short
+        stanzas = []
+        archobjs = DBSession.query(DebInfo.uid, stanzacolumn) \
+                            .filter(DebInfo.index_id == indexobj.uid) \
+                            .filter(DebInfo.arch.in_(arches)) \
+                            .order_by(DebInfo.package, DebInfo.version, DebInfo.filename)
+        for uid, stanza in archobjs:
+            # stanzas are rendered when a .deb is indexed, but deb info indexed
+            # before that needs to be rendered here
+            if stanza is None:
+                relic, debinfo = DBSession.query(Relic, DebInfo) \
+                                          .filter(Relic.uid == DebInfo.relic_id) \
+                                          .filter(DebInfo.uid == uid) \
+                                          .one()
+                info = dict((c.name, getattr(debinfo, c.name))
+                            for c in DebInfo.__table__.columns)
+                stanza = render_debian_stanza(info, relic.size, long_description=long_description)
+            stanzas.append(stanza)
+
+        bytedata = "\n".join(stanzas).encode()
+        depends = []
 
-    # since the request is for a compressed file, check to see if we have a cached
-    # uncompressed file first, and base our compressed one off of that...
-    # mainly so the cached files remain in sync in terms of content
     if compression:
-        uncompressedkey = basekey + 'none'
-        try:
-            cacheddata = DBSession.query(FileCache).filter_by(key=uncompressedkey).one_or_none()
-            if cacheddata:
-                bytedata = cacheddata.value
-                if compression == "gz":
-                    finaldata = gzip.compress(bytedata)
-                elif compression == "bz2":
-                    finaldata = bz2.compress(bytedata)
-                else:
-                    finaldata = bytedata
-
-                mtime = datetime.datetime.utcnow()
-                size = len(finaldata)
-                md5sum = hashlib.md5(finaldata).hexdigest()
-                sha1 = hashlib.sha1(finaldata).hexdigest()
-                sha256 = hashlib.sha256(finaldata).hexdigest()
-                newcacheddata = FileCache(
-                    key=key,
-                    value=finaldata,
-                    mtime=mtime,
-                    size=size,
-                    md5sum=md5sum,
-                    sha1=sha1,
-                    sha256=sha256)
-                with transaction.manager:
-                    DBSession.add(newcacheddata)
-
-                return (finaldata, mtime, size, md5sum, sha1, sha256)
-        except:
-            logger.error('multiple values with cache key "{}"'.format(uncompressedkey))
-            return None
+        finaldata = compress_debian_package_index(bytedata, compression, debian_compression_level(compression))
+    else:
+        finaldata = bytedata
 
+    return cache_put(key, finaldata, depends=depends, history=debian_package_history(compression))
 
-    # generate and cache Package file
+
+# ed script (as from 'diff --ed') turning the lines 'old' into 'new'. the
+# changes are listed from the end of the file so line numbers stay valid.
+def debian_ed_diff(old, new):
     lines = []
-    archobjs = DBSession.query(Relic, DebInfo) \
-                        .filter(Relic.uid == DebInfo.relic_id) \
-                        .filter(DebInfo.architecture.ilike('%{0}%'.format(arch)))
-    for relic, debinfo in archobjs:
-        # we're possibly pulling only partial matches, so this just confirms the
-        # selection choice
-        arches = [a.lower().strip() for a in debinfo.architecture.split()]
-        if arch not in arches:
+    matcher = difflib.SequenceMatcher(None, old, new)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
             continue
+        if tag == 'insert':
+            lines.append("{}a".format(i1))
+        else:
+            lines_range = str(i2) if i2 - i1 == 1 else "{},{}".format(i1 + 1, i2)
+            lines.append(lines_range + ('d' if tag == 'delete' else 'c'))
+        if tag != 'delete':
+            lines.extend(new[j1:j2])
+            lines.append(".")
+    return "".join(line + "\n" for line in lines)
+
+
+# Packages.diff/Index for an architecture, with a patch from each of the
+# superseded Packages generations kept in the cache to the next one, ending at
+# the current Packages. patches are cached by the generations they're between,
+# so only the newest one has to be generated after the Packages change.
+def generate_debian_pdiff_index(channel, index, arch, force=False):
+    key = debian_pdiff_key(channel, index, arch, 'Index')
+    if not force:
+        cacheddata = cache_get(key)
+        if cacheddata:
+            return cacheddata
 
-        lines.append("Package: {}".format(debinfo.package))
-        if debinfo.source:
-            lines.append("Source: {}".format(debinfo.source))
-        lines.append("Version: {}".format(debinfo.version))
-        if debinfo.section:
-            lines.append("Section: {}".format(debinfo.section))
-        if debinfo.section:
-            lines.append("Priority: {}".format(debinfo.priority))
-        lines.append("Architecture: {}".format(debinfo.architecture))
-        if debinfo.essential:
-            lines.append("Essential: {}".format(debinfo.essential))
-        if debinfo.depends:
-            lines.append("Depends: {}".format(debinfo.depends))
-        if debinfo.recommends:
-            lines.append("Recommends: {}".format(debinfo.recommends))
-        if debinfo.suggests:
-            lines.append("Suggests: {}".format(debinfo.suggests))
-        if debinfo.enhances:
-            lines.append("Enhances: {}".format(debinfo.enhances))
-        if debinfo.pre_depends:
-            lines.append("Pre-Depends: {}".format(debinfo.pre_depends))
-        if debinfo.installed_size:
-            lines.append("Installed-Size: {}".format(debinfo.installed_size))
-        lines.append("Maintainer: {}".format(debinfo.maintainer))
-        lines.append("Description: {}".format(debinfo.description))
-        if debinfo.homepage:
-            lines.append("Homepage: {}".format(debinfo.homepage))
-        if debinfo.built_using:
-            lines.append("Built-Using: {}".format(debinfo.built_using))
-        lines.append("Filename: {}".format(debinfo.filename))
-        lines.append("Size: {}".format(relic.size))
-        lines.append("MD5Sum: {}".format(debinfo.md5sum))
-        lines.append("SHA1: {}".format(debinfo.sha1))
-        lines.append("SHA256: {}".format(debinfo.sha256))
-        lines.append("SHA512: {}".format(debinfo.sha512))
-        lines.append("Description-md5: {}".format(debinfo.description_md5))
-        if debinfo.multi_arch:
-            lines.append("Multi-Arch: {}".format(debinfo.multi_arch))
-        lines.append("")
+    current = generate_debian_package_index(channel, index, arch)
+    if not current:
+        return None
+    packagekey = debian_package_key(channel, index, arch)
+
+    # oldest to newest, skipping regenerations that didn't change anything
+    generations = []
+    superseded = cache_history(packagekey).limit(debian_pdiff_history()).all()
+    for generation in list(reversed(superseded)) + [current]:
+        if not generations or generations[-1].sha256 != generation.sha256:
+            generations.append(generation)
+
+    history = []
+    patches = []
+    downloads = []
+    patchkeys = set([key])
+    level = debian_compression_level('gz')
+    for (old, new) in zip(generations, generations[1:]):
+        name = "{}-{}".format(old.sha256[:16], new.sha256[:16])
+        patchkey = debian_pdiff_key(channel, index, arch, name)
+        patch = cache_get(patchkey)
+        patchgz = cache_get(patchkey + '.gz')
+        if not patch or not patchgz:
+            diff = debian_ed_diff(cache_value(old).decode().splitlines(),
+                                  cache_value(new).decode().splitlines()).encode()
+            patch = cache_put(patchkey, diff)
+            patchgz = cache_put(patchkey + '.gz', gzip.compress(diff, compresslevel=level))
+        patchkeys.update((patchkey, patchkey + '.gz'))
+        history.append(" {} {} {}".format(old.sha256, str(old.size).rjust(15), name))
+        patches.append(" {} {} {}".format(patch.sha256, str(patch.size).rjust(15), name))
+        downloads.append(" {} {} {}.gz".format(patchgz.sha256, str(patchgz.size).rjust(15), name))
+
+    # patches from generations that are no longer kept
+    stale = cache_keys(debian_pdiff_key(channel, index, arch, '')) - patchkeys
+    if stale:
+        cache_invalidate(stale)
 
-    data = "\n".join(lines)
-    bytedata = data.encode()
-    if compression == "gz":
-        finaldata = gzip.compress(bytedata)
-    elif compression == "bz2":
-        finaldata = bz2.compress(bytedata)
-    else:
-        finaldata = bytedata
+    lines = []
+    lines.append("SHA256-Current: {} {}".format(current.sha256, current.size))
+    lines.append("SHA256-History:")
+    lines.extend(history)
+    lines.append("SHA256-Patches:")
+    lines.extend(patches)
+    lines.append("SHA256-Download:")
+    lines.extend(downloads)
+    data = "\n".join(lines) + "\n"
+
+    # superseded versions stay available under by-hash/SHA256/
+    return cache_put(key, data.encode(), depends=[packagekey], history=debian_by_hash_history())
+
+
+# i18n/Translation-en for a channel/index: the long descriptions left out of
+# Packages when reliquary.debian.split_descriptions is on
+def generate_debian_translation_index(channel, index, compression=None, force=False):
+    key = debian_translation_key(channel, index, compression)
+    if not force:
+        cacheddata = cache_get(key)
+        if cacheddata:
+            return cacheddata
 
-    mtime = datetime.datetime.utcnow()
-    size = len(finaldata)
-    md5sum = hashlib.md5(finaldata).hexdigest()
-    sha1 = hashlib.sha1(finaldata).hexdigest()
-    sha256 = hashlib.sha256(finaldata).hexdigest()
-    newcacheddata = FileCache(
-        key=key,
-        value=finaldata,
-        mtime=mtime,
-        size=size,
-        md5sum=md5sum,
-        sha1=sha1,
-        sha256=sha256)
-    with transaction.manager:
-        DBSession.add(newcacheddata)
+    if compression:
+        uncompressed = generate_debian_translation_index(channel, index)
+        if not uncompressed:
+            return None
+        finaldata = compress_debian_package_index(cache_value(uncompressed), compression, debian_compression_level(compression))
+        depends = [debian_translation_key(channel, index)]
+    else:
+        indexobj = fetch_index_from_names(channel, index)
+        if not indexobj:
+            return None
 
-    return (finaldata, mtime, size, md5sum, sha1, sha256)
+        lines = []
+        descriptions = DBSession.query(DebInfo.package,
+                                       DebInfo.description_md5,
+                                       DebInfo.description) \
+                                .filter(DebInfo.index_id == indexobj.uid) \
+                                .order_by(DebInfo.package, DebInfo.description_md5) \
+                                .distinct()
+        for package, description_md5, description in descriptions:
+            lines.append("Package: {}".format(package))
+            lines.append("Description-md5: {}".format(description_md5))
+            lines.append("Description-en: {}".format(description))
+            lines.append("")
+        finaldata = "\n".join(lines).encode()
+        # the descriptions come from the packages of every architecture
+        depends = [debian_package_key(channel, index, arch)
+                   for arch in get_unique_architectures_set(indexobj.uid)]
+
+    # superseded versions stay available under by-hash/SHA256/
+    return cache_put(key, finaldata, depends=depends, history=debian_by_hash_history())
 
 
 def get_unique_architectures_set(index_id):
-    arches = set()
-    relics = DBSession.query(Relic).filter_by(index_id=index_id)
-    for relic in relics:
-        parts = split_debian_name(relic.name)
-        if not parts or not parts[2]:
-            continue
-        arches.add(parts[2])
-
+    arches = set(arch for (arch,) in DBSession.query(DebInfo.arch)
+                                              .filter_by(index_id=index_id)
+                                              .filter(DebInfo.arch.isnot(None))
+                                              .distinct())
+    # 'all' packages are listed in every other architecture's Packages, so
+    # 'all' only needs a Packages of its own if there's nothing else
+    if len(arches) > 1:
+        arches.discard('all')
     return arches
 
 
@@ -430,23 +1514,59 @@ Architecture: {architecture}""".format(architecture=arch)
     return (data, mtime, size, md5sum, sha1, sha256)
 
 
+# the cached file with the given sha256 that is (or was, before it was
+# superseded) cached under one of 'keys', as (entry, key), or None if there
+# isn't one
+def find_cached_by_hash(keys, sha256):
+    for entry in DBSession.query(FileCache).filter_by(sha256=sha256):
+        key = entry.key.split('@', 1)[0]
+        if key in keys:
+            return (entry, key)
+    return None
+
+
+# the cached Packages file (current or recently superseded) of an
+# architecture with the given sha256, as (entry, compression), or None if
+# there isn't one
+def find_debian_by_hash(channel, index, arch, sha256):
+    keys = dict((debian_package_key(channel, index, arch, c), c) for c in DEBIAN_COMPRESSIONS)
+    found = find_cached_by_hash(keys, sha256)
+    if not found:
+        return None
+    entry, key = found
+    return (entry, keys[key])
+
+
+# the cached Translation-en (current or recently superseded) of a channel/index
+# with the given sha256, as (entry, compression), or None if there isn't one
+def find_debian_translation_by_hash(channel, index, sha256):
+    keys = dict((debian_translation_key(channel, index, c), c) for c in DEBIAN_COMPRESSIONS)
+    found = find_cached_by_hash(keys, sha256)
+    if not found:
+        return None
+    entry, key = found
+    return (entry, keys[key])
+
+
+# the cached Packages.diff/Index (current or recently superseded), or patch of
+# an architecture with the given sha256, or None if there isn't one
+def find_debian_pdiff_by_hash(channel, index, arch, sha256):
+    keys = set(key.split('@', 1)[0] for key in
+               cache_keys(debian_pdiff_key(channel, index, arch, '')))
+    found = find_cached_by_hash(keys, sha256)
+    return found[0] if found else None
+
+
 def get_debian_release_data(index_id, force=False):
     indexobj = DBSession.query(Index).filter_by(uid=index_id).one()
     index = indexobj.name
     channel = DBSession.query(Channel).filter_by(uid=indexobj.channel_id).one().name
 
-    key = "{}-{}-release"
+    key = debian_release_key(channel, index)
     if not force:
-        try:
-            cacheddata = DBSession.query(FileCache).filter_by(key=key).one_or_none()
-            if cacheddata:
-                return cacheddata.value
-        except:
-            logger.error("apparently there's more than one release cached file for /{}/dist/{}/Release".format(channel, index))
-            return None
-    else:
-        with transaction.manager:
-            DBSession.query(FileCache).filter_by(key=key).delete()
+        cacheddata = cache_get(key)
+        if cacheddata:
+            return cacheddata
 
     lines = []
 
@@ -469,10 +1589,7 @@ def get_debian_release_data(index_id, force=False):
     # Architectures -- what are all the different architectures for packages
     #   being managed?
     # (required)
-    unique_arches = get_unique_architectures_set(index_id)
-    arches = []
-    for a in unique_arches:
-        arches.append(a)
+    arches = sorted(get_unique_architectures_set(index_id))
     lines.append("Architectures: {}".format(" ".join(arches)))
 
     # Components -- this is a fixed and static value for now
@@ -489,43 +1606,52 @@ def get_debian_release_data(index_id, force=False):
     #   1. checksum in the corresponding format
     #   2. size of the file
     #   3. filename relative to the directory of the Release file
-    arches = get_unique_architectures_set(index_id)
+    # the Release is regenerated along with the Packages files it lists (see
+    # pregenerate_debian_index), and dropped whenever one of them is
     md5sums = []
     sha1s = []
     sha256s = []
+    depends = []
     for arch in arches:
-        package = generate_debian_package_index(channel, index, arch)
-        packagegz = generate_debian_package_index(channel, index, arch, compression='gz')
-        packagebz2 = generate_debian_package_index(channel, index, arch, compression='bz2')
-        release = generate_debian_arch_release_index(arch)
-        # uncompressed
-        if not package:
-            logger.error("Failed to get package details for debian/{}/dist/{}/[In]Release ({})".format(channel, index, arch))
+        for compression in DEBIAN_COMPRESSIONS:
+            filename = "main/binary-{}/Packages{}".format(arch, '.' + compression if compression else '')
+            package = generate_debian_package_index(channel, index, arch, compression=compression)
+            if not package:
+                logger.error("Failed to get {} details for debian/{}/dist/{}/[In]Release".format(filename, channel, index))
+                continue
+            depends.append(debian_package_key(channel, index, arch, compression))
+            md5sums.append(" {} {} {}".format(package.md5sum, str(package.size).rjust(15), filename))
+            sha1s.append(" {} {} {}".format(package.sha1, str(package.size).rjust(15), filename))
+            sha256s.append(" {} {} {}".format(package.sha256, str(package.size).rjust(15), filename))
+        # pdiff
+        filename = "main/binary-{}/Packages.diff/Index".format(arch)
+        pdiff = generate_debian_pdiff_index(channel, index, arch)
+        if not pdiff:
+            logger.error("Failed to get {} details for debian/{}/dist/{}/[In]Release".format(filename, channel, index))
         else:
-            md5sums.append(" {} {} {}".format(package[3], str(package[2]).rjust(15), "main/binary-{}/Packages".format(arch)))
-            sha1s.append(" {} {} {}".format(package[4], str(package[2]).rjust(15), "main/binary-{}/Packages".format(arch)))
-            sha256s.append(" {} {} {}".format(package[5], str(package[2]).rjust(15), "main/binary-{}/Packages".format(arch)))
-        # gz
-        if not packagegz:
-            logger.error("Failed to get package.gz details for debian/{}/dist/{}/[In]Release ({})".format(channel, index, arch))
-        else:
-            md5sums.append(" {} {} {}".format(packagegz[3], str(packagegz[2]).rjust(15), "main/binary-{}/Packages.gz".format(arch)))
-            sha1s.append(" {} {} {}".format(packagegz[4], str(packagegz[2]).rjust(15), "main/binary-{}/Packages.gz".format(arch)))
-            sha256s.append(" {} {} {}".format(packagegz[5], str(packagegz[2]).rjust(15), "main/binary-{}/Packages.gz".format(arch)))
-        # bz2
-        if not packagebz2:
-            logger.error("Failed to get package.bz2 details for debian/{}/dist/{}/[In]Release ({})".format(channel, index, arch))
-        else:
-            md5sums.append(" {} {} {}".format(packagebz2[3], str(packagebz2[2]).rjust(15), "main/binary-{}/Packages.bz2".format(arch)))
-            sha1s.append(" {} {} {}".format(packagebz2[4], str(packagebz2[2]).rjust(15), "main/binary-{}/Packages.bz2".format(arch)))
-            sha256s.append(" {} {} {}".format(packagebz2[5], str(packagebz2[2]).rjust(15), "main/binary-{}/Packages.bz2".format(arch)))
+            depends.append(debian_pdiff_key(channel, index, arch, 'Index'))
+            md5sums.append(" {} {} {}".format(pdiff.md5sum, str(pdiff.size).rjust(15), filename))
+            sha1s.append(" {} {} {}".format(pdiff.sha1, str(pdiff.size).rjust(15), filename))
+            sha256s.append(" {} {} {}".format(pdiff.sha256, str(pdiff.size).rjust(15), filename))
         # release
-        if not release:
-            logger.error("Failed to get release details for debian/{}/dist/{}/[In]Release ({})".format(channel, index, arch))
-        else:
-            md5sums.append(" {} {} {}".format(release[3], str(release[2]).rjust(15), "main/binary-{}/Release".format(arch)))
-            sha1s.append(" {} {} {}".format(release[4], str(release[2]).rjust(15), "main/binary-{}/Release".format(arch)))
-            sha256s.append(" {} {} {}".format(release[5], str(release[2]).rjust(15), "main/binary-{}/Release".format(arch)))
+        filename = "main/binary-{}/Release".format(arch)
+        release = generate_debian_arch_release_index(arch)
+        md5sums.append(" {} {} {}".format(release[3], str(release[2]).rjust(15), filename))
+        sha1s.append(" {} {} {}".format(release[4], str(release[2]).rjust(15), filename))
+        sha256s.append(" {} {} {}".format(release[5], str(release[2]).rjust(15), filename))
+
+    # i18n -- the long descriptions, if they aren't in Packages
+    if debian_split_descriptions():
+        for compression in DEBIAN_COMPRESSIONS:
+            filename = "main/i18n/Translation-en{}".format('.' + compression if compression else '')
+            translation = generate_debian_translation_index(channel, index, compression=compression)
+            if not translation:
+                logger.error("Failed to get {} details for debian/{}/dist/{}/[In]Release".format(filename, channel, index))
+                continue
+            depends.append(debian_translation_key(channel, index, compression))
+            md5sums.append(" {} {} {}".format(translation.md5sum, str(translation.size).rjust(15), filename))
+            sha1s.append(" {} {} {}".format(translation.sha1, str(translation.size).rjust(15), filename))
+            sha256s.append(" {} {} {}".format(translation.sha256, str(translation.size).rjust(15), filename))
 
     lines.append("MD5Sum:")
     lines.append("\n".join(md5sums))
@@ -536,21 +1662,73 @@ def get_debian_release_data(index_id, force=False):
 
     # Acquire-By-Hash -- an alternative method for clients, this is just an
     #   indicator for whether or not the server supports this
-    # for now, reliquary does not support this
-    lines.append("Acquire-By-Hash: no")
+    # the Packages, Packages.diff/Index and Translation-en files listed here
+    # stay available under by-hash/SHA256/ after they're regenerated (see
+    # find_debian_by_hash, find_debian_pdiff_by_hash and
+    # find_debian_translation_by_hash)
+    lines.append("Acquire-By-Hash: yes")
 
     data = "\n".join(lines)
-    bytedata = data.encode()
-
-    with transaction.manager:
-        DBSession.add(FileCache(
-            key=key,
-            value=bytedata,
-            mtime=datetime.datetime.utcnow(),
-            size=len(data),
-            md5sum=hashlib.md5(bytedata).hexdigest(),
-            sha1=hashlib.sha1(bytedata).hexdigest(),
-            sha256=hashlib.sha256(bytedata).hexdigest(),
-        ))
-
-    return data
+    return cache_put(key, data.encode(), depends=depends)
+
+
+# regenerates the cached Packages files for the given architectures of a
+# channel/index (or all of its architectures), and everything generated from
+# them, along with its Release. everything is replaced in place, so requests
+# keep getting the previous versions while this runs. the compressed Packages
+# of every architecture are built concurrently.
+def pregenerate_debian_index(channel, index, index_id, arches=None):
+    current = get_unique_architectures_set(index_id)
+    # packages for 'all' are part of every architecture's Packages
+    if arches is None or 'all' in arches:
+        arches = set(arches or ()) | current
+    arches = set(arches)
+
+    # architectures that don't have packages anymore
+    gone = arches - current
+    if gone:
+        cache_invalidate([debian_package_key(channel, index, arch) for arch in gone])
+    arches &= current
+
+    uncompressed = {}
+    for arch in arches:
+        package = generate_debian_package_index(channel, index, arch, force=True)
+        if not package:
+            logger.error("Failed to generate Packages for debian/{}/dist/{}/main/binary-{}".format(channel, index, arch))
+            continue
+        uncompressed[arch] = cache_value(package)
+
+    # the settings are read here since the worker threads don't have the
+    # current registry
+    settings = get_current_registry().settings or {}
+    workers = int(settings.get('reliquary.debian.compression_workers', os.cpu_count() or 1))
+    levels = dict((c, debian_compression_level(c)) for c in DEBIAN_COMPRESSIONS if c)
+    history = debian_by_hash_history()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for arch, data in uncompressed.items():
+            for compression, level in levels.items():
+                futures[(arch, compression)] = pool.submit(compress_debian_package_index, data, compression, level)
+        for (arch, compression), future in futures.items():
+            key = debian_package_key(channel, index, arch, compression)
+            try:
+                finaldata = future.result()
+            except Exception:
+                logger.exception("Failed to generate Packages.{} for debian/{}/dist/{}/main/binary-{}".format(
+                    compression, channel, index, arch))
+                # don't leave the previous version around, it no longer
+                # matches the uncompressed Packages
+                cache_invalidate([key])
+                continue
+            cache_put(key,
+                      finaldata,
+                      depends=[debian_package_key(channel, index, arch)],
+                      history=history)
+
+    for arch in uncompressed:
+        generate_debian_pdiff_index(channel, index, arch, force=True)
+    if debian_split_descriptions():
+        for compression in DEBIAN_COMPRESSIONS:
+            generate_debian_translation_index(channel, index, compression=compression, force=True)
+
+    get_debian_release_data(index_id, force=True)
@@ -1,3 +1,4 @@
+import logging
 import os
 
 from pyramid.httpexceptions import HTTPNotFound
@@ -6,10 +7,15 @@ from pyramid.view import view_config
 
 from reliquary.utils import (
     download_response,
+    index_relic,
+    save_relic_stream,
     validate_reliquary_location,
 )
 
 
+logger = logging.getLogger(__name__)
+
+
 @view_config(route_name='put_relic', request_method='PUT', permission='put')
 def put_relic(req):
     # set path for relic from url parts
@@ -35,12 +41,17 @@ def put_relic(req):
     if not os.path.exists(relic_folder):
         os.makedirs(relic_folder)
 
-    # save relic to the path
-    req.body_file.seek(0)
-    with open(relic_path, 'wb') as fout:
-        fout.write(req.body_file.read())
+    # stream relic to the path
+    try:
+        digests = save_relic_stream(req.body_file, relic_folder, relic_path)
+    except (IOError, OSError) as ex:
+        logger.error('failed to save relic "{}": {}'.format(relic_path, ex))
+        return Response('{"status":"error","failed to save relic"}',
+                        content_type='application/json',
+                        status_code=500)
 
-    # TODO: index channel/index/relic
+    # index channel/index/relic so it's available without a reindex
+    index_relic(channel, index, relic_name, relic_path, digests=digests)
 
     return Response('{"status":"ok"}', content_type='application/json')
 
@@ -1,16 +1,15 @@
 import json
-import requests
 
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import Response
 from pyramid.view import view_config
 
 from reliquary.models import DBSession, Relic
+from reliquary.upstream import upstream_document
 from reliquary.utils import (
-    download_response,
     fetch_index_from_names,
-    fetch_relic_if_not_exists,
-    split_commonjs_name,
+    proxy_relic_response,
+    pypi_normalize_package_name,
 )
 
 
@@ -26,15 +25,12 @@ def commonjs_registry_root(req):
     if not indexobj:
         return HTTPNotFound()
 
-    relics = DBSession.query(Relic).filter_by(index_id=indexobj.uid)
+    names = DBSession.query(Relic.package_name) \
+                     .filter_by(index_id=indexobj.uid) \
+                     .filter(Relic.package_name.isnot(None)) \
+                     .distinct()
     uniqrelics = {}
-    for relic in relics:
-        matches = split_commonjs_name(relic.name)
-        relicname = None
-        if not matches:
-            relicname = relic.name
-        else:
-            relicname = matches[0]
+    for (relicname,) in names:
         relic_url = req.route_url('commonjs_registry_package_root',
                                   channel=channel,
                                   index=index,
@@ -63,16 +59,16 @@ def commonjs_registry_package_root(req):
     if not indexobj:
         return HTTPNotFound()
 
-    # this gets all packages that start with the requested package name,
-    # but it may include more than the intended package -- from here,
-    # each relic name needs to be broken down into it's name and version
-    # then compared with the the given name
+    # the normalized name narrows this down to the relics for the requested
+    # package, but normalization is looser than commonjs naming (e.g. '.' and
+    # '-' are equivalent), so the parsed name still needs to be compared with
+    # the given name
     results = DBSession.query(Relic) \
-                       .filter_by(index_id=indexobj.uid) \
-                       .filter(Relic.name.startswith(package))
+                       .filter_by(index_id=indexobj.uid,
+                                  normalized_name=pypi_normalize_package_name(package))
     packageobjroot = dict(name=package, versions=dict())
     for relic in results:
-        name, version, _ = split_commonjs_name(relic.name)
+        name, version = relic.package_name, relic.version
         if name.strip().lower() == package.strip().lower():
             relic_url = req.route_url('get_relic',
                                       channel=channel,
@@ -106,16 +102,17 @@ def commonjs_registry_package_version(req):
     if not indexobj:
         return HTTPNotFound()
 
-    # this gets all packages that start with the requested package name,
-    # but it may include more than the intended package -- from here,
-    # each relic name needs to be broken down into it's name and version
-    # then compared with the the given name
+    # the normalized name narrows this down to the relics for the requested
+    # package, but normalization is looser than commonjs naming (e.g. '.' and
+    # '-' are equivalent), so the parsed name still needs to be compared with
+    # the given name
     results = DBSession.query(Relic) \
-                       .filter_by(index_id=indexobj.uid) \
-                       .filter(Relic.name.startswith(package))
+                       .filter_by(index_id=indexobj.uid,
+                                  normalized_name=pypi_normalize_package_name(package),
+                                  version=version)
     packageversionobj = dict()
     for relic in results:
-        name, pversion, _ = split_commonjs_name(relic.name)
+        name, pversion = relic.package_name, relic.version
         if name.strip().lower() == package.strip().lower() \
                 and pversion == version:
             relic_url = req.route_url('get_relic',
@@ -144,10 +141,13 @@ def commonjs_proxy_registry_root(req):
                         status_code=404)
 
     # this really is just a proxy for the upstream.
-    # TODO: configurable upstream
     # TODO: more granular permissions for this view to prevent abuse
     # TODO: temp redirect to self-hosted url instead of proxy url
-    resp = requests.get('http://registry.npmjs.org/-/all')
+    resp = upstream_document(req.registry, 'commonjs', '/-/all')
+    if resp is None:
+        return Response('{"status":"error","upstream unavailable"}',
+                        content_type='application/json',
+                        status_code=502)
     if resp.status_code != 200:
         return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
                         content_type='application/json',
@@ -170,10 +170,13 @@ def commonjs_proxy_registry_package_root(req):
                         status_code=404)
 
     # this really is just a proxy for the upstream.
-    # TODO: configurable upstream
     # TODO: more granular permissions for this view to prevent abuse
     # TODO: temp redirect to self-hosted url instead of proxy url
-    resp = requests.get('http://registry.npmjs.org/{}/'.format(package))
+    resp = upstream_document(req.registry, 'commonjs', '/{}/'.format(package))
+    if resp is None:
+        return Response('{"status":"error","upstream unavailable"}',
+                        content_type='application/json',
+                        status_code=502)
     if resp.status_code != 200:
         return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
                         content_type='application/json',
@@ -232,10 +235,13 @@ def commonjs_proxy_registry_package_version(req):
                         status_code=404)
 
     # this really is just a proxy for the upstream.
-    # TODO: configurable upstream
     # TODO: more granular permissions for this view to prevent abuse
     # TODO: temp redirect to self-hosted url instead of proxy url
-    resp = requests.get('http://registry.npmjs.org/{}/{}/'.format(package, version))
+    resp = upstream_document(req.registry, 'commonjs', '/{}/{}/'.format(package, version))
+    if resp is None:
+        return Response('{"status":"error","upstream unavailable"}',
+                        content_type='application/json',
+                        status_code=502)
     if resp.status_code != 200:
         return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
                         content_type='application/json',
@@ -298,5 +304,4 @@ def commonjs_proxy_package(req):
     # package distributions are supposed to be tarball's with the ext 'tgz'
     relic_name = "{}-{}.tgz".format(package, version)
 
-    fetch_relic_if_not_exists(req, channel, index, relic_name, upstream)
-    return download_response(req, channel, index, relic_name)
+    return proxy_relic_response(req, channel, index, relic_name, upstream)
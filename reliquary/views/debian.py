@@ -5,13 +5,22 @@ from pyramid.httpexceptions import HTTPNotFound, HTTPInternalServerError
 from pyramid.response import Response
 from pyramid.view import view_config
 
+from reliquary.cache import cache_get
 from reliquary.models import DBSession, Index, Relic
 from reliquary.utils import (
+    cached_file_response,
     download_response,
     fetch_channel_from_name,
     fetch_index_from_names,
+    debian_pdiff_key,
+    debian_split_descriptions,
+    find_debian_by_hash,
+    find_debian_pdiff_by_hash,
+    find_debian_translation_by_hash,
     generate_debian_arch_release_index,
     generate_debian_package_index,
+    generate_debian_pdiff_index,
+    generate_debian_translation_index,
     get_debian_release_data,
     get_unique_architectures_set,
 )
@@ -19,6 +28,13 @@ from reliquary.utils import (
 
 logger = logging.getLogger(__name__)
 
+PACKAGES_CONTENT_TYPES = {
+    None: 'text/plain',
+    'gz': 'application/gzip',
+    'bz2': 'application/x-bzip2',
+    'xz': 'application/x-xz',
+}
+
 
 def packages_view(req, compression=None):
     channel = req.matchdict.get('channel', None)
@@ -43,13 +59,7 @@ def packages_view(req, compression=None):
     if not pkgdata:
         return HTTPInternalServerError()
 
-    contenttype = 'text/plain'
-    if compression == 'gz':
-        contenttype = 'application/gzip'
-    elif compression == 'bz2':
-        contenttype = 'application/x-bzip2'
-
-    return Response(pkgdata[0], content_type=contenttype, status_code=200)
+    return cached_file_response(req, pkgdata, PACKAGES_CONTENT_TYPES[compression])
 
 
 def fetch_channel_index_items(req, channelobj, route_name):
@@ -267,6 +277,12 @@ def debian_archindex(req):
                                arch=arch),
              text="Packages.bz2",
              cls="file"),
+        dict(url=req.route_url('debian_archpackagesxz',
+                               channel=channel,
+                               index=index,
+                               arch=arch),
+             text="Packages.xz",
+             cls="file"),
     ]
     items.sort(key=lambda x: x["text"])
 
@@ -317,6 +333,171 @@ def debian_archpackagesbz2(req):
     return packages_view(req, compression='bz2')
 
 
+@view_config(
+    route_name='debian_archpackagesdiff',
+    request_method='GET',
+    permission='view')
+def debian_archpackagesdiff(req):
+    channel = req.matchdict.get('channel', None)
+    index = req.matchdict.get('index', None)
+    arch = req.matchdict.get('arch', None)
+    name = req.matchdict.get('name', None)
+
+    if not channel or not index or not arch or not name:
+        return HTTPNotFound()
+
+    arch = arch.lower().strip()
+
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return HTTPNotFound()
+
+    if name == 'Index':
+        pdiffdata = generate_debian_pdiff_index(channel, index, arch)
+        if not pdiffdata:
+            return HTTPInternalServerError()
+        return cached_file_response(req, pdiffdata, 'text/plain')
+
+    # patches are generated along with the Index that lists them
+    patch = cache_get(debian_pdiff_key(channel, index, arch, name))
+    if not patch:
+        return HTTPNotFound()
+    contenttype = 'application/gzip' if name.endswith('.gz') else 'text/plain'
+    return cached_file_response(req, patch, contenttype)
+
+
+@view_config(
+    route_name='debian_archpackagesdiffbyhash',
+    request_method='GET',
+    permission='view')
+def debian_archpackagesdiffbyhash(req):
+    channel = req.matchdict.get('channel', None)
+    index = req.matchdict.get('index', None)
+    arch = req.matchdict.get('arch', None)
+    sha256 = req.matchdict.get('sha256', None)
+
+    if not channel or not index or not arch or not sha256:
+        return HTTPNotFound()
+
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return HTTPNotFound()
+
+    arch = arch.lower().strip()
+    entry = find_debian_pdiff_by_hash(channel, index, arch, sha256.lower())
+    if not entry:
+        return HTTPNotFound()
+
+    # the url is the content's hash, so it never changes
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+    contenttype = 'application/gzip' if entry.key.split('@', 1)[0].endswith('.gz') else 'text/plain'
+    return cached_file_response(req, entry, contenttype, headers=headers)
+
+
+@view_config(
+    route_name='debian_translation',
+    request_method='GET',
+    permission='view')
+def debian_translation(req):
+    channel = req.matchdict.get('channel', None)
+    index = req.matchdict.get('index', None)
+    name = req.matchdict.get('name', None)
+
+    if not channel or not index or not name:
+        return HTTPNotFound()
+
+    # long descriptions are only split out of Packages if configured to be
+    if not debian_split_descriptions():
+        return HTTPNotFound()
+
+    basename, _, compression = name.partition('.')
+    if basename != 'Translation-en' or compression not in [c or '' for c in PACKAGES_CONTENT_TYPES]:
+        return HTTPNotFound()
+    compression = compression or None
+
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return HTTPNotFound()
+
+    translationdata = generate_debian_translation_index(channel, index, compression=compression)
+    if not translationdata:
+        return HTTPInternalServerError()
+
+    return cached_file_response(req, translationdata, PACKAGES_CONTENT_TYPES[compression])
+
+
+@view_config(
+    route_name='debian_translationbyhash',
+    request_method='GET',
+    permission='view')
+def debian_translationbyhash(req):
+    channel = req.matchdict.get('channel', None)
+    index = req.matchdict.get('index', None)
+    sha256 = req.matchdict.get('sha256', None)
+
+    if not channel or not index or not sha256:
+        return HTTPNotFound()
+
+    if not debian_split_descriptions():
+        return HTTPNotFound()
+
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return HTTPNotFound()
+
+    found = find_debian_translation_by_hash(channel, index, sha256.lower())
+    if not found:
+        return HTTPNotFound()
+
+    # the url is the content's hash, so it never changes
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+    entry, compression = found
+    return cached_file_response(req, entry, PACKAGES_CONTENT_TYPES[compression], headers=headers)
+
+
+@view_config(
+    route_name='debian_archbyhash',
+    request_method='GET',
+    permission='view')
+def debian_archbyhash(req):
+    channel = req.matchdict.get('channel', None)
+    index = req.matchdict.get('index', None)
+    arch = req.matchdict.get('arch', None)
+    sha256 = req.matchdict.get('sha256', None)
+
+    if not channel or not index or not arch or not sha256:
+        return HTTPNotFound()
+
+    indexobj = fetch_index_from_names(channel, index)
+    if not indexobj:
+        return HTTPNotFound()
+
+    arch = arch.lower().strip()
+    sha256 = sha256.lower()
+
+    # the url is the content's hash, so it never changes
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+
+    release = generate_debian_arch_release_index(arch)
+    if release[5] == sha256:
+        return Response(release[0], content_type='text/plain', headers=headers, status_code=200)
+
+    found = find_debian_by_hash(channel, index, arch, sha256)
+    if not found:
+        return HTTPNotFound()
+
+    entry, compression = found
+    return cached_file_response(req, entry, PACKAGES_CONTENT_TYPES[compression], headers=headers)
+
+
+@view_config(
+    route_name='debian_archpackagesxz',
+    request_method='GET',
+    permission='view')
+def debian_archpackagesxz(req):
+    return packages_view(req, compression='xz')
+
+
 @view_config(
     route_name='debian_distrelease',
     request_method='GET',
@@ -332,8 +513,8 @@ def debian_distrelease(req):
     if not indexobj:
         return HTTPNotFound()
 
-    data = get_debian_release_data(indexobj.uid)
-    return Response(data, content_type='text/plain', status_code=200)
+    release = get_debian_release_data(indexobj.uid)
+    return cached_file_response(req, release, 'text/plain')
 
 
 @view_config(
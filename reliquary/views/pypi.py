@@ -1,16 +1,14 @@
-import requests
-
 from pyramid.response import Response
 from pyramid.url import route_url
 from pyramid.view import view_config
 
 from reliquary.models import DBSession, Relic
+from reliquary.upstream import upstream_document, upstream_urls
 from reliquary.utils import (
-    download_response,
     fetch_index_from_names,
-    fetch_relic_if_not_exists,
+    proxy_relic_response,
     pypi_normalize_package_name,
-    split_pypi_name,
+    pypi_upstream_digests,
 )
 
 
@@ -27,20 +25,15 @@ def pypi_simple(req):
     if not indexobj:
         return dict(lines=[])
 
+    # the normalized name is stored on each relic when it's indexed, so this
+    # is only a distinct over the (index_id, normalized_name) index
+    names = DBSession.query(Relic.normalized_name) \
+                     .filter_by(index_id=indexobj.uid) \
+                     .filter(Relic.normalized_name.isnot(None)) \
+                     .distinct()
     lines = []
-    relics = DBSession.query(Relic).filter_by(index_id=indexobj.uid)
-    uniqrelics = {}
-    for relic in relics:
-        matches = split_pypi_name(relic.name)
-        # if a name couldn't be satisfactorly extracted, use the the whole
-        # relic name as the package name
-        if not matches:
-            uniqrelics[relic.name] = True
-        else:
-            uniqrelics[matches[0]] = True
-    for relic, _ in uniqrelics.items():
-        lines.append("<a href='{0}'>{0}</a><br/>".format(
-                     pypi_normalize_package_name(relic)))
+    for (name,) in names:
+        lines.append("<a href='{0}'>{0}</a><br/>".format(name))
 
     lines.sort()
 
@@ -67,23 +60,19 @@ def pypi_simple_package(req):
         return dict(lines=[])
 
     lines = []
-    relics = DBSession.query(Relic).filter_by(index_id=indexobj.uid)
-    matched = []
-    for relic in relics:
-        rparts = split_pypi_name(relic.name)
-        normname = pypi_normalize_package_name(rparts[0])
-        if package == normname:
-            matched.append((relic.name, normname))
-    matched.sort(key=lambda x: x[1])
-
-    for relic in matched:
+    matched = DBSession.query(Relic.name) \
+                       .filter_by(index_id=indexobj.uid,
+                                  normalized_name=package) \
+                       .order_by(Relic.name)
+
+    for (relic_name,) in matched:
         packageurl = route_url('get_relic',
                                req,
                                channel=channel,
                                index=index,
-                               relic_name=relic[0])
+                               relic_name=relic_name)
         lines.append("<a href='{0}' rel='internal'>{1}</a><br/>".format(
-                     packageurl, relic[0]))
+                     packageurl, relic_name))
 
     return dict(lines=lines)
 
@@ -101,10 +90,13 @@ def pypi_proxy_simple(req):
                         status_code=404)
 
     # this really is just a proxy for the upstream.
-    # TODO: configurable upstream
     # TODO: more granular permissions for this view to prevent abuse
     # TODO: temp redirect to self-hosted url instead of proxy url
-    resp = requests.get('https://pypi.python.org/simple/')
+    resp = upstream_document(req.registry, 'pypi', '/simple/')
+    if resp is None:
+        return Response('{"status":"error","upstream unavailable"}',
+                        content_type='application/json',
+                        status_code=502)
     if resp.status_code != 200:
         return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
                         content_type='application/json',
@@ -127,10 +119,13 @@ def pypi_proxy_simple_package(req):
                         status_code=404)
 
     # this really is just a proxy for the upstream.
-    # TODO: configurable upstream
     # TODO: more granular permissions for this view to prevent abuse
     # TODO: temp redirect to self-hosted url instead of proxy url
-    resp = requests.get('https://pypi.python.org/simple/{0}/'.format(package))
+    resp = upstream_document(req.registry, 'pypi', '/simple/{0}/'.format(package))
+    if resp is None:
+        return Response('{"status":"error","upstream unavailable"}',
+                        content_type='application/json',
+                        status_code=502)
     if resp.status_code != 200:
         return Response('{"status":"error","upstream had error '+str(resp.status_code)+'"}',  # noqa
                         content_type='application/json',
@@ -157,7 +152,8 @@ def pypi_proxy_package(req):
 
     packageparts = package.split('#')
     relic_name = packageparts[0]
-    upstream = "https://pypi.python.org/packages/{0}/{1}/{2}/{3}".format(parta, partb, hashval, package)
+    upstream = upstream_urls(req.registry, 'pypi', "/packages/{0}/{1}/{2}/{3}".format(parta, partb, hashval, package))
+
+    expected = pypi_upstream_digests(parta, partb, hashval, package)
 
-    fetch_relic_if_not_exists(req, channel, index, relic_name, upstream)
-    return download_response(req, channel, index, relic_name)
+    return proxy_relic_response(req, channel, index, relic_name, upstream, expected=expected)
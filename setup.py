@@ -67,6 +67,7 @@ setup(name='reliquary',
       zip_safe=False,
       extras_require={
           'testing': tests_require,
+          'watch': ['inotify_simple'],
       },
       install_requires=requires,
       entry_points={
@@ -76,5 +77,8 @@ setup(name='reliquary',
           "console_scripts": [
               "init_reliquary = reliquary.scripts:init_reliquary",
               "reindex_reliquary = reliquary.scripts:reindex",
+              "reliquary-watch = reliquary.scripts:watch",
+              "reliquary-benchmark = reliquary.scripts:benchmark",
+              "reliquary-blobs = reliquary.scripts:blobs",
           ],
       })